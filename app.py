@@ -1,49 +1,179 @@
+import asyncio
 import json
 import time
 
 from distutils.util import strtobool
 from dataclasses import asdict
+from typing import Optional
 from uuid import uuid4
 
-from quart import Quart, abort, request
+from quart import Quart, Response, abort, g, make_response, request
 from quart_cors import cors
 from werkzeug.exceptions import HTTPException
 
-from lemon import check_signing_secret, \
+from cache import setup_cache, teardown_cache
+from events import setup_events, \
+    teardown_events, \
+    check_entitlements_limits, \
+    stream_entitlements
+from lemon import setup_lemonsqueezy, \
+    teardown_lemonsqueezy, \
+    check_signing_secret, \
     parse_event, \
-    dispatch_event, \
     activate_license as activate_license_internal
-from logger import logger
-from mongo.db import convert_id_to_str_in_json, \
-    convert_at_to_datetime_in_json
-from mongo.licenses import setup_licenses, \
+from logger import logger, log_body
+from metrics import Histogram
+from mongo.batcher import flush_batchers
+from mongo.db import setup_mongo, teardown_mongo
+from mongo.entitlements import entitlement_key, get_entitlements
+from mongo.licenses import check_licenses, \
     find_latest_license, \
+    find_latest_licenses, \
     convert_license_to_response
-from mongo.orders import setup_orders, \
+from mongo.orders import check_orders, \
     find_latest_order, \
+    find_latest_orders, \
     convert_order_to_response
-from mongo.subscriptions import setup_subscriptions, \
-    setup_subscription_payments, \
+from mongo.subscriptions import check_subscriptions, \
     find_latest_subscription, \
+    find_latest_subscriptions, \
     convert_subscription_to_response
-from mongo.users import User, setup_users, upsert_user
-from oauth import generate_user_token, \
+from mongo.users import User, check_users, upsert_user
+from oauth import setup_oauth, \
+    teardown_oauth, \
+    generate_user_token, \
     decrypt_user_token, \
     upsert_user_from_google_oauth
+from rds import setup_redis, \
+    teardown_redis, \
+    setup_secrets, \
+    teardown_secrets
+from shared_metrics import setup_shared_metrics, \
+    teardown_shared_metrics, \
+    render_shared_metrics
+from webhooks import setup_webhooks, teardown_webhooks, enqueue_webhook
 
 app = Quart(__name__)
 app = cors(app, allow_origin='*')
 
+_request_seconds = Histogram(
+    'lemonsqueepy_http_request_duration_seconds',
+    'HTTP request latency by method, route and status code.',
+    ('method', 'route', 'status'),
+)
+
+# Routes which record the request body, see `log_body()`.
+_BODY_LOGGED_ROUTES = {
+    '/api/webhooks/lemonsqueezy',
+    '/api/licenses/activate',
+}
+
+# The max items of `/api/entitlements/check` per request.
+_MAX_CHECK_ITEMS = 50
+
 
 # https://pgjones.gitlab.io/quart/how_to_guides/startup_shutdown.html
 @app.before_serving
 async def before_serving():
-    logger.info('setup collections before serving')
-    await setup_users()
-    await setup_orders()
-    await setup_licenses()
-    await setup_subscriptions()
-    await setup_subscription_payments()
+    # Clients are created per worker, see `hypercorn_config.py`.
+    logger.info('setup clients before serving')
+    await setup_mongo()
+    await setup_redis()
+
+    # Indexes are applied by `python cli.py apply-indexes` when deploying,
+    # instead of by every worker concurrently, see `apply_indexes()`;
+    # only the unique ones are ensured here, see `ensure_unique_indexes()`.
+    logger.info('check indexes and query plans before serving')
+    await check_users()
+    await check_orders()
+    await check_licenses()
+    await check_subscriptions()
+
+    logger.info('setup secrets before serving')
+    await setup_secrets()
+
+    logger.info('setup cache before serving')
+    await setup_cache()
+
+    logger.info('setup oauth before serving')
+    await setup_oauth()
+
+    logger.info('setup lemonsqueezy before serving')
+    await setup_lemonsqueezy()
+
+    logger.info('setup webhooks before serving')
+    await setup_webhooks()
+
+    logger.info('setup events before serving')
+    await setup_events()
+
+    logger.info('setup shared metrics before serving')
+    await setup_shared_metrics()
+
+
+@app.after_serving
+async def after_serving():
+    logger.info('teardown events after serving')
+    await teardown_events()
+
+    logger.info('teardown webhooks after serving')
+    await teardown_webhooks()
+
+    logger.info('flush batched writes after serving')
+    await flush_batchers()
+
+    logger.info('teardown lemonsqueezy after serving')
+    await teardown_lemonsqueezy()
+
+    logger.info('teardown oauth after serving')
+    await teardown_oauth()
+
+    logger.info('teardown cache after serving')
+    await teardown_cache()
+
+    logger.info('teardown secrets after serving')
+    await teardown_secrets()
+
+    # The last, so the final metrics of this worker are kept.
+    logger.info('teardown shared metrics after serving')
+    await teardown_shared_metrics()
+
+    logger.info('teardown clients after serving')
+    await teardown_redis()
+    await teardown_mongo()
+
+
+@app.before_request
+async def before_request():
+    g.start = time.perf_counter()
+
+
+# Handled errors (see `handle_exception()`) are recorded too.
+@app.after_request
+async def after_request(response: Response) -> Response:
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - g.get('start', time.perf_counter())
+    _request_seconds.observe(request.method, rule, str(response.status_code), value=elapsed)  # nopep8.
+
+    # Record the body for debugging, as configured in logger.py.
+    if rule in _BODY_LOGGED_ROUTES:
+        log_body(
+            name=rule,
+            body=await request.get_data(),  # cached.
+            error=response.status_code >= 400,
+            status=response.status_code,
+        )
+
+    return response
+
+
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+#
+# Only for the internal network, e.g. deny it in nginx;
+# merged from all workers, see `shared_metrics.py`.
+@app.get('/metrics')
+async def metrics():
+    return await render_shared_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}  # nopep8.
 
 
 # https://flask.palletsprojects.com/en/2.2.x/errorhandling/#generic-exception-handler
@@ -112,17 +242,15 @@ async def google_oauth():
 # we need to fallback to manual request Lemon Squeezy APIs.
 @app.post('/api/webhooks/lemonsqueezy')
 async def lemonsqueezy_webhooks():
-    # Always record webhooks body for debugging.
-    body: dict = await request.get_json() or {}
-    logger.info(f'/api/webhooks/lemonsqueezy, body={json.dumps(body)}')
-
+    # Verify the raw body before parsing, so forged payloads cost nothing.
     data = await request.get_data()  # raw body.
     check_signing_secret(request.headers, data)
-
     event = parse_event(request.headers)
-    convert_id_to_str_in_json(body)
-    convert_at_to_datetime_in_json(body)
-    await dispatch_event(event, body)
+
+    # Acknowledge as soon as queued, processed by consumers in background,
+    # and the duplicate deliveries are dropped directly.
+    signature = request.headers.get('X-Signature', '')
+    await enqueue_webhook(event, data, signature)
 
     return {}  # 200.
 
@@ -199,15 +327,129 @@ async def check_license():
     return convert_license_to_response(res)
 
 
+# Check many orders, subscriptions and licenses in one request,
+# with one query per collection.
+#
+# {
+#   'user_token': optional; str, required if checking orders or subscriptions.
+#   'items':      required; list of (up to `_MAX_CHECK_ITEMS`) objects:
+#     {'kind': 'order' | 'subscription', 'store_id': str, 'product_id': str,
+#      'variant_id': str, 'test_mode': optional bool}
+#     {'kind': 'license', 'license_key': str, 'test_mode': optional bool}
+# }
+#
+# Return the results by "KIND:STORE_ID:PRODUCT_ID:VARIANT_ID:TEST_MODE",
+# or "license:LICENSE_KEY:TEST_MODE", e.g. "order:1:2:3:false",
+# the result is as same as the single check API, or null if not found.
+@app.post('/api/entitlements/check')
+async def check_entitlements():
+    body: dict = await request.get_json() or {}
+
+    items = body.get('items')
+    if not isinstance(items, list) or not items:
+        abort(400, '"items" must be non-empty array')
+    if len(items) > _MAX_CHECK_ITEMS:
+        abort(400, f'"items" must not exceed {_MAX_CHECK_ITEMS}')
+
+    order_items: list[tuple[str, str, str, bool]] = []
+    subscription_items: list[tuple[str, str, str, bool]] = []
+    license_items: list[tuple[str, bool]] = []
+    for item in items:
+        if not isinstance(item, dict):
+            abort(400, '"items" must be array of objects')
+
+        kind = item.get('kind')
+        test_mode = item.get('test_mode', False)
+        if not isinstance(test_mode, bool):
+            abort(400, '"test_mode" must be boolean')
+
+        if kind == 'order' or kind == 'subscription':
+            product = (
+                _parse_str_from_dict(item, 'store_id'),
+                _parse_str_from_dict(item, 'product_id'),
+                _parse_str_from_dict(item, 'variant_id'),
+                test_mode,
+            )
+            (order_items if kind == 'order' else subscription_items).append(product)  # nopep8.
+        elif kind == 'license':
+            license_items.append((_parse_str_from_dict(item, 'license_key'), test_mode))  # nopep8.
+        else:
+            abort(400, '"kind" must be "order", "subscription" or "license"')
+
+    # Decrypt only once for all items.
+    user_id = ''
+    if order_items or subscription_items:
+        user_token = _parse_str_from_dict(body, 'user_token')
+        user_id = decrypt_user_token(user_token).user_id
+
+    found_orders, found_subscriptions, found_licenses = await asyncio.gather(
+        find_latest_orders(user_id, order_items),
+        find_latest_subscriptions(user_id, subscription_items),
+        find_latest_licenses(license_items),
+    )
+
+    res: dict[str, Optional[dict]] = {}
+    for item in order_items:
+        order = found_orders.get((user_id, *item))
+        res[entitlement_key('order', item)] = convert_order_to_response(order) if order else None  # nopep8.
+    for item in subscription_items:
+        subscription = found_subscriptions.get((user_id, *item))
+        res[entitlement_key('subscription', item)] = convert_subscription_to_response(subscription) if subscription else None  # nopep8.
+    for item in license_items:
+        license = found_licenses.get(item)
+        res[entitlement_key('license', item)] = convert_license_to_response(license) if license else None  # nopep8.
+
+    return res
+
+
+# ?user_token=str  required.
+#
+# Return all orders, subscriptions and licenses of the user,
+# as same as `/api/entitlements/check`, with the `ETag` header;
+# if the `If-None-Match` header matches, return 304 without querying MongoDB.
+@app.get('/api/user/entitlements')
+async def user_entitlements():
+    user_token = _parse_str_from_dict(request.args, 'user_token')
+    snapshot = await get_entitlements(decrypt_user_token(user_token).user_id)
+
+    headers = {'ETag': f'"{snapshot.etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(snapshot.etag):
+        return '', 304, headers
+
+    return snapshot.entitlements, 200, headers
+
+
+# ?user_token=str  required.
+#
+# Server-Sent Events of the entitlements of the user,
+# pushed as soon as a webhook touches the user, see events.py.
+#
+# Connect with `new EventSource(url)`, which sends the `Last-Event-ID` header
+# (the last ETag) on reconnecting, so the unchanged snapshot is skipped.
+@app.get('/api/user/events')
+async def user_events():
+    user_token = _parse_str_from_dict(request.args, 'user_token')
+    user_id = decrypt_user_token(user_token).user_id
+    check_entitlements_limits(user_id)
+
+    headers = {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # disable nginx buffering.
+    }
+    last_etag = request.headers.get('Last-Event-ID', '')
+    response = await make_response(stream_entitlements(user_id, last_etag), 200, headers)  # nopep8.
+    response.timeout = None  # closed by the stream itself, see `_LIFETIME`.
+    return response
+
+
 # {
 #   'license_key':   required; str.
 #   'instance_name': required; str.
 # }
 @app.post('/api/licenses/activate')
 async def activate_license():
-    # Always record api body for debugging.
     body: dict = await request.get_json() or {}
-    logger.info(f'/api/licenses/activate, body={json.dumps(body)}')
 
     license_key = _parse_str_from_dict(body, 'license_key')
     instance_name = _parse_str_from_dict(body, 'instance_name')
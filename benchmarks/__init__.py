@@ -0,0 +1,2 @@
+# Run benchmarks as modules in the project root directory,
+# e.g. `python -m benchmarks.bench_webhook`.
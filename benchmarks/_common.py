@@ -0,0 +1,92 @@
+import asyncio
+import contextlib
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+from typing import Callable, Iterator
+
+import httpx
+import orjson
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PAYLOADS_DIR = os.path.join(os.path.dirname(__file__), 'payloads')
+_RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def load_payload(name: str) -> bytes:
+    with open(os.path.join(_PAYLOADS_DIR, f'{name}.json'), 'rb') as f:
+        return f.read()
+
+
+# Return the best microseconds per call of `repeat` rounds,
+# the best is less disturbed by other processes than the mean.
+def bench(name: str, fn: Callable[[], object], number: int = 2000, repeat: int = 5) -> float:  # nopep8.
+    best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+    print(f'{name:<48} {best:>10.2f} us/call')
+    return best
+
+
+# Save the `results` as "benchmarks/results/NAME-COMMIT-TIMESTAMP.json" by default,
+# with the environment, for comparing across commits.
+def save_results(name: str, results: dict, path: str = '') -> str:
+    commit = _git_commit()
+    if not path:
+        os.makedirs(_RESULTS_DIR, exist_ok=True)
+        path = os.path.join(_RESULTS_DIR, f'{name}-{commit[:10]}-{int(time.time())}.json')  # nopep8.
+
+    data = {
+        'name': name,
+        'commit': commit,
+        'timestamp': int(time.time()),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+    print(f'results saved, path={path}')
+    return path
+
+
+# Start the production server with `workers`, and stop it when exited;
+# requires a local mongod and redis (with the signing secret).
+@contextlib.contextmanager
+def serve(bind: str, workers: int) -> Iterator[subprocess.Popen]:
+    env = dict(os.environ, LEMONSQUEEPY_BIND=bind, LEMONSQUEEPY_WORKERS=str(workers))  # nopep8.
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'hypercorn', '--config', 'python:hypercorn_config', 'app:app'],  # nopep8.
+        cwd=_ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get('/api/licenses/check?license_key=ready')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.5)
+    raise TimeoutError(f'server not ready, base_url={base_url}')
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_ROOT_DIR, text=True).strip()  # nopep8.
+    except Exception:
+        return 'unknown'
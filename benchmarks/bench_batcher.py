@@ -0,0 +1,74 @@
+import asyncio
+import copy
+import time
+import uuid
+
+import orjson
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks._common import load_payload
+from mongo.batcher import WriteBatcher
+from mongo.db import normalize_json
+
+# Requires a local mongod, writes to a throwaway database.
+_DATABASE = 'lemonsqueepy_bench'
+_DOCUMENTS = 5000
+_CONCURRENCY = 200  # in-flight webhooks.
+
+
+async def _insert_one(collection, documents: list[dict]) -> float:
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(_CONCURRENCY)
+
+    async def insert(document: dict):
+        async with semaphore:
+            await collection.insert_one(document)
+
+    await asyncio.gather(*[insert(d) for d in documents])
+    return len(documents) / (time.perf_counter() - start)
+
+
+async def _batched(collection, documents: list[dict], max_size: int) -> float:
+    batcher = WriteBatcher(collection, max_size=max_size)
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(_CONCURRENCY)
+
+    async def insert(document: dict):
+        async with semaphore:
+            await batcher.write(document)
+
+    await asyncio.gather(*[insert(d) for d in documents])
+    await batcher.flush()
+    return len(documents) / (time.perf_counter() - start)
+
+
+def _documents() -> list[dict]:
+    template = orjson.loads(load_payload('order_created'))
+    documents = []
+    for _ in range(_DOCUMENTS):
+        document = copy.deepcopy(template)
+        document['meta']['custom_data']['user_id'] = str(uuid.uuid4())
+        normalize_json(document)
+        documents.append(document)
+    return documents
+
+
+async def main():
+    client = AsyncIOMotorClient('localhost', 27017)
+    collection = client[_DATABASE]['orders']
+
+    await collection.drop()
+    rate = await _insert_one(collection, _documents())
+    print(f'{"insert_one":<24} {rate:>10.0f} docs/s')
+
+    for max_size in [1, 10, 50, 100, 500]:
+        await collection.drop()
+        rate = await _batched(collection, _documents(), max_size)
+        print(f'{f"batched max_size={max_size}":<24} {rate:>10.0f} docs/s')
+
+    await client.drop_database(_DATABASE)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+from typing import Any
+
+import orjson
+
+from dateutil import parser
+
+from benchmarks._common import bench, load_payload
+from mongo.db import convert_at_to_datetime_in_json, parse_iso8601
+
+
+# The `convert_at_to_datetime_in_json()` before, dateutil for all `_at` fields.
+def _legacy_convert_at_to_datetime_in_json(data: Any):
+    if isinstance(data, list):
+        for item in data:
+            _legacy_convert_at_to_datetime_in_json(item)
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            if not isinstance(value, str) or not key.endswith('_at'):
+                _legacy_convert_at_to_datetime_in_json(value)
+                continue
+            try:
+                data[key] = parser.isoparse(value)
+            except Exception:
+                pass  # DO NOTHING.
+
+
+def main():
+    value = '2023-01-17T12:26:23.000000Z'
+    bench('isoparse', lambda: parser.isoparse(value), number=20000)
+    bench('parse_iso8601', lambda: parse_iso8601(value), number=20000)
+    bench('isoparse invalid', lambda: _isoparse_or_none('...'), number=20000)  # nopep8.
+    bench('parse_iso8601 invalid', lambda: parse_iso8601('...'), number=20000)
+    print()
+
+    for name in ['order_created', 'subscription_updated']:
+        data = load_payload(name)
+        bench(f'{name} legacy', lambda: _legacy_convert_at_to_datetime_in_json(orjson.loads(data)))  # nopep8.
+        bench(f'{name} fast path', lambda: convert_at_to_datetime_in_json(orjson.loads(data)))  # nopep8.
+
+
+def _isoparse_or_none(value: str):
+    try:
+        return parser.isoparse(value)
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    main()
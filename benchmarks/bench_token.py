@@ -0,0 +1,47 @@
+import json
+import time
+
+from base64 import b64encode
+
+from Crypto.Cipher import AES
+
+from benchmarks._common import bench
+from oauth import generate_user_token, \
+    _decrypt_user_token, \
+    _decrypt_legacy_user_token
+from signing import get_signing_keyring
+
+_SECRET = '0123456789abcdef'
+
+
+# The `generate_user_token()` before, base64 JSON of base64 fields.
+def _generate_legacy_user_token(user_id: str, timestamp: int, secret: str) -> str:  # nopep8.
+    info = json.dumps({'user_id': user_id, 'generate_timestamp': timestamp})
+    cipher = AES.new(secret.encode(), AES.MODE_EAX)
+    ciphertext, tag = cipher.encrypt_and_digest(info.encode())
+    token = json.dumps({
+        'ciphertext': b64encode(ciphertext).decode(),
+        'tag': b64encode(tag).decode(),
+        'nonce': b64encode(cipher.nonce).decode(),
+    })
+    return b64encode(token.encode()).decode()
+
+
+def main():
+    user_id = 'b2b2a2b5-1bd3-4f4e-8a0e-6f1c1b0e1a7d'
+    timestamp = int(time.time())
+
+    keyring = get_signing_keyring(_SECRET)
+    legacy = _generate_legacy_user_token(user_id, timestamp, _SECRET)
+    token = generate_user_token(user_id, timestamp, _SECRET)
+    print(f'token length, legacy={len(legacy)}, compact={len(token)}')
+
+    bench('generate legacy', lambda: _generate_legacy_user_token(user_id, timestamp, _SECRET), number=20000)  # nopep8.
+    bench('generate compact', lambda: generate_user_token(user_id, timestamp, _SECRET), number=20000)  # nopep8.
+    bench('decrypt legacy', lambda: _decrypt_legacy_user_token(legacy, keyring), number=20000)  # nopep8.
+    bench('decrypt compact', lambda: _decrypt_user_token.__wrapped__(token, keyring), number=20000)  # nopep8.
+    bench('decrypt compact cached', lambda: _decrypt_user_token(token, keyring), number=20000)  # nopep8.
+
+
+if __name__ == '__main__':
+    main()
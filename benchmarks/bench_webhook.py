@@ -0,0 +1,34 @@
+import json
+
+import orjson
+
+from benchmarks._common import bench, load_payload
+from mongo.db import convert_id_to_str_in_json, \
+    convert_at_to_datetime_in_json, \
+    normalize_json
+
+
+# The webhook handler before, parse twice, dump once, walk twice.
+def _legacy(data: bytes):
+    body = json.loads(data)  # request.get_json()
+    json.dumps(body)  # for logging.
+    convert_id_to_str_in_json(body)
+    convert_at_to_datetime_in_json(body)
+
+
+def _single_pass(data: bytes):
+    data.decode(errors='replace')  # for logging.
+    body = orjson.loads(data)
+    normalize_json(body)
+
+
+def main():
+    for name in ['order_created', 'subscription_updated']:
+        data = load_payload(name)
+        legacy = bench(f'{name} legacy', lambda: _legacy(data))
+        single = bench(f'{name} single pass', lambda: _single_pass(data))
+        print(f'{name} saved {legacy - single:.2f} us/webhook ({legacy / single:.1f}x)\n')  # nopep8.
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from benchmarks._common import serve, wait_ready
+from oauth import generate_user_token
+
+# Requires a local mongod and redis (with the signing secret),
+# starts hypercorn with `hypercorn_config.py` for each worker count,
+# then requests the check endpoints with `concurrency` clients.
+_BIND = '127.0.0.1:8765'
+
+
+async def _drive(paths: list[str], concurrency: int, duration: float) -> int:
+    count = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(client: httpx.AsyncClient, i: int):
+        nonlocal count
+        while time.monotonic() < deadline:
+            await client.get(paths[i % len(paths)])
+            count += 1
+            i += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f'http://{_BIND}', limits=limits) as client:  # nopep8.
+        await asyncio.gather(*[worker(client, i) for i in range(concurrency)])
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)  # seconds.
+    args = parser.parse_args()
+
+    token = generate_user_token('bench', int(time.time()))
+    paths = [
+        f'/api/orders/check?user_token={token}&store_id=1&product_id=1&variant_id=1',  # nopep8.
+        f'/api/subscriptions/check?user_token={token}&store_id=1&product_id=1&variant_id=1',  # nopep8.
+        '/api/licenses/check?license_key=bench',
+    ]
+
+    for workers in args.workers:
+        with serve(_BIND, workers):
+            asyncio.run(wait_ready(f'http://{_BIND}'))
+            count = asyncio.run(_drive(paths, args.concurrency, args.duration))
+            print(f'workers={workers:<4} {count / args.duration:>10.1f} req/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import copy
+import hashlib
+import hmac
+import time
+import uuid
+
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+import httpx
+import orjson
+
+from benchmarks._common import load_payload, save_results, serve, wait_ready
+from rds import get_str_from_rds, LEMONSQUEEZY_SIGNING_SECRET
+
+_BIND = '127.0.0.1:8766'
+
+# Report these percentiles of the latencies, in milliseconds.
+_PERCENTILES = [50, 95, 99]
+
+Request = Callable[[httpx.AsyncClient], Awaitable[httpx.Response]]
+
+
+# Acts as Lemon Squeezy, signs and sends webhooks of unique orders and licenses,
+# so the deduplication doesn't short-circuit them.
+class LemonSqueezyStub:
+    def __init__(self, secret: str, user_id: str):
+        self._secret = secret.encode()
+        self._user_id = user_id
+        self._order = orjson.loads(load_payload('order_created'))
+        self._license = orjson.loads(load_payload('license_key_created'))
+        self._updated_at = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+    def order_created(self) -> tuple[dict, bytes]:
+        body = self._next(self._order)
+        return self._sign('order_created', body)
+
+    def license_key_created(self, key: str) -> tuple[dict, bytes]:
+        body = self._next(self._license)
+        body['data']['attributes']['key'] = key
+        return self._sign('license_key_created', body)
+
+    def _next(self, payload: dict) -> dict:
+        self._updated_at += timedelta(seconds=1)
+        body = copy.deepcopy(payload)
+        body['meta']['custom_data']['user_id'] = self._user_id
+        body['data']['id'] = str(uuid.uuid4())
+        body['data']['attributes']['updated_at'] = self._updated_at.isoformat().replace('+00:00', 'Z')  # nopep8.
+        return body
+
+    def _sign(self, event: str, body: dict) -> tuple[dict, bytes]:
+        data = orjson.dumps(body)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Event-Name': event,
+            'X-Signature': hmac.new(self._secret, data, hashlib.sha256).hexdigest(),  # nopep8.
+        }
+        return headers, data
+
+
+async def _run_scenario(
+    base_url: str,
+    request: Request,
+    concurrency: int,
+    duration: float,
+) -> dict:
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    deadline = time.monotonic() + duration
+
+    async def worker(client: httpx.AsyncClient):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                status = str((await request(client)).status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    started = time.monotonic()
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:  # nopep8.
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    res = {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'statuses': statuses,
+    }
+    for p in _PERCENTILES:
+        res[f'p{p}_ms'] = _percentile(latencies, p)
+    return res
+
+
+# Nearest-rank percentile of the sorted `values`.
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]  # nopep8.
+
+
+async def _main(args: argparse.Namespace) -> dict:
+    base_url = f'http://{_BIND}'
+    await wait_ready(base_url)
+
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        user = (await client.post('/api/user/register')).json()
+
+        # Seed one order and one license, and wait for the consumers.
+        stub = LemonSqueezyStub(get_str_from_rds(LEMONSQUEEZY_SIGNING_SECRET), user['id'])  # nopep8.
+        license_key = str(uuid.uuid4())
+        for headers, data in [stub.order_created(), stub.license_key_created(license_key)]:  # nopep8.
+            await client.post('/api/webhooks/lemonsqueezy', headers=headers, content=data)  # nopep8.
+
+        order_params = {
+            'user_token': user['token'],
+            'store_id': '1',
+            'product_id': '1',
+            'variant_id': '1',
+        }
+        for _ in range(100):
+            res = await client.get('/api/orders/check', params=order_params)
+            if res.status_code == 200:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            raise TimeoutError('seeded webhooks not processed')
+
+    async def check_order(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.get('/api/orders/check', params=order_params)
+
+    async def check_license(client: httpx.AsyncClient) -> httpx.Response:
+        return await client.get('/api/licenses/check', params={'license_key': license_key})  # nopep8.
+
+    async def send_webhook(client: httpx.AsyncClient) -> httpx.Response:
+        headers, data = stub.order_created()
+        return await client.post('/api/webhooks/lemonsqueezy', headers=headers, content=data)  # nopep8.
+
+    scenarios: dict[str, Request] = {
+        'orders_check': check_order,
+        'licenses_check': check_license,
+        'webhook': send_webhook,
+    }
+
+    results = {}
+    for name in args.scenarios:
+        res = await _run_scenario(base_url, scenarios[name], args.concurrency, args.duration)  # nopep8.
+        results[name] = res
+        print(f'{name:<16} {res["rps"]:>10.1f} req/s  '
+              f'p50={res["p50_ms"]:.2f}ms p95={res["p95_ms"]:.2f}ms p99={res["p99_ms"]:.2f}ms  '  # nopep8.
+              f'statuses={res["statuses"]}')
+    return results
+
+
+# End-to-end load test against the production server,
+# requires a local mongod and redis (with the signing secret):
+#
+#   python -m benchmarks.load [--workers 1] [--concurrency 32] [--duration 10] [--output PATH]
+#
+# Results are saved as JSON for comparing across commits.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)  # seconds.
+    parser.add_argument('--scenarios', nargs='+', default=['orders_check', 'licenses_check', 'webhook'])  # nopep8.
+    parser.add_argument('--output', default='')  # nopep8; default in benchmarks/results.
+    args = parser.parse_args()
+
+    with serve(_BIND, args.workers):
+        results = asyncio.run(_main(args))
+
+    results['config'] = {
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+    }
+    save_results('load', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import copy
+import hashlib
+import hmac
+import time
+
+import orjson
+
+from werkzeug.datastructures import Headers
+
+from benchmarks._common import bench, load_payload, save_results
+from lemon import check_signing_secret
+from mongo.db import convert_id_to_str_in_json, \
+    convert_at_to_datetime_in_json, \
+    normalize_json
+from oauth import generate_user_token, decrypt_user_token, _decrypt_user_token
+from signing import get_signing_keyring
+
+_SECRET = '0123456789abcdef'
+
+
+# Micro benchmarks of the per request hot paths, without any server:
+#
+#   python -m benchmarks.micro [--output PATH]
+#
+# Results are saved as JSON (microseconds per call) for comparing across commits.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='')  # nopep8; default in benchmarks/results.
+    args = parser.parse_args()
+
+    results: dict[str, float] = {}
+
+    for name in ['order_created', 'subscription_updated', 'license_key_created']:  # nopep8.
+        data = load_payload(name)
+        body = orjson.loads(data)
+
+        # Copy first, the converters modify in place; the copying is measured separately.
+        results[f'{name}/deepcopy'] = bench(f'{name} deepcopy', lambda: copy.deepcopy(body))  # nopep8.
+        results[f'{name}/convert_id_to_str_in_json'] = bench(f'{name} convert_id_to_str_in_json', lambda: convert_id_to_str_in_json(copy.deepcopy(body)))  # nopep8.
+        results[f'{name}/convert_at_to_datetime_in_json'] = bench(f'{name} convert_at_to_datetime_in_json', lambda: convert_at_to_datetime_in_json(copy.deepcopy(body)))  # nopep8.
+        results[f'{name}/normalize_json'] = bench(f'{name} normalize_json', lambda: normalize_json(copy.deepcopy(body)))  # nopep8.
+
+        signature = hmac.new(_SECRET.encode(), data, hashlib.sha256).hexdigest()  # nopep8.
+        headers = Headers({'X-Signature': signature})
+        results[f'{name}/check_signing_secret'] = bench(f'{name} check_signing_secret', lambda: check_signing_secret(headers, data, _SECRET))  # nopep8.
+        print()
+
+    user_id = 'b2b2a2b5-1bd3-4f4e-8a0e-6f1c1b0e1a7d'
+    timestamp = int(time.time())
+    token = generate_user_token(user_id, timestamp, _SECRET)
+    keyring = get_signing_keyring(_SECRET)
+
+    results['generate_user_token'] = bench('generate_user_token', lambda: generate_user_token(user_id, timestamp, _SECRET), number=20000)  # nopep8.
+    results['decrypt_user_token'] = bench('decrypt_user_token', lambda: _decrypt_user_token.__wrapped__(token, keyring), number=20000)  # nopep8.
+    results['decrypt_user_token/cached'] = bench('decrypt_user_token cached', lambda: decrypt_user_token(token, _SECRET), number=20000)  # nopep8.
+
+    save_results('micro', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
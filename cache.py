@@ -0,0 +1,323 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import time
+
+import bson
+import redis
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from logger import logger
+from metrics import collector
+from rds import async_rds, get_script
+
+# All caches by name, for reporting stats and invalidation messages.
+_caches: dict[str, 'KeyedCache'] = {}
+
+# Invalidation messages are broadcast to all workers by redis pub/sub,
+# as "name:digest" format.
+_INVALIDATE_CHANNEL = 'lemonsqueepy:cache:invalidate'
+
+_listener: Optional[asyncio.Task] = None
+
+# Set the shared value only if the generation of the key is unchanged
+# since the value is loaded, i.e. not invalidated by any worker meanwhile.
+#
+# KEYS[1] the value key, KEYS[2] the generation key.
+# ARGV[1] the generation when loading, ARGV[2] the value, ARGV[3] the TTL.
+_SET_SCRIPT = '''
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+'''
+
+
+# Two tiers LRU cache of an async function, as same as `alru_cache`,
+# but invalidates the entries of given arguments only,
+# instead of clearing the whole cache.
+#
+# The first tier is in process, the second tier is shared by redis (optional),
+# and an invalidation is broadcast to all workers (processes),
+# so the TTLs can be minutes without serving stale values.
+#
+# The key is the bound arguments (with defaults) of the function,
+# so `f(1, b=2)` and `f(1, 2)` are the same entry.
+class KeyedCache:
+    def __init__(
+        self,
+        fn: Callable[..., Awaitable[Any]],
+        name: str,
+        maxsize: int = 1024,
+        ttl: float = 10,  # seconds.
+        shared_ttl: Optional[int] = None,  # nopep8; seconds; None means in process only.
+        encode: Callable[[Any], Any] = lambda v: v,  # nopep8; to BSON compatible value.
+        decode: Callable[[Any], Any] = lambda v: v,
+    ):
+        self._fn = fn
+        self._signature = inspect.signature(fn)
+        self._name = name
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._shared_ttl = shared_ttl
+        self._encode = encode
+        self._decode = decode
+
+        self._entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+
+        # The loading of each missed key, shared by concurrent callers,
+        # removed when invalidated, so the stale value is not cached.
+        self._loading: dict[str, asyncio.Task] = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._shared_hits = 0
+        self._shared_misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+        functools.update_wrapper(self, fn)
+        _caches[name] = self
+
+    async def __call__(self, *args, **kwargs) -> Any:
+        digest = self._digest(*args, **kwargs)
+
+        entry = self._entries.get(digest)
+        if entry and entry[1] > time.monotonic():
+            self._hits += 1
+            self._entries.move_to_end(digest)
+            return entry[0]
+
+        self._misses += 1
+        task = self._loading.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._load(digest, args, kwargs))
+            task.add_done_callback(functools.partial(self._loaded, digest))
+            self._loading[digest] = task
+
+        # A cancelled caller doesn't cancel the others.
+        return await asyncio.shield(task)
+
+    async def invalidate(self, *args, **kwargs) -> bool:
+        digest = self._digest(*args, **kwargs)
+        dropped = self._drop(digest)
+
+        if self._shared_ttl is None:
+            return dropped
+
+        # Bump the generation first, so the values loaded before by any worker
+        # are not set, see `_SET_SCRIPT`.
+        try:
+            async with async_rds.pipeline(transaction=False) as pipe:
+                pipe.incr(self._generation_key(digest))
+                pipe.expire(self._generation_key(digest), self._shared_ttl)
+                pipe.delete(self._shared_key(digest))
+                pipe.publish(_INVALIDATE_CHANNEL, f'{self._name}:{digest}')
+                await pipe.execute()
+        except redis.RedisError:
+            logger.exception(f'invalidate shared cache failed, name={self._name}')  # nopep8.
+
+        return dropped
+
+    # Invalidate all entries whose cached value matches the `predicate`,
+    # in process only.
+    def invalidate_if(self, predicate: Callable[[Any], bool]) -> int:
+        self._loading.clear()  # the loading values may match too.
+        digests = [d for d, (v, _) in self._entries.items() if predicate(v)]
+        for digest in digests:
+            del self._entries[digest]
+
+        self._invalidations += len(digests)
+        return len(digests)
+
+    def clear(self):
+        self._loading.clear()
+        self._invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+            'shared_hits': self._shared_hits,
+            'shared_misses': self._shared_misses,
+            'evictions': self._evictions,
+            'invalidations': self._invalidations,
+        }
+
+    def _digest(self, *args, **kwargs) -> str:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = repr(tuple(bound.arguments.values()))
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def _shared_key(self, digest: str) -> str:
+        return f'lemonsqueepy:cache:{self._name}:{digest}'
+
+    def _generation_key(self, digest: str) -> str:
+        return f'lemonsqueepy:cache:{self._name}:{digest}:generation'
+
+    def _set(self, digest: str, value: Any):
+        self._entries[digest] = (value, time.monotonic() + self._ttl)
+        self._entries.move_to_end(digest)
+
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def _drop(self, digest: str) -> bool:
+        self._loading.pop(digest, None)
+        if self._entries.pop(digest, None) is None:
+            return False
+
+        self._invalidations += 1
+        return True
+
+    def _loaded(self, digest: str, task: asyncio.Task):
+        if self._loading.get(digest) is task:
+            del self._loading[digest]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if all callers are cancelled.
+
+    async def _load(self, digest: str, args: tuple, kwargs: dict) -> Any:
+        found, value, generation = await self._get_shared(digest)
+        if not found:
+            value = await self._fn(*args, **kwargs)
+
+        # Don't cache the value loaded before invalidation, it may be stale.
+        if self._loading.get(digest) is asyncio.current_task():
+            self._set(digest, value)
+            if not found:
+                await self._set_shared(digest, value, generation)
+
+        return value
+
+    # Return (found, value, generation).
+    async def _get_shared(self, digest: str) -> tuple[bool, Any, bytes]:
+        if self._shared_ttl is None:
+            return False, None, b''
+
+        try:
+            data, generation = await async_rds.mget(
+                self._shared_key(digest),
+                self._generation_key(digest),
+            )
+        except redis.RedisError:
+            logger.exception(f'get shared cache failed, name={self._name}')
+            return False, None, b''
+
+        generation = generation or b'0'
+        if data is None:
+            self._shared_misses += 1
+            return False, None, generation
+
+        self._shared_hits += 1
+        return True, self._decode(bson.decode(data)['v']), generation
+
+    async def _set_shared(self, digest: str, value: Any, generation: bytes):
+        if self._shared_ttl is None or not generation:
+            return
+
+        try:
+            data = bson.encode({'v': self._encode(value)})
+            await get_script(_SET_SCRIPT)(
+                keys=[self._shared_key(digest), self._generation_key(digest)],
+                args=[generation, data, self._shared_ttl],
+                client=async_rds,
+            )
+        except redis.RedisError:
+            logger.exception(f'set shared cache failed, name={self._name}')
+
+
+def keyed_cache(
+    name: str,
+    maxsize: int = 1024,
+    ttl: float = 10,
+    shared_ttl: Optional[int] = None,
+    encode: Callable[[Any], Any] = lambda v: v,
+    decode: Callable[[Any], Any] = lambda v: v,
+):
+    def decorator(fn: Callable[..., Awaitable[Any]]) -> KeyedCache:
+        return KeyedCache(
+            fn,
+            name=name,
+            maxsize=maxsize,
+            ttl=ttl,
+            shared_ttl=shared_ttl,
+            encode=encode,
+            decode=decode,
+        )
+    return decorator
+
+
+def cache_stats() -> dict[str, dict]:
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+
+async def setup_cache():
+    global _listener
+    _listener = asyncio.create_task(_listen_invalidations())
+
+
+async def teardown_cache():
+    global _listener
+    if not _listener:
+        return
+
+    _listener.cancel()
+    try:
+        await _listener
+    except asyncio.CancelledError:
+        pass  # DO NOTHING.
+    _listener = None
+
+
+async def _listen_invalidations():
+    while True:
+        try:
+            async with async_rds.pubsub() as pubsub:
+                await pubsub.subscribe(_INVALIDATE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    name, digest = message['data'].decode().split(':', 1)
+                    if name in _caches:
+                        _caches[name]._drop(digest)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Clear all in process entries, since some messages may be lost.
+            logger.exception('listen cache invalidations failed, retry later')
+            for cache in _caches.values():
+                cache.clear()
+            await asyncio.sleep(5)
+
+
+@collector('lemonsqueepy_cache_requests_total', 'Cache lookups by cache, tier and result.', 'counter', ('cache', 'tier', 'result'))  # nopep8.
+async def _collect_cache_requests() -> dict:
+    res = {}
+    for name, stats in cache_stats().items():
+        res[(name, 'local', 'hit')] = stats['hits']
+        res[(name, 'local', 'miss')] = stats['misses']
+        res[(name, 'shared', 'hit')] = stats['shared_hits']
+        res[(name, 'shared', 'miss')] = stats['shared_misses']
+    return res
+
+
+@collector('lemonsqueepy_cache_size', 'Entries in the local tier by cache.', 'gauge', ('cache',))  # nopep8.
+async def _collect_cache_size() -> dict:
+    return {(name,): stats['size'] for name, stats in cache_stats().items()}
+
+
+@collector('lemonsqueepy_cache_evictions_total', 'Evicted or invalidated entries by cache and reason.', 'counter', ('cache', 'reason'))  # nopep8.
+async def _collect_cache_evictions() -> dict:
+    res = {}
+    for name, stats in cache_stats().items():
+        res[(name, 'evicted')] = stats['evictions']
+        res[(name, 'invalidated')] = stats['invalidations']
+    return res
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+
+import mongo.licenses as licenses_module
+import mongo.orders as orders_module
+import mongo.subscriptions as subscriptions_module
+
+from logger import logger
+from mongo.archive import setup_archive, \
+    slim_collection, \
+    storage_stats as storage_stats_internal
+from mongo.db import orders, \
+    subscriptions, \
+    subscription_payments, \
+    licenses, \
+    teardown_mongo
+from mongo.licenses import setup_licenses, backfill_latest_licenses
+from mongo.orders import setup_orders, backfill_latest_orders
+from mongo.subscriptions import setup_subscriptions, \
+    setup_subscription_payments, \
+    backfill_latest_subscriptions
+from mongo.users import setup_users
+from webhooks import setup_webhook_events
+
+
+# Create the declared indexes of all collections, and drop the undeclared ones,
+# see `apply_indexes()`; run once when deploying, before starting workers.
+async def apply_indexes():
+    await setup_users()
+    await setup_orders()
+    await setup_licenses()
+    await setup_subscriptions()
+    await setup_subscription_payments()
+    await setup_webhook_events()
+    await setup_archive()
+    logger.info('apply indexes done')
+
+
+# Rebuild the latest states of orders, subscriptions and licenses from history,
+# it's safe to run multiple times, or run when serving.
+async def backfill_latest():
+    await setup_orders()
+    await setup_licenses()
+    await setup_subscriptions()
+
+    count = await backfill_latest_orders()
+    logger.info(f'backfill latest orders, count={count}')
+
+    count = await backfill_latest_subscriptions()
+    logger.info(f'backfill latest subscriptions, count={count}')
+
+    count = await backfill_latest_licenses()
+    logger.info(f'backfill latest licenses, count={count}')
+
+
+async def _run(command):
+    try:
+        await command()
+    finally:
+        await teardown_mongo()
+
+
+# Convert the history collections to the slim storage mode,
+# see mongo/archive.py, set `LEMONSQUEEPY_STORAGE=slim` before or after it.
+async def slim_storage():
+    await setup_archive()
+    for collection, paths in _slim_collections():
+        count = await slim_collection(collection, paths)
+        logger.info(f'slim storage, collection={collection.name}, count={count}')  # nopep8.
+
+
+# Print the sizes and query latency of the history collections,
+# run before and after `slim-storage` to compare.
+async def storage_stats():
+    for collection, indexes in [
+        (orders, orders_module._INDEXES),
+        (subscriptions, subscriptions_module._INDEXES),
+        (subscription_payments, subscriptions_module._PAYMENT_INDEXES),
+        (licenses, licenses_module._INDEXES),
+    ]:
+        stats = await storage_stats_internal(collection, indexes)
+        print(collection.name, json.dumps(stats))
+
+
+def _slim_collections() -> list[tuple]:
+    return [
+        (orders, orders_module._SLIM_PATHS),
+        (subscriptions, subscriptions_module._SLIM_PATHS),
+        (subscription_payments, subscriptions_module._PAYMENT_SLIM_PATHS),
+        (licenses, licenses_module._SLIM_PATHS),
+    ]
+
+
+_COMMANDS = {
+    'apply-indexes': apply_indexes,
+    'backfill-latest': backfill_latest,
+    'slim-storage': slim_storage,
+    'storage-stats': storage_stats,
+}
+
+# Usage: python cli.py COMMAND
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=list(_COMMANDS.keys()))
+    args = parser.parse_args()
+    asyncio.run(_run(_COMMANDS[args.command]))
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import time
+
+from typing import AsyncIterator, Optional
+
+import orjson
+
+from quart import abort
+
+from logger import logger
+from metrics import Counter, collector
+from mongo.entitlements import ENTITLEMENTS_CHANNEL, get_entitlements
+from rds import async_rds
+
+# https://html.spec.whatwg.org/multipage/server-sent-events.html
+#
+# Push the entitlements snapshot (see mongo/entitlements.py) to the clients
+# as soon as a webhook touches the user, instead of polling.
+#
+# `touch_entitlements()` publishes the user id to redis,
+# every worker subscribes once, and wakes up its own connections of the user,
+# which then read the snapshot and push it only if the ETag changed.
+#
+# A connection only holds a flag (not a queue of messages),
+# so bursts of touches are coalesced into one push of the latest snapshot.
+_MAX_CONNECTIONS = int(os.environ.get('LEMONSQUEEPY_EVENTS_MAX_CONNECTIONS', 1000))  # per worker.  # nopep8.
+_MAX_USER_CONNECTIONS = 4  # per worker, e.g. a few tabs.
+
+_HEARTBEAT = 15  # seconds, shorter than nginx `proxy_read_timeout`.
+_LIFETIME = 3600  # seconds, then clients reconnect, so workers are rebalanced.
+_RETRY = 3000  # milliseconds, the reconnection delay of clients.
+
+
+class Subscriber:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.changed = asyncio.Event()
+        self.closed = False
+
+
+# user id -> connections of this worker.
+_subscribers: dict[str, set[Subscriber]] = {}
+_connections = 0
+
+_listener: Optional[asyncio.Task] = None
+
+_rejected = Counter(
+    'lemonsqueepy_events_rejected_total',
+    'Rejected event stream connections by reason.',
+    ('reason',),
+)
+
+_pushed = Counter(
+    'lemonsqueepy_events_pushed_total',
+    'Entitlements snapshots pushed to event stream connections.',
+)
+
+
+async def setup_events():
+    global _listener
+    _listener = asyncio.create_task(_listen_entitlements())
+
+
+async def teardown_events():
+    global _listener
+    for subscribers in _subscribers.values():
+        for subscriber in subscribers:
+            subscriber.closed = True
+            subscriber.changed.set()
+
+    if not _listener:
+        return
+
+    _listener.cancel()
+    try:
+        await _listener
+    except asyncio.CancelledError:
+        pass  # DO NOTHING.
+    _listener = None
+
+
+# Check the limits before responding,
+# so they are reported as HTTP errors instead of a broken stream.
+#
+# The connection is registered when streaming, see `stream_entitlements()`,
+# so it is never leaked if the response is not streamed at all,
+# e.g. the client disconnected before.
+def check_entitlements_limits(user_id: str):
+    reason = _exceeded_limit(user_id)
+    if reason == 'connections':
+        _rejected.inc(reason)
+        abort(503, 'too many event stream connections')
+    if reason == 'user_connections':
+        _rejected.inc(reason)
+        abort(429, f'too many event stream connections, user_id={user_id}')
+
+
+# Push the current snapshot first (skipped if `last_etag` matches,
+# i.e. the `Last-Event-ID` header of reconnecting),
+# then every changed snapshot, as the "entitlements" events:
+#
+#   id: ETAG
+#   event: entitlements
+#   data: {"etag": ETAG, "entitlements": {...}}
+async def stream_entitlements(user_id: str, last_etag: str = '') -> AsyncIterator[bytes]:  # nopep8.
+    subscriber = None
+    try:
+        yield f'retry: {_RETRY}\n\n'.encode()
+
+        # Exceeded by concurrent requests after checked, reconnect later.
+        reason = _exceeded_limit(user_id)
+        if reason:
+            _rejected.inc(reason)
+            return
+
+        subscriber = _subscribe(user_id)
+        deadline = time.monotonic() + _LIFETIME
+        subscriber.changed.set()
+        while time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(subscriber.changed.wait(), _HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b': heartbeat\n\n'
+                continue
+
+            subscriber.changed.clear()
+            if subscriber.closed:
+                break
+
+            snapshot = await get_entitlements(user_id)
+            if snapshot.etag == last_etag:
+                continue
+
+            last_etag = snapshot.etag
+            data = orjson.dumps({'etag': snapshot.etag, 'entitlements': snapshot.entitlements})  # nopep8.
+            yield b'id: %s\nevent: entitlements\ndata: %s\n\n' % (snapshot.etag.encode(), data)  # nopep8.
+            _pushed.inc()
+    finally:
+        if subscriber:
+            _unsubscribe(subscriber)
+
+
+def _exceeded_limit(user_id: str) -> str:
+    if _connections >= _MAX_CONNECTIONS:
+        return 'connections'
+    if len(_subscribers.get(user_id, ())) >= _MAX_USER_CONNECTIONS:
+        return 'user_connections'
+    return ''
+
+
+def _subscribe(user_id: str) -> Subscriber:
+    global _connections
+    subscriber = Subscriber(user_id)
+    _subscribers.setdefault(user_id, set()).add(subscriber)
+    _connections += 1
+    return subscriber
+
+
+def _unsubscribe(subscriber: Subscriber):
+    global _connections
+    subscribers = _subscribers.get(subscriber.user_id)
+    if subscribers is None or subscriber not in subscribers:
+        return
+
+    subscribers.remove(subscriber)
+    if not subscribers:
+        del _subscribers[subscriber.user_id]
+    _connections -= 1
+
+
+def _notify(user_id: str):
+    for subscriber in _subscribers.get(user_id, ()):
+        subscriber.changed.set()
+
+
+async def _listen_entitlements():
+    while True:
+        try:
+            async with async_rds.pubsub() as pubsub:
+                await pubsub.subscribe(ENTITLEMENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    _notify(message['data'].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Wake up all connections to compare the ETags,
+            # since some messages may be lost.
+            logger.exception('listen entitlements failed, retry later')
+            for user_id in list(_subscribers):
+                _notify(user_id)
+            await asyncio.sleep(5)
+
+
+@collector('lemonsqueepy_events_connections', 'Open event stream connections.', 'gauge')  # nopep8.
+async def _collect_connections() -> dict:
+    return {(): _connections}
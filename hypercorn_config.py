@@ -0,0 +1,27 @@
+import os
+
+# https://hypercorn.readthedocs.io/en/latest/how_to_guides/configuring.html
+#
+# Usage: hypercorn --config python:hypercorn_config app:app
+#
+# Every worker is a process with its own event loop, MongoDB and redis clients
+# (created in `before_serving()`), so the throughput scales with CPU cores;
+# in-process caches are per worker, and invalidated across workers by redis.
+# As same as the `proxy_pass` in lemon.mthli.com.conf.
+bind = [os.environ.get('LEMONSQUEEPY_BIND', '127.0.0.1:8000')]
+
+# Set by `LEMONSQUEEPY_WORKERS` in pm2.json when deploying,
+# or one per CPU core by default, e.g. when running locally.
+workers = int(os.environ.get('LEMONSQUEEPY_WORKERS', 0)) or os.cpu_count() or 1
+
+# https://github.com/MagicStack/uvloop
+worker_class = 'uvloop'
+
+backlog = 2048
+keep_alive_timeout = 75  # nopep8; seconds, longer than nginx upstream `keepalive_timeout`.
+graceful_timeout = 4  # seconds, shorter than pm2 `kill_timeout`.
+
+# Restart workers periodically instead of pm2 `max_memory_restart`,
+# which only watches the main process, with jitter to not restart all at once.
+max_requests = 200000
+max_requests_jitter = 20000
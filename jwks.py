@@ -0,0 +1,158 @@
+import asyncio
+import json
+import re
+import time
+
+import httpx
+
+from typing import Optional
+
+from jwt import PyJWK, PyJWKSet
+from jwt.exceptions import PyJWKClientError
+
+from logger import logger
+
+_MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+
+# Async replacement of `jwt.PyJWKClient`, never blocks the event loop.
+#
+# Keys are looked up by `kid` in memory, and refreshed in background
+# before they are expired (honour the `Cache-Control` response header).
+# An unknown `kid` triggers one refetch at most per `min_refetch_interval`,
+# so a bad credential can't make a refetch storm to the upstream.
+#
+# The `uri` can be a `file://` path, or a local server with `transport`,
+# so tests don't need to access the real upstream.
+class JWKSManager:
+    def __init__(
+        self,
+        uri: str,
+        lifespan: int = 86400,  # seconds; if no `Cache-Control` returned.
+        prefetch: int = 300,  # seconds; refresh before expired.
+        min_refetch_interval: int = 60,  # seconds; for unknown `kid`.
+        timeout: int = 10,  # seconds.
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self._uri = uri
+        self._lifespan = lifespan
+        self._prefetch = prefetch
+        self._min_refetch_interval = min_refetch_interval
+        self._timeout = timeout
+        self._transport = transport
+
+        self._keys: dict[str, PyJWK] = {}
+        self._expire_at: float = 0  # monotonic.
+        self._fetch_at: float = 0  # monotonic.
+        self._lock: Optional[asyncio.Lock] = None
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception:
+            # Don't block serving, will retry in background.
+            logger.exception(f'fetch jwks failed, uri={self._uri}')
+        self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if not self._refresher:
+            return
+
+        self._refresher.cancel()
+        try:
+            await self._refresher
+        except asyncio.CancelledError:
+            pass  # DO NOTHING.
+        self._refresher = None
+
+    async def get_signing_key(self, kid: str) -> PyJWK:
+        key = self._keys.get(kid)
+        if key and self._expire_at > time.monotonic():
+            return key
+
+        async with self._get_lock():  # only one refetch at a time.
+            key = self._keys.get(kid)
+            if key and self._expire_at > time.monotonic():
+                return key  # refreshed by others when waiting for lock.
+
+            # Serve the stale keys if refetched recently.
+            if self._fetch_at + self._min_refetch_interval <= time.monotonic():
+                try:
+                    await self.refresh()
+                except Exception:
+                    logger.exception(f'fetch jwks failed, uri={self._uri}')
+
+        key = self._keys.get(kid)
+        if not key:
+            raise PyJWKClientError(f'unable to find a signing key that matches: "{kid}"')  # nopep8.
+
+        return key
+
+    async def refresh(self):
+        self._fetch_at = time.monotonic()
+        data, max_age = await self._fetch()
+
+        keys = {k.key_id: k for k in PyJWKSet.from_dict(data).keys if k.key_id}  # nopep8.
+        if not keys:
+            raise PyJWKClientError(f'no usable signing keys, uri={self._uri}')
+
+        self._keys = keys
+        self._expire_at = self._fetch_at + max_age
+
+    async def _fetch(self) -> tuple[dict, int]:
+        if self._uri.startswith('file://'):
+            path = self._uri[len('file://'):]
+            text = await asyncio.to_thread(_read_text, path)
+            return json.loads(text), self._lifespan
+
+        async with httpx.AsyncClient(transport=self._transport) as client:
+            response = await client.get(
+                url=self._uri,
+                timeout=self._timeout,
+                follow_redirects=True,
+            )
+            response.raise_for_status()
+
+        return response.json(), _parse_max_age(response.headers, self._lifespan)  # nopep8.
+
+    # Create lazily to bind the running event loop.
+    def _get_lock(self) -> asyncio.Lock:
+        if not self._lock:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _refresh_forever(self):
+        while True:
+            delay = self._expire_at - self._prefetch - time.monotonic()
+            await asyncio.sleep(max(delay, self._min_refetch_interval))
+
+            async with self._get_lock():
+                try:
+                    await self.refresh()
+                except Exception:
+                    # Keep the stale keys, retry later.
+                    logger.exception(f'refresh jwks failed, uri={self._uri}')
+
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+def _parse_max_age(headers: httpx.Headers, default: int) -> int:
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+
+    match = _MAX_AGE_PATTERN.search(cache_control)
+    if not match:
+        return default
+
+    try:
+        age = int(headers.get('Age', '0'))
+    except ValueError:
+        age = 0
+
+    return max(int(match.group(1)) - age, 0)
+
+
+def _read_text(path: str) -> str:
+    with open(path) as f:
+        return f.read()
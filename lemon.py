@@ -1,22 +1,38 @@
-import hashlib
-import hmac
-import json
+import time
 
 import httpx
 
+from datetime import datetime, timezone
 from enum import unique
+from typing import Optional
 
 from quart import abort
 from strenum import StrEnum
 from werkzeug.datastructures import Headers
 
-from logger import logger
-from mongo.licenses import insert_license
+from logger import log_body, mask
+from metrics import Counter, Histogram
+from mongo.db import normalize_json
+from mongo.entitlements import touch_entitlements
+from mongo.licenses import insert_license, update_latest_license
 from mongo.orders import insert_order
 from mongo.subscriptions import insert_subscription, insert_subscription_payment
-from rds import get_str_from_rds, \
-    LEMONSQUEEZY_SIGNING_SECRET, \
-    LEMONSQUEEZY_API_KEY
+from ratelimit import RateLimiter, parse_retry_after
+from rds import get_str_from_rds, LEMONSQUEEZY_API_KEY
+from signing import get_signing_keyring
+
+
+_api_seconds = Histogram(
+    'lemonsqueepy_lemonsqueezy_api_duration_seconds',
+    'Lemon Squeezy API latency by endpoint, including failed requests.',
+    ('endpoint',),
+)
+
+_api_responses = Counter(
+    'lemonsqueepy_lemonsqueezy_api_responses_total',
+    'Lemon Squeezy API responses by endpoint and status code (or error).',
+    ('endpoint', 'status'),
+)
 
 
 # https://docs.lemonsqueezy.com/help/webhooks#event-types
@@ -44,12 +60,8 @@ def check_signing_secret(headers: Headers, body: bytes, secret: str = ''):
     if not signature:
         abort(400, f'"X-Signature" not exists')
 
-    secret = secret.strip()
-    if not secret:
-        secret = get_str_from_rds(LEMONSQUEEZY_SIGNING_SECRET)
-
-    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
-    if not hmac.compare_digest(digest, signature):
+    # Webhooks don't carry the key id, try the active key first.
+    if not get_signing_keyring(secret).verify(body, signature):
         abort(400, f'invalid "X-Signature", signature={signature}')
 
 
@@ -79,12 +91,131 @@ async def dispatch_event(event: Event, body: dict):
         abort(400, f'unsupported event, event={str(event)}')
 
 
+# https://www.python-httpx.org/advanced/#pool-limit-configuration
+#
+# Long-lived client shared by all Lemon Squeezy REST calls of current process,
+# reuse keep-alive connections instead of new TCP and TLS handshakes per call.
+# Open it in `before_serving` and close it after serving.
+#
+# Tests can point the `base_url` to a local stub server,
+# or replace the `transport` with `httpx.MockTransport`.
+class LemonSqueezyClient:
+    def __init__(
+        self,
+        base_url: str = 'https://api.lemonsqueezy.com',
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30,  # seconds.
+        http2: bool = False,  # requires `httpx[http2]`.
+        timeout: float = 10,  # seconds; default of all endpoints.
+        timeouts: Optional[dict[str, float]] = None,  # endpoint -> seconds.
+        rate_limiters: Optional[dict[str, RateLimiter]] = None,  # nopep8; endpoint -> limiter.
+        retries: int = 2,  # only for connection errors.
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self._base_url = base_url
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2
+        self._timeout = timeout
+        self._timeouts = timeouts or {}
+        self._rate_limiters = rate_limiters or {}
+        self._retries = retries
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def open(self):
+        if self._client:
+            return
+
+        transport = self._transport or httpx.AsyncHTTPTransport(
+            retries=self._retries,
+            limits=self._limits,
+            http2=self._http2,
+        )
+
+        self._client = httpx.AsyncClient(
+            base_url=self._base_url,
+            transport=transport,
+            timeout=self._timeout,
+            follow_redirects=True,
+        )
+
+    async def close(self):
+        if not self._client:
+            return
+
+        await self._client.aclose()
+        self._client = None
+
+    # The `endpoint` is a short name for looking up timeout and rate limiter,
+    # e.g. "licenses/activate", fallback to the default timeout.
+    async def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: str = '',
+        **kwargs,
+    ) -> httpx.Response:
+        await self.open()  # in case of used outside of serving.
+
+        limiter = self._rate_limiters.get(endpoint)
+        if limiter:
+            await limiter.acquire()
+
+        timeout = self._timeouts.get(endpoint, self._timeout)
+        start = time.perf_counter()
+        try:
+            response = await self._client.request(
+                method=method,
+                url=path,
+                timeout=timeout,
+                **kwargs,
+            )
+        except httpx.HTTPError as e:
+            _api_responses.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            _api_seconds.observe(endpoint, value=time.perf_counter() - start)
+
+        _api_responses.inc(endpoint, str(response.status_code))
+
+        if limiter and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            await limiter.penalize(parse_retry_after(retry_after))
+
+        return response
+
+
+# https://docs.lemonsqueezy.com/api#rate-limiting
+# https://docs.lemonsqueezy.com/help/licensing/license-api#rate-limiting
+_lemonsqueezy = LemonSqueezyClient(
+    timeouts={
+        'licenses/activate': 10,  # seconds.
+        'license-keys': 5,  # seconds.
+    },
+    rate_limiters={
+        'licenses/activate': RateLimiter('license-api', limit=60),
+        'license-keys': RateLimiter('api', limit=300),
+    },
+)
+
+
+async def setup_lemonsqueezy():
+    await _lemonsqueezy.open()
+
+
+async def teardown_lemonsqueezy():
+    await _lemonsqueezy.close()
+
+
 # https://docs.lemonsqueezy.com/help/licensing/license-api#post-v1-licenses-activate
 #
-# FIXME (Matthew Lee)
-# API calls are rate limited to 60 / minute,
-# but the rate limited http code is undocumented,
-# don't know whether it is 429 or not for now until we reach and log it.
+# API calls are rate limited to 60 / minute, shared by all workers,
+# requests over the limit wait for a while instead of failing directly.
 async def activate_license(
     license_key: str,
     instance_name: str,
@@ -103,20 +234,18 @@ async def activate_license(
         'instance_name': instance_name,
     }
 
-    transport = httpx.AsyncHTTPTransport(retries=2)
-    client = httpx.AsyncClient(transport=transport)
-
-    try:
-        # Content-Type must be 'application/x-www-form-urlencoded'.
-        response = await client.post(
-            url='https://api.lemonsqueezy.com/v1/licenses/activate',
-            headers=headers,
-            data=data,
-            timeout=10,
-            follow_redirects=True,
-        )
-    finally:
-        await client.aclose()
+    # Before requesting, so the webhook of this activation is not older,
+    # and in seconds as same as the timestamps from Lemon Squeezy.
+    activated_at = datetime.now(timezone.utc).replace(microsecond=0)
+
+    # Content-Type must be 'application/x-www-form-urlencoded'.
+    response = await _lemonsqueezy.request(
+        method='POST',
+        path='/v1/licenses/activate',
+        endpoint='licenses/activate',
+        headers=headers,
+        data=data,
+    )
 
     # https://docs.lemonsqueezy.com/help/licensing/license-api#errors
     if not response.is_success:
@@ -128,16 +257,27 @@ async def activate_license(
 
     # Automatically .aclose() if the response body is read to completion.
     data: dict = response.json()
-    logger.info(
-        f'activate license, '
-        f'license_key={license_key}, '
-        f'instance_name={instance_name}, '
-        f'body={json.dumps(data)}'
+    log_body(
+        name='activate license',
+        body=response.content,
+        license_key=mask(license_key),
+        instance_name=instance_name,
     )
 
     # The `data` structure is not similar to webhooks request,
-    # so we retrieve license again for later code reusing.
-    return await retrieve_license(str(data['license_key']['id']), api_key)
+    # so we convert it for later code reusing,
+    # only retrieve license again when some fields are missing.
+    license = _convert_activation_to_license(data, activated_at)
+    if not license:
+        license = await retrieve_license(str(data['license_key']['id']), api_key)  # nopep8.
+
+    # Serve the next license check locally, see `update_latest_license()`.
+    normalize_json(license)
+    user_id = await update_latest_license(license)
+    if user_id:
+        await touch_entitlements(user_id)
+
+    return license
 
 
 # https://docs.lemonsqueezy.com/api/license-keys#retrieve-a-license-key
@@ -151,28 +291,73 @@ async def retrieve_license(license_id: str, api_key: str = '') -> dict:
         'Authorization': f'Bearer {api_key}',
     }
 
-    transport = httpx.AsyncHTTPTransport(retries=2)
-    client = httpx.AsyncClient(transport=transport)
-
-    try:
-        response = await client.get(
-            url=f'https://api.lemonsqueezy.com/v1/license-keys/{license_id}',
-            headers=headers,
-            timeout=10,
-            follow_redirects=True,
-        )
-    finally:
-        await client.aclose()
+    response = await _lemonsqueezy.request(
+        method='GET',
+        path=f'/v1/license-keys/{license_id}',
+        endpoint='license-keys',
+        headers=headers,
+    )
 
     if not response.is_success:
         abort(response.status_code, response.text)
 
     # Automatically .aclose() if the response body is read to completion.
     data: dict = response.json()
-    logger.info(
-        f'retrieve license, '
-        f'license_id={license_id}, '
-        f'body={json.dumps(data)}'
-    )
+    log_body(name='retrieve license', body=response.content, license_id=license_id)  # nopep8.
 
     return data
+
+
+# https://docs.lemonsqueezy.com/help/licensing/license-api#post-v1-licenses-activate
+# https://docs.lemonsqueezy.com/api/license-keys#the-license-key-object
+#
+# Build the license document as same as the webhooks request `data`,
+# return None if the activation response doesn't have enough fields.
+#
+# The license object in the response has no `updated_at`,
+# so it is stamped with the `activated_at` (not the instance's `created_at`),
+# then the webhooks of the later changes are newer and replace it.
+def _convert_activation_to_license(
+    activation: dict,
+    activated_at: datetime,
+) -> Optional[dict]:
+    license_key: dict = activation.get('license_key') or {}
+    meta: dict = activation.get('meta') or {}
+
+    required = [
+        license_key.get('id'),
+        license_key.get('status'),
+        license_key.get('key'),
+        license_key.get('activation_usage'),
+        license_key.get('created_at'),
+        license_key.get('test_mode'),
+    ]
+    if any(r is None for r in required) \
+            or 'activation_limit' not in license_key:
+        return None
+
+    key: str = license_key['key']
+    return {
+        'data': {
+            'type': 'license-keys',
+            'id': license_key['id'],
+            'attributes': {
+                'store_id': meta.get('store_id'),
+                'customer_id': meta.get('customer_id'),
+                'order_id': meta.get('order_id'),
+                'order_item_id': meta.get('order_item_id'),
+                'product_id': meta.get('product_id'),
+                'user_name': meta.get('customer_name'),
+                'user_email': meta.get('customer_email'),
+                'key': key,
+                'key_short': f'XXXX-{key[-12:]}',
+                'activation_limit': license_key['activation_limit'],
+                'instances_count': license_key['activation_usage'],
+                'status': license_key['status'],
+                'expires_at': license_key.get('expires_at'),
+                'created_at': license_key['created_at'],
+                'updated_at': license_key.get('updated_at') or activated_at,
+                'test_mode': license_key['test_mode'],
+            },
+        },
+    }
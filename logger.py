@@ -1,10 +1,142 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+
+from typing import Union
+
+import orjson
+
+from metrics import Counter
+
+# https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+#
+# Records are put into a bounded queue without blocking (dropped if full),
+# then formatted and written to stdout by the listener thread,
+# so logging never blocks the event loop.
+#
+# Messages are formatted lazily in the listener thread,
+# so pass immutable arguments, e.g. `logger.info('body=%s', raw_bytes)`.
+_QUEUE_SIZE = 10000
+
+# "json" (default) or "text", e.g. `LEMONSQUEEPY_LOG_FORMAT=text` for local debugging.
+_FORMAT = os.environ.get('LEMONSQUEEPY_LOG_FORMAT', 'json')
+
+# How `log_body()` logs the request and response bodies:
+#
+#   full       log all bodies.
+#   truncated  log all bodies, but only the first `_BODY_LIMIT` characters (default).
+#   sampled    log `_BODY_SAMPLE_RATE` of bodies, and all bodies of errors.
+#   errors     only log bodies of errors.
+_BODY_MODE = os.environ.get('LEMONSQUEEPY_LOG_BODY', 'truncated')
+_BODY_LIMIT = int(os.environ.get('LEMONSQUEEPY_LOG_BODY_LIMIT', 2048))  # nopep8; characters.
+_BODY_SAMPLE_RATE = float(os.environ.get('LEMONSQUEEPY_LOG_BODY_SAMPLE_RATE', 0.01))  # nopep8.
+
+# The JSON string values of these keys are redacted in bodies,
+# e.g. "key" of the license key object, "license_key" of the license API.
+_REDACTED_PATTERN = re.compile(
+    r'"(key|license_key|api_key|secret|token|user_token|credential|password)"(\s*:\s*)"(?:[^"\\]|\\.)*"',  # nopep8.
+)
 
 _fmt = '[%(asctime)s] [%(process)d] [%(levelname)s] [%(module)s] %(message)s'
 _datefmt = '%Y-%m-%d %H:%M:%S %z'
+
+_dropped = Counter(
+    'lemonsqueepy_log_dropped_total',
+    'Log records dropped because the logging queue is full.',
+)
+
+
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}  # nopep8.
+
+
+# Output one JSON object per line, with the `extra` fields.
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record, _datefmt),
+            'pid': record.process,
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        data.update(_get_extra(record))
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
+
+# Append the `extra` fields as ", key=value".
+class _TextFormatter(logging.Formatter):
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        extra = ''.join(f', {k}={v}' for k, v in _get_extra(record).items())
+        return super().formatMessage(record) + extra
+
+
+def _get_extra(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in record.__dict__.items() if k not in _RESERVED_ATTRS}  # nopep8.
+
+
+# The default `prepare()` formats the message in the calling thread,
+# and `enqueue()` raises (then prints to stderr) when the queue is full.
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped.inc()
+
+
+# Redacted and truncated when formatting, in the listener thread.
+class _Body:
+    def __init__(self, body: Union[bytes, str], limit: int):
+        self._body = body
+        self._limit = limit
+
+    def __str__(self) -> str:
+        body = self._body
+        if isinstance(body, bytes):
+            body = body.decode(errors='replace')
+
+        body = _REDACTED_PATTERN.sub(r'"\1"\2"[REDACTED]"', body)
+        if self._limit and len(body) > self._limit:
+            body = f'{body[:self._limit]}...({len(body)} characters)'
+        return body
+
+
+# Log the raw `body` as configured by `_BODY_MODE`, see above.
+def log_body(name: str, body: Union[bytes, str], error: bool = False, **fields):  # nopep8.
+    if _BODY_MODE == 'errors' and not error:
+        return
+    if _BODY_MODE == 'sampled' and not error and random.random() >= _BODY_SAMPLE_RATE:  # nopep8.
+        return
+
+    limit = 0 if _BODY_MODE == 'full' else _BODY_LIMIT
+    logger.info('%s, body=%s', name, _Body(body, limit), extra=fields, stacklevel=2)  # nopep8.
+
+
+# Keep the last 4 characters only, e.g. for license keys.
+def mask(value: str) -> str:
+    return f'****{value[-4:]}' if len(value) > 8 else '****'
+
+
 _handler = logging.StreamHandler()
-_handler.setFormatter(logging.Formatter(fmt=_fmt, datefmt=_datefmt))
+if _FORMAT == 'text':
+    _handler.setFormatter(_TextFormatter(fmt=_fmt, datefmt=_datefmt))
+else:
+    _handler.setFormatter(_JsonFormatter())
+
+_queue: queue.Queue = queue.Queue(maxsize=_QUEUE_SIZE)
+_listener = logging.handlers.QueueListener(_queue, _handler, respect_handler_level=True)  # nopep8.
+_listener.start()
+atexit.register(_listener.stop)  # flush the queue.
 
 logger = logging.getLogger()
-logger.addHandler(_handler)
+logger.addHandler(_QueueHandler(_queue))
 logger.setLevel(logging.INFO)
@@ -0,0 +1,258 @@
+import bisect
+import threading
+
+from typing import Any, Awaitable, Callable, Optional, Union
+
+# A lightweight in-process registry, rendered in the Prometheus text format.
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+#
+# Recording is a dict lookup plus a few additions under an uncontended lock
+# (MongoDB command events are recorded in the motor executor threads),
+# so it is cheap enough to always keep on.
+#
+# Every worker has its own registry, and publishes its snapshot to redis,
+# then the scrape is merged from all workers, see `shared_metrics.py`;
+# counters and histograms are summed, gauges are summed or the max one.
+
+# Seconds, from the fast in-process paths to the slow remote APIs.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+LabelValues = tuple[str, ...]
+
+# Called on every scrape, return the current values by label values,
+# e.g. the stats maintained by other modules.
+CollectFunc = Callable[[], Awaitable[dict[LabelValues, float]]]
+
+# The raw values of all metrics by name, as JSON compatible lists,
+# e.g. {'name': [[['label value'], 1.0]]}, see `snapshot_metrics()`.
+Snapshot = dict[str, list[list]]
+
+_metrics: dict[str, Union['Counter', 'Histogram', 'Gauge', '_Collector']] = {}
+
+
+class Counter:
+    type = 'counter'
+    merge = 'sum'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, *values: str, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def snapshot(self) -> dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, items: dict[LabelValues, float]) -> list[str]:
+        return _render_values(self, items)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        merge: str = 'sum',  # or 'max', e.g. the same shared state.
+    ):
+        self.merge = merge
+        super().__init__(name, help, labels)
+
+    def set(self, *values: str, value: float):
+        with self._lock:
+            self._values[values] = value
+
+
+class Histogram:
+    type = 'histogram'
+    merge = 'sum'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._buckets = buckets
+        # label values -> [count of each bucket (not cumulative), +Inf, sum].
+        self._values: dict[LabelValues, list[float]] = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, *values: str, value: float):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(values)
+            if counts is None:
+                counts = self._values[values] = [0] * (len(self._buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict[LabelValues, list[float]]:
+        with self._lock:
+            return {values: list(counts) for values, counts in self._values.items()}  # nopep8.
+
+    def render(self, items: dict[LabelValues, list[float]]) -> list[str]:
+        lines = _header(self.name, self.help, self.type)
+        for values, counts in sorted(items.items()):
+            cumulative = 0
+            for bucket, count in zip((*self._buckets, '+Inf'), counts):
+                cumulative += count
+                labels = _labels((*self.labels, 'le'), (*values, str(bucket)))
+                lines.append(f'{self.name}_bucket{labels} {_number(cumulative)}')  # nopep8.
+            labels = _labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {_number(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {_number(cumulative)}')
+        return lines
+
+
+class _Collector:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labels: tuple[str, ...],
+        collect: CollectFunc,
+        merge: str,
+    ):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.collect = collect
+        self.merge = merge
+        _register(self)
+
+    async def snapshot(self) -> dict[LabelValues, float]:
+        return await self.collect()
+
+    def render(self, items: dict[LabelValues, float]) -> list[str]:
+        return _render_values(self, items)
+
+
+# Register the decorated function as the values of a metric, e.g.
+#
+#   @collector('lemonsqueepy_cache_size', 'Entries in cache.', 'gauge', ('cache',))
+#   async def _collect_cache_size():
+#       return {(name,): len(cache) for name, cache in _caches.items()}
+def collector(
+    name: str,
+    help: str,
+    type: str,  # 'counter' or 'gauge'.
+    labels: tuple[str, ...] = (),
+    merge: str = 'sum',  # or 'max', e.g. the same shared state.
+) -> Callable[[CollectFunc], CollectFunc]:
+    def decorator(fn: CollectFunc) -> CollectFunc:
+        _Collector(name, help, type, labels, fn, merge)
+        return fn
+    return decorator
+
+
+async def snapshot_metrics() -> Snapshot:
+    res: Snapshot = {}
+    for metric in _metrics.values():
+        if isinstance(metric, _Collector):
+            values = await metric.snapshot()
+        else:
+            values = metric.snapshot()
+        res[metric.name] = [[list(v), value] for v, value in values.items()]
+    return res
+
+
+# Render the merged `snapshots` of workers, or only this worker if None.
+async def render_metrics(snapshots: Optional[list[Snapshot]] = None) -> str:
+    if snapshots is None:
+        snapshots = [await snapshot_metrics()]
+
+    lines: list[str] = []
+    for metric in _metrics.values():
+        lines.extend(metric.render(_merge(metric, snapshots)))
+    return '\n'.join(lines) + '\n'
+
+
+# Merge the `snapshots` of workers into one, only the cumulative metrics
+# (counters and histograms) if `cumulative`, e.g. of the exited workers.
+def merge_snapshots(
+    snapshots: list[Snapshot],
+    cumulative: bool = False,
+) -> Snapshot:
+    res: Snapshot = {}
+    for metric in _metrics.values():
+        if cumulative and metric.type == 'gauge':
+            continue
+        merged = _merge(metric, snapshots)
+        res[metric.name] = [[list(v), value] for v, value in merged.items()]
+    return res
+
+
+def _merge(
+    metric: Union[Counter, Histogram, Gauge, '_Collector'],
+    snapshots: list[Snapshot],
+) -> dict[LabelValues, Any]:
+    res: dict[LabelValues, Any] = {}
+    for snapshot in snapshots:
+        for values, value in snapshot.get(metric.name, []):
+            key = tuple(values)
+            current = res.get(key)
+            if current is None:
+                res[key] = value
+            elif isinstance(value, list):  # histogram.
+                if len(value) == len(current):  # same buckets.
+                    res[key] = [a + b for a, b in zip(current, value)]
+            elif metric.merge == 'max':
+                res[key] = max(current, value)
+            else:
+                res[key] = current + value
+    return res
+
+
+def _render_values(
+    metric: Union[Counter, Gauge, '_Collector'],
+    items: dict[LabelValues, float],
+) -> list[str]:
+    lines = _header(metric.name, metric.help, metric.type)
+    for values, value in sorted(items.items()):
+        lines.append(f'{metric.name}{_labels(metric.labels, values)} {_number(value)}')  # nopep8.
+    return lines
+
+
+def _register(metric: Union[Counter, Histogram, Gauge, _Collector]):
+    if metric.name in _metrics:
+        raise ValueError(f'duplicated metric, name={metric.name}')
+    _metrics[metric.name] = metric
+
+
+def _header(name: str, help: str, type: str) -> list[str]:
+    return [f'# HELP {name} {help}', f'# TYPE {name} {type}']
+
+
+def _labels(names: tuple[str, ...], values: LabelValues) -> str:
+    if not names:
+        return ''
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,163 @@
+import os
+import time
+import zlib
+
+import bson
+
+from typing import Optional, Union
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+
+from mongo.batcher import WriteBatcher
+from mongo.db import IndexSpec, \
+    webhook_archive, \
+    apply_indexes, \
+    get_by_path, \
+    project_document
+
+# The history collections (orders, subscriptions, licenses, etc.) store
+# the whole webhook payloads by default, including `links`, `relationships`, etc.
+#
+# In the slim storage mode (`LEMONSQUEEPY_STORAGE=slim`),
+# they only store the fields for querying, indexing and responding,
+# and the whole payloads go to `webhook_archive` compressed, by the same `_id`.
+#
+# Run `python cli.py slim-storage` to convert the existing documents,
+# it's safe to run multiple times, or run when serving.
+SLIM_STORAGE = os.environ.get('LEMONSQUEEPY_STORAGE', 'full') == 'slim'
+
+_ARCHIVE_INDEXES: list[IndexSpec] = [
+    ([('collection', ASCENDING), ('data_id', ASCENDING)], {}),
+]
+
+# Replace by `_id`, so archiving the same document again is fine.
+_archive_batcher = WriteBatcher(
+    webhook_archive,
+    operation=lambda archive: ReplaceOne({'_id': archive['_id']}, archive, upsert=True),  # nopep8.
+)
+
+
+async def setup_archive():
+    await apply_indexes(webhook_archive, _ARCHIVE_INDEXES)
+
+
+# All paths of the indexes, plus the `extra_paths`.
+def slim_paths(indexes: list[IndexSpec], extra_paths: list[str]) -> list[str]:
+    paths = {path for keys, _ in indexes for path, _ in keys}
+    return sorted(paths | set(extra_paths) | {'meta.event_name', 'data.type', 'data.id'})  # nopep8.
+
+
+# Archive the whole `document` of the `collection`,
+# and return the slim one which only contains the `paths` to store.
+async def archive_document(
+    collection: AsyncIOMotorCollection,
+    document: dict,
+    paths: list[str],
+) -> dict:
+    document.setdefault('_id', ObjectId())
+    await _archive_batcher.write(_build_archive(collection, document))
+
+    slim = project_document(document, paths)
+    slim['_id'] = document['_id']
+    slim['archived'] = True
+    return slim
+
+
+async def load_archived_document(
+    document_id: Union[ObjectId, str],  # str, the webhook event identity.
+) -> Optional[dict]:
+    archive = await webhook_archive.find_one({'_id': document_id})
+    if not archive:
+        return None
+    return bson.decode(zlib.decompress(archive['payload']))
+
+
+# Convert the existing documents of the `collection` in batches,
+# return the number of converted documents.
+async def slim_collection(
+    collection: AsyncIOMotorCollection,
+    paths: list[str],
+    batch_size: int = 500,
+) -> int:
+    count = 0
+    query = {'archived': {'$ne': True}}
+    cursor = collection.find(query, batch_size=batch_size)
+    batch: list[dict] = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            count += await _slim_batch(collection, batch, paths)
+            batch = []
+    if batch:
+        count += await _slim_batch(collection, batch, paths)
+    return count
+
+
+async def _slim_batch(
+    collection: AsyncIOMotorCollection,
+    documents: list[dict],
+    paths: list[str],
+) -> int:
+    # Archive first, the documents are not changed if failed.
+    await webhook_archive.bulk_write([
+        ReplaceOne({'_id': d['_id']}, _build_archive(collection, d), upsert=True)  # nopep8.
+        for d in documents
+    ], ordered=False)
+
+    operations = []
+    for document in documents:
+        slim = project_document(document, paths)
+        slim['_id'] = document['_id']
+        slim['archived'] = True
+        operations.append(ReplaceOne({'_id': document['_id']}, slim))
+    await collection.bulk_write(operations, ordered=False)
+    return len(documents)
+
+
+# The sizes of the `collection` (the working set of querying the history),
+# and the latency of querying the latest document of sampled entities,
+# run before and after `slim_collection()` to compare.
+async def storage_stats(
+    collection: AsyncIOMotorCollection,
+    indexes: list[IndexSpec],
+    samples: int = 100,
+) -> dict:
+    database = collection.database
+    stats: dict = await database.command('collStats', collection.name)
+    res = {
+        'count': stats.get('count', 0),
+        'size': stats.get('size', 0),
+        'avg_obj_size': stats.get('avgObjSize', 0),
+        'storage_size': stats.get('storageSize', 0),
+        'total_index_size': stats.get('totalIndexSize', 0),
+    }
+
+    # Equality on all index fields, except the sort one, by the ESR rule.
+    keys, _ = indexes[0]
+    equality = [
+        path for path, _ in keys if path != 'data.attributes.updated_at'
+    ]
+    latencies: list[float] = []
+    pipeline = [{'$sample': {'size': samples}}]
+    async for document in collection.aggregate(pipeline):
+        query = {path: get_by_path(document, path) for path in equality}
+        start = time.perf_counter()
+        await collection.find(query).sort('data.attributes.updated_at', DESCENDING).limit(1).to_list(1)  # nopep8.
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    for p in [50, 95, 99]:
+        res[f'query_p{p}_ms'] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)] if latencies else 0  # nopep8.
+    return res
+
+
+def _build_archive(collection: AsyncIOMotorCollection, document: dict) -> dict:
+    return {
+        '_id': document['_id'],
+        'collection': collection.name,
+        'data_id': (document.get('data') or {}).get('id'),
+        'payload': bson.Binary(zlib.compress(bson.encode(document))),
+        'create_timestamp': int(time.time()),
+    }
@@ -0,0 +1,123 @@
+import asyncio
+
+from typing import Any, Callable, Optional, Union
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from logger import logger
+
+WriteOperation = Union[InsertOne, ReplaceOne]
+
+# All batchers, for flushing on shutdown.
+_batchers: list['WriteBatcher'] = []
+
+
+# Replace by `_id` if any, e.g. the webhook event identity,
+# so writing the same document again (e.g. retrying) never duplicates it.
+def insert_or_replace(document: dict) -> WriteOperation:
+    if '_id' in document:
+        return ReplaceOne({'_id': document['_id']}, document, upsert=True)
+    return InsertOne(document)
+
+
+# Write-behind batcher of a collection,
+# collects documents for `max_delay` seconds or up to `max_size` documents,
+# then writes them with one unordered `bulk_write()`.
+#
+# The `write()` returns after the document is written (or raises),
+# so callers can still do something after writing, e.g. invalidate cache.
+#
+# Documents of the same entity (`entity_key`) never go into the same batch,
+# and batches are written one by one, so the per-entity order is preserved.
+class WriteBatcher:
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        operation: Callable[[dict], WriteOperation] = insert_or_replace,
+        entity_key: Callable[[dict], Any] = id,  # all documents are different.
+        ignored_codes: frozenset[int] = frozenset(),  # e.g. duplicate key.
+        max_size: int = 100,
+        max_delay: float = 0.005,  # seconds.
+    ):
+        self._collection = collection
+        self._operation = operation
+        self._entity_key = entity_key
+        self._ignored_codes = ignored_codes
+        self._max_size = max_size
+        self._max_delay = max_delay
+
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._flushers: set[asyncio.Task] = set()  # keep references.
+        self._lock: Optional[asyncio.Lock] = None  # create lazily.
+
+        _batchers.append(self)
+
+    async def write(self, document: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((document, future))
+
+        if not self._flusher or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+        elif len(self._pending) >= self._max_size:
+            flusher = asyncio.create_task(self.flush())
+            self._flushers.add(flusher)
+            flusher.add_done_callback(self._flushers.discard)
+
+        await future
+
+    async def flush(self):
+        if not self._lock:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:  # write batches one by one.
+            while self._pending:
+                await self._write_batch(self._take_batch())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._max_delay)
+        await self.flush()
+
+    def _take_batch(self) -> list[tuple[dict, asyncio.Future]]:
+        batch: list[tuple[dict, asyncio.Future]] = []
+        keys = set()
+
+        for document, future in self._pending:
+            key = self._entity_key(document)
+            if key in keys or len(batch) >= self._max_size:
+                break  # the later one goes to the next batch.
+            keys.add(key)
+            batch.append((document, future))
+
+        del self._pending[:len(batch)]
+        return batch
+
+    async def _write_batch(self, batch: list[tuple[dict, asyncio.Future]]):
+        errors: dict[int, Exception] = {}
+        try:
+            await self._collection.bulk_write(
+                [self._operation(document) for document, _ in batch],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') not in self._ignored_codes:
+                    errors[error['index']] = BulkWriteError({'writeErrors': [error]})  # nopep8.
+        except Exception as e:
+            logger.exception(f'bulk write failed, collection={self._collection.name}')  # nopep8.
+            errors = {i: e for i in range(len(batch))}
+
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue  # cancelled by the caller.
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(None)
+
+
+async def flush_batchers():
+    for batcher in _batchers:
+        await batcher.flush()
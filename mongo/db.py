@@ -1,18 +1,273 @@
+import re
+
 from datetime import datetime
-from typing import Any, Union
+from typing import Any, Optional, Sequence, Union
 
 from dateutil import parser
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import ReplaceOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from logger import logger
+from metrics import Histogram
 
 # Default host and port.
-_client = AsyncIOMotorClient('localhost', 27017)
-_db = _client['lemonsqueezy']  # database.
+_HOST = 'localhost'
+_PORT = 27017
+_DATABASE = 'lemonsqueezy'
+
+# The client (and its connection pool and monitor threads) is created per worker
+# in `setup_mongo()`, or lazily on first use, e.g. by scripts and tests,
+# so nothing is created at import time, before hypercorn spawns the workers.
+_client: Optional[AsyncIOMotorClient] = None
+
+
+_command_seconds = Histogram(
+    'lemonsqueepy_mongo_command_duration_seconds',
+    'MongoDB command latency by command and collection.',
+    ('command', 'collection'),
+)
+
+
+# https://pymongo.readthedocs.io/en/stable/api/pymongo/monitoring.html
+#
+# The collection tells the caller, e.g. "find" on "latest_orders"
+# is `find_latest_order()` or `find_latest_orders()`.
+class _CommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._collections: dict[tuple, str] = {}  # nopep8; (connection, request) -> name.
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        if isinstance(collection, str):
+            self._collections[(event.connection_id, event.request_id)] = collection  # nopep8.
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._observe(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._observe(event)
+
+    def _observe(self, event: Union[monitoring.CommandSucceededEvent, monitoring.CommandFailedEvent]):  # nopep8.
+        collection = self._collections.pop((event.connection_id, event.request_id), '')  # nopep8.
+        _command_seconds.observe(event.command_name, collection, value=event.duration_micros / 1e6)  # nopep8.
+
+
+def _get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(_HOST, _PORT, event_listeners=[_CommandListener()])  # nopep8.
+    return _client
+
+
+async def setup_mongo():
+    _get_client()
+
+
+async def teardown_mongo():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+# Resolve the collection of current client on access,
+# so modules can still import collections at import time.
+class _Collection:
+    def __init__(self, name: str):
+        self._name = name
+        self._client: Optional[AsyncIOMotorClient] = None
+        self._collection: Optional[AsyncIOMotorCollection] = None
+
+    def __getattr__(self, attr: str) -> Any:
+        client = _get_client()
+        if self._client is not client:
+            self._client = client
+            self._collection = client[_DATABASE][self._name]
+        return getattr(self._collection, attr)
+
+
+users = _Collection('users')  # collection.
+orders = _Collection('orders')  # collection.
+licenses = _Collection('licenses')  # collection.
+subscriptions = _Collection('subscriptions')  # collection.
+subscription_payments = _Collection('subscription_payments')  # collection.
+
+# The latest state of each order, subscription and license,
+# maintained on webhooks insertion, for checking with a single point lookup.
+latest_orders = _Collection('latest_orders')  # collection.
+latest_licenses = _Collection('latest_licenses')  # collection.
+latest_subscriptions = _Collection('latest_subscriptions')  # collection.
+
+# The identities of dispatched webhooks, for dropping the duplicates.
+webhook_events = _Collection('webhook_events')  # collection.
+
+# The compressed whole webhook payloads in the slim storage mode, see mongo/archive.py.
+webhook_archive = _Collection('webhook_archive')  # collection.
+
+# The webhooks failed to process after retrying, for manual investigation.
+webhook_dead_letters = _Collection('webhook_dead_letters')  # collection.
+
+# The index names applied by `apply_indexes()`, by collection name.
+applied_indexes = _Collection('applied_indexes')  # collection.
+
+# "YYYY-MM-DDTHH:MM:SS[.fff|.ffffff](Z|±HH:MM)" only.
+_ISO8601_PATTERN = re.compile(
+    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}'
+    r'(\.\d{3}|\.\d{6})?(Z|[+-]\d{2}:\d{2})',
+)
+
+# https://www.mongodb.com/docs/manual/reference/error-codes/
+DUPLICATE_KEY_ERROR = 11000
+INDEX_NOT_FOUND_ERROR = 27
+
+# As same as the arguments of `create_index()`, e.g.
+# ([('data.attributes.store_id', ASCENDING)], {'unique': True}).
+IndexSpec = tuple[list[tuple[str, int]], dict]
+
+
+# MongoDB does not recreate the index if it already exists.
+# https://www.mongodb.com/community/forums/t/behavior-of-createindex-for-an-existing-index/2248/2
+#
+# Create all declared indexes of the collection,
+# and drop the ones applied before (or `legacy`) which are not declared anymore,
+# since every index costs a write on every insertion;
+# the indexes added by operators are never dropped.
+#
+# Run by `python cli.py apply-indexes` when deploying, instead of by workers.
+async def apply_indexes(
+    collection: AsyncIOMotorCollection,
+    specs: list[IndexSpec],
+    legacy: Sequence[str] = (),
+):
+    declared: set[str] = set()
+    for keys, options in specs:
+        name = await collection.create_index(keys, background=True, **options)
+        declared.add(name)
+
+    applied: dict = await applied_indexes.find_one({'_id': collection.name}) or {}  # nopep8.
+    undeclared = (set(applied.get('names', [])) | set(legacy)) - declared
+    for name in sorted(undeclared):
+        try:
+            await collection.drop_index(name)
+            logger.info(f'drop undeclared index, collection={collection.name}, index={name}')  # nopep8.
+        except OperationFailure as e:
+            if e.code != INDEX_NOT_FOUND_ERROR:  # dropped already.
+                raise
+
+    await applied_indexes.replace_one(
+        {'_id': collection.name},
+        {'names': sorted(declared)},
+        upsert=True,
+    )
+
+
+# Copy the dotted `paths` from `document` to a new compact document,
+# e.g. 'data.attributes.status' -> {'data': {'attributes': {'status': ...}}}.
+def project_document(document: dict, paths: list[str]) -> dict:
+    res: dict = {}
+    for path in paths:
+        keys = path.split('.')
+
+        target = res
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = get_by_path(document, path)
+
+    return res
+
+
+# Get the dotted `path` value from `document`, None if not exists.
+def get_by_path(document: dict, path: str) -> Any:
+    value: Any = document
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+# Replace the latest state matched by the unique index `keys`,
+# only if the `latest` document is not older than the stored one,
+# otherwise the upsert raises a duplicate key error, just ignore it.
+def latest_operation(keys: list[tuple[str, int]], latest: dict) -> ReplaceOne:
+    query = {path: get_by_path(latest, path) for path, _ in keys}
+    updated_at = latest['data']['attributes'].get('updated_at')
+    if updated_at is not None:
+        query['data.attributes.updated_at'] = {'$lte': updated_at}
+
+    return ReplaceOne(query, latest, upsert=True)
+
+
+async def upsert_latest(
+    collection: AsyncIOMotorCollection,
+    keys: list[tuple[str, int]],
+    latest: dict,
+):
+    try:
+        await collection.bulk_write([latest_operation(keys, latest)])
+    except BulkWriteError as e:
+        codes = {err.get('code') for err in e.details.get('writeErrors', [])}
+        if codes != {DUPLICATE_KEY_ERROR}:
+            raise
+
+
+# The unique indexes are for correctness instead of performance,
+# e.g. an older latest state is dropped by the duplicate key error,
+# see `latest_operation()`, so workers ensure them before serving
+# even if `python cli.py apply-indexes` was not run; it's cheap
+# since MongoDB does not recreate the index if it already exists.
+async def ensure_unique_indexes(
+    collection: AsyncIOMotorCollection,
+    specs: list[IndexSpec],
+):
+    for keys, options in specs:
+        if options.get('unique'):
+            await collection.create_index(keys, background=True, **options)
+
 
-users = _db['users']  # collection.
-orders = _db['orders']  # collection.
-licenses = _db['licenses']  # collection.
-subscriptions = _db['subscriptions']  # collection.
-subscription_payments = _db['subscription_payments']  # collection.
+# https://www.mongodb.com/docs/manual/reference/explain-results/
+#
+# Warn if the query is not covered by an index scan,
+# or has to sort in memory (the `SORT` stage).
+async def check_query_plan(
+    collection: AsyncIOMotorCollection,
+    query: dict,
+    sort: Optional[list[tuple[str, int]]] = None,
+):
+    cursor = collection.find(query).limit(1)
+    if sort:
+        cursor = cursor.sort(sort)
+
+    try:
+        explain: dict = await cursor.explain()
+    except Exception:
+        logger.exception(f'explain query failed, collection={collection.name}')
+        return
+
+    plan: dict = explain.get('queryPlanner', {}).get('winningPlan', {})
+
+    stages = set(_collect_stages(plan))
+    if stages <= {'EOF'}:
+        return  # collection not exists yet.
+
+    if 'IXSCAN' not in stages or 'SORT' in stages:
+        logger.warning(
+            f'query is not covered by index, '
+            f'collection={collection.name}, '
+            f'query={list(query.keys())}, '
+            f'stages={sorted(stages)}'
+        )
+
+
+def _collect_stages(plan: Any):
+    if isinstance(plan, list):
+        for item in plan:
+            yield from _collect_stages(item)
+    elif isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            if isinstance(value, (dict, list)):
+                yield from _collect_stages(value)
 
 
 # https://lemonsqueezy.nolt.io/234
@@ -53,10 +308,64 @@ def convert_at_to_datetime_in_json(data: Any):
             if not isinstance(value, str) or not key.endswith('_at'):
                 convert_at_to_datetime_in_json(value)
                 continue
-            try:
-                data[key] = parser.isoparse(value)
-            except Exception:
-                pass  # DO NOTHING.
+            dt = parse_iso8601(value)
+            if dt:
+                data[key] = dt
+
+
+# As same as `convert_id_to_str_in_json()` then `convert_at_to_datetime_in_json()`,
+# but walks all nodes only once without recursion.
+def normalize_json(data: Any):
+    memo: dict[str, Optional[datetime]] = {}  # same timestamps in payload.
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+
+        for key, value in node.items():
+            if not isinstance(key, str):
+                raise TypeError(f'key must be string instead of {type(key)}')
+            if isinstance(value, (dict, list)):
+                stack.append(value)
+            elif isinstance(value, int):
+                if key == 'id' or key.endswith('_id'):
+                    node[key] = str(value)
+            elif isinstance(value, str) and key.endswith('_at'):
+                dt = parse_iso8601(value, memo)
+                if dt:
+                    node[key] = dt
+
+
+# Lemon Squeezy always sends the date-time as "2023-01-17T12:26:23.000000Z",
+# which can be parsed by `datetime.fromisoformat()` much faster than dateutil,
+# and fallback to dateutil only for the unusual formats look like date-time,
+# return None if it is not a date-time, without raising exceptions.
+def parse_iso8601(
+    value: str,
+    memo: Optional[dict[str, Optional[datetime]]] = None,
+) -> Optional[datetime]:
+    if memo is not None and value in memo:
+        return memo[value]
+
+    dt: Optional[datetime] = None
+    try:
+        if _ISO8601_PATTERN.fullmatch(value):
+            # The "Z" suffix is unsupported before Python 3.11.
+            text = value[:-1] + '+00:00' if value.endswith('Z') else value
+            dt = datetime.fromisoformat(text)
+        elif value[:4].isdigit():
+            dt = parser.isoparse(value)
+    except ValueError:
+        pass  # DO NOTHING.
+
+    if memo is not None:
+        memo[value] = dt
+
+    return dt
 
 
 # https://stackoverflow.com/a/42777551
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+
+from dataclasses import dataclass
+
+import orjson
+import redis
+
+from logger import logger
+from mongo.db import latest_orders, \
+    latest_subscriptions, \
+    latest_licenses, \
+    get_by_path
+from mongo.licenses import convert_license_to_response
+from mongo.orders import convert_order_to_response
+from mongo.subscriptions import convert_subscription_to_response
+from rds import async_rds
+
+# The snapshot of all orders, subscriptions and licenses of a user,
+# recomputed only when a webhook touches the user,
+# so polling clients only compare the ETag most of the time.
+#
+# The version is increased on every touch, and the snapshot is valid
+# only if it is computed at the current version, so an outdated recomputing
+# never overrides the newer one.
+_VERSION_KEY = 'lemonsqueepy:entitlements:version:{}'
+_SNAPSHOT_KEY = 'lemonsqueepy:entitlements:snapshot:{}'
+_SNAPSHOT_TTL = 86400  # seconds, recomputed on demand after expired.
+
+# The user id is published after the snapshot is stored, see events.py.
+ENTITLEMENTS_CHANNEL = 'lemonsqueepy:entitlements:changed'
+
+_ORDER_KEY_PATHS = [
+    'data.attributes.store_id',
+    'data.attributes.first_order_item.product_id',
+    'data.attributes.first_order_item.variant_id',
+    'data.attributes.test_mode',
+]
+
+_SUBSCRIPTION_KEY_PATHS = [
+    'data.attributes.store_id',
+    'data.attributes.product_id',
+    'data.attributes.variant_id',
+    'data.attributes.test_mode',
+]
+
+_LICENSE_KEY_PATHS = [
+    'data.attributes.key',
+    'data.attributes.test_mode',
+]
+
+
+@dataclass
+class Snapshot:
+    version: int
+    etag: str  # the digest of `entitlements`.
+    entitlements: dict  # as same as `/api/entitlements/check`.
+
+
+# The key of an item in `/api/entitlements/check` and the snapshot, e.g.
+# "order:STORE_ID:PRODUCT_ID:VARIANT_ID:TEST_MODE" or "license:LICENSE_KEY:TEST_MODE".
+def entitlement_key(kind: str, item: tuple) -> str:
+    return ':'.join([kind, *(json.dumps(v) if isinstance(v, bool) else str(v) for v in item)])  # nopep8.
+
+
+# Called after a webhook of the user has been dispatched.
+async def touch_entitlements(user_id: str):
+    try:
+        version = await async_rds.incr(_VERSION_KEY.format(user_id))
+        snapshot = await _compute_snapshot(user_id, version)
+        await _store_snapshot(user_id, snapshot)
+        await async_rds.publish(ENTITLEMENTS_CHANNEL, user_id)
+    except redis.RedisError:
+        logger.exception(f'touch entitlements failed, user_id={user_id}')
+
+
+async def get_entitlements(user_id: str) -> Snapshot:
+    try:
+        version, snapshot = await async_rds.mget(
+            _VERSION_KEY.format(user_id),
+            _SNAPSHOT_KEY.format(user_id),
+        )
+    except redis.RedisError:
+        logger.exception(f'get entitlements failed, user_id={user_id}')
+        return await _compute_snapshot(user_id, 0)  # not stored.
+
+    version = int(version or 0)
+    if snapshot:
+        res = Snapshot(**orjson.loads(snapshot))
+        if res.version == version:
+            return res
+
+    res = await _compute_snapshot(user_id, version)
+    try:
+        await _store_snapshot(user_id, res)
+    except redis.RedisError:
+        logger.exception(f'store entitlements failed, user_id={user_id}')
+    return res
+
+
+async def _compute_snapshot(user_id: str, version: int) -> Snapshot:
+    query = {'meta.custom_data.user_id': user_id}
+    found_orders, found_subscriptions, found_licenses = await asyncio.gather(
+        latest_orders.find(query).to_list(None),
+        latest_subscriptions.find(query).to_list(None),
+        latest_licenses.find(query).to_list(None),
+    )
+
+    entitlements = {}
+    for order in found_orders:
+        key = entitlement_key('order', _get_by_paths(order, _ORDER_KEY_PATHS))
+        entitlements[key] = convert_order_to_response(order)
+    for subscription in found_subscriptions:
+        key = entitlement_key('subscription', _get_by_paths(subscription, _SUBSCRIPTION_KEY_PATHS))  # nopep8.
+        entitlements[key] = convert_subscription_to_response(subscription)
+    for license in found_licenses:
+        key = entitlement_key('license', _get_by_paths(license, _LICENSE_KEY_PATHS))  # nopep8.
+        entitlements[key] = convert_license_to_response(license)
+
+    data = orjson.dumps(entitlements, option=orjson.OPT_SORT_KEYS)
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    return Snapshot(version=version, etag=etag, entitlements=entitlements)
+
+
+async def _store_snapshot(user_id: str, snapshot: Snapshot):
+    data = orjson.dumps({
+        'version': snapshot.version,
+        'etag': snapshot.etag,
+        'entitlements': snapshot.entitlements,
+    })
+    await async_rds.set(_SNAPSHOT_KEY.format(user_id), data, ex=_SNAPSHOT_TTL)
+
+
+def _get_by_paths(document: dict, paths: list[str]) -> tuple:
+    return tuple(get_by_path(document, path) for path in paths)
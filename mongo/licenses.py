@@ -1,10 +1,25 @@
 from enum import unique
 from typing import Optional
 
-from async_lru import alru_cache
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from strenum import StrEnum
 
-from mongo.db import licenses, convert_datetime_to_isoformat_with_z
+from cache import keyed_cache
+from mongo.archive import SLIM_STORAGE, archive_document, slim_paths
+from mongo.batcher import WriteBatcher
+from mongo.db import DUPLICATE_KEY_ERROR, \
+    IndexSpec, \
+    licenses, \
+    latest_licenses, \
+    apply_indexes, \
+    check_query_plan, \
+    ensure_unique_indexes, \
+    get_by_path, \
+    latest_operation, \
+    project_document, \
+    upsert_latest, \
+    convert_datetime_to_isoformat_with_z
 
 
 @unique
@@ -15,24 +30,104 @@ class Status(StrEnum):
     DISABLED = 'disabled'
 
 
+# https://www.mongodb.com/docs/manual/tutorial/equality-sort-range-rule/
+#
+# The compound index covers querying the latest license in history by ESR rule,
+# equality fields first, then the sort field;
+# other single field indexes are covered by its prefix, or never queried.
+_INDEXES: list[IndexSpec] = [
+    ([
+        ('data.attributes.key', ASCENDING),          # str.
+        ('data.attributes.test_mode', ASCENDING),    # bool.
+        ('data.attributes.updated_at', DESCENDING),  # datetime.
+    ], {}),
+    ([('data.id', ASCENDING)], {}),                    # nopep8; str, as the `license_id`.
+    ([('data.attributes.user_email', ASCENDING)], {}),  # str.
+]
+
+# The single field indexes created by the older versions (before tracked),
+# dropped by `apply_indexes()` if not declared above.
+_LEGACY_INDEXES: list[str] = [f'{path}_1' for path in [
+    'meta.event_name',
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.customer_id',
+    'data.attributes.order_id',
+    'data.attributes.order_item_id',
+    'data.attributes.product_id',
+    'data.attributes.user_email',
+    'data.attributes.key',
+    'data.attributes.key_short',
+    'data.attributes.status',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]]
+
+# One document per license, see `upsert_latest()`,
+# and the user's licenses for the entitlements snapshot.
+_LATEST_INDEXES: list[IndexSpec] = [
+    ([
+        ('data.attributes.key', ASCENDING),        # str.
+        ('data.attributes.test_mode', ASCENDING),  # bool.
+    ], {'unique': True}),
+    ([('meta.custom_data.user_id', ASCENDING)], {}),  # str.
+]
+
+# Only the fields for querying and `convert_license_to_response()`.
+_LATEST_PATHS = [
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.product_id',
+    'data.attributes.key',
+    'data.attributes.test_mode',
+    'data.attributes.status',
+    'data.attributes.activation_limit',
+    'data.attributes.instances_count',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]
+
+# Only the fields for querying, indexing and responding in the slim storage mode.
+_SLIM_PATHS = slim_paths(_INDEXES, _LATEST_PATHS)
+
+_LATEST_SORT = [('data.attributes.updated_at', DESCENDING)]
+
+
+# The arguments of `find_latest_license()`, as same order as `_LATEST_INDEXES[0]`.
+def _entity_key(license: dict) -> tuple:
+    keys, _ = _LATEST_INDEXES[0]
+    return tuple(get_by_path(license, path) for path, _ in keys)
+
+
+_batcher = WriteBatcher(licenses, entity_key=_entity_key)
+_latest_batcher = WriteBatcher(
+    latest_licenses,
+    operation=lambda latest: latest_operation(_LATEST_INDEXES[0][0], latest),
+    entity_key=_entity_key,
+    ignored_codes=frozenset({DUPLICATE_KEY_ERROR}),  # not newer.
+)
+
+
 async def setup_licenses():
-    await licenses.create_index('meta.event_name', background=True)                # nopep8; str.
-    await licenses.create_index('meta.custom_data.user_id', background=True)       # nopep8; str.
+    await apply_indexes(licenses, _INDEXES, _LEGACY_INDEXES)
+    await apply_indexes(latest_licenses, _LATEST_INDEXES)
 
-    await licenses.create_index('data.id', background=True)                        # nopep8; str, as the `license_id`.
-    await licenses.create_index('data.attributes.store_id', background=True)       # nopep8; str.
-    await licenses.create_index('data.attributes.customer_id', background=True)    # nopep8; str.
-    await licenses.create_index('data.attributes.order_id', background=True)       # nopep8; str.
-    await licenses.create_index('data.attributes.order_item_id', background=True)  # nopep8; str.
-    await licenses.create_index('data.attributes.product_id', background=True)     # nopep8; str.
 
-    await licenses.create_index('data.attributes.user_email', background=True)     # nopep8; str.
-    await licenses.create_index('data.attributes.key', background=True)            # nopep8; str.
-    await licenses.create_index('data.attributes.key_short', background=True)      # nopep8; str.
-    await licenses.create_index('data.attributes.status', background=True)         # nopep8; str.
+async def check_licenses():
+    await ensure_unique_indexes(latest_licenses, _LATEST_INDEXES)
+    await check_query_plan(licenses, _latest_license_query(''), _LATEST_SORT)
+    await check_query_plan(latest_licenses, _latest_license_query(''))
 
-    await licenses.create_index('data.attributes.created_at', background=True)     # nopep8; datetime.
-    await licenses.create_index('data.attributes.updated_at', background=True)     # nopep8; datetime.
+
+# Rebuild the latest states from history, return the number of licenses.
+async def backfill_latest_licenses() -> int:
+    count = 0
+    async for license in licenses.find({}):
+        await _upsert_latest_license(license)
+        count += 1
+    return count
 
 
 # https://docs.lemonsqueezy.com/api/license-keys#the-license-key-object
@@ -41,30 +136,91 @@ async def setup_licenses():
 # You will notice that the `data` in the payload is the order object,
 # plus some `meta` and the usual `relationships` and `links`.
 async def insert_license(license: dict):
-    await licenses.insert_one(license)
-    find_latest_license.cache_clear()
+    if SLIM_STORAGE:
+        slim = await archive_document(licenses, license, _SLIM_PATHS)
+        await _batcher.write(slim)
+    else:
+        await _batcher.write(license)
+    await _latest_batcher.write(project_document(license, _LATEST_PATHS))
+
+    # Only invalidate the cache of this license.
+    await find_latest_license.invalidate(*_entity_key(license))
+
+
+# The license object from the API (e.g. activating), instead of webhooks,
+# is not in the history, and only updates the `data` of the latest state
+# if not older, so the `meta` from webhooks (e.g. the user id) is kept;
+# marked as `synthetic` until replaced by the next webhook which is newer.
+#
+# The fields missing in the API response (None) are only set on inserting,
+# instead of overwriting the ones from webhooks.
+#
+# Return the user id of the latest state, if any.
+async def update_latest_license(license: dict) -> Optional[str]:
+    keys, _ = _LATEST_INDEXES[0]
+    query = {path: get_by_path(license, path) for path, _ in keys}
+    query['data.attributes.updated_at'] = {'$lte': get_by_path(license, 'data.attributes.updated_at')}  # nopep8.
+
+    fields = {path: get_by_path(license, path) for path in _LATEST_PATHS if path.startswith('data.')}  # nopep8.
+    update: dict = {
+        '$set': {p: v for p, v in fields.items() if v is not None},
+        '$setOnInsert': {p: v for p, v in fields.items() if v is None},
+    }
+    update['$set']['synthetic'] = True
+    if not update['$setOnInsert']:
+        del update['$setOnInsert']  # empty is invalid.
+    try:
+        latest = await latest_licenses.find_one_and_update(
+            query,
+            update,
+            projection={'meta.custom_data.user_id': True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        return None  # not newer.
+    finally:
+        await find_latest_license.invalidate(*_entity_key(license))
+
+    return get_by_path(latest or {}, 'meta.custom_data.user_id')
+
+
+async def _upsert_latest_license(license: dict):
+    latest = project_document(license, _LATEST_PATHS)
+    keys, _ = _LATEST_INDEXES[0]
+    await upsert_latest(latest_licenses, keys, latest)
 
 
 # Based on the upper API specs, the `license_key` is unique in all stores.
 # https://docs.lemonsqueezy.com/api/license-keys#retrieve-a-license-key
-@alru_cache(ttl=10)
+#
+# Run `python cli.py backfill-latest` once after upgrading,
+# to build the latest states from history.
+@keyed_cache(name='find_latest_license', ttl=60, shared_ttl=600)
 async def find_latest_license(
     license_key: str,
     test_mode: bool = False,
 ) -> Optional[dict]:
-    cursor = licenses \
-        .find({
-            'data.attributes.key': license_key,
-            'data.attributes.test_mode': test_mode,
-        }) \
-        .sort('data.attributes.updated_at', -1) \
-        .limit(1)
-
-    res: list[dict] = []
-    async for order in cursor:
-        res.append(order)
-
-    return res[0] if res else None
+    query = _latest_license_query(license_key, test_mode)
+    return await latest_licenses.find_one(query)
+
+
+# Batch version of `find_latest_license()` with one `$or` query,
+# the `items` are the (license_key, test_mode) tuples,
+# return the found licenses by `_entity_key()`.
+async def find_latest_licenses(items: list[tuple[str, bool]]) -> dict[tuple, dict]:  # nopep8.
+    if not items:
+        return {}
+
+    query = {'$or': [_latest_license_query(*item) for item in items]}
+    return {_entity_key(license): license async for license in latest_licenses.find(query)}  # nopep8.
+
+
+def _latest_license_query(license_key: str, test_mode: bool = False) -> dict:
+    return {
+        'data.attributes.key': license_key,
+        'data.attributes.test_mode': test_mode,
+    }
 
 
 def convert_license_to_response(license: dict) -> dict:
@@ -1,10 +1,24 @@
 from enum import unique
 from typing import Optional
 
-from async_lru import alru_cache
+from pymongo import ASCENDING, DESCENDING
 from strenum import StrEnum
 
-from mongo.db import orders, convert_datetime_to_isoformat_with_z
+from cache import keyed_cache
+from mongo.archive import SLIM_STORAGE, archive_document, slim_paths
+from mongo.batcher import WriteBatcher
+from mongo.db import DUPLICATE_KEY_ERROR, \
+    IndexSpec, \
+    orders, \
+    latest_orders, \
+    apply_indexes, \
+    check_query_plan, \
+    ensure_unique_indexes, \
+    get_by_path, \
+    latest_operation, \
+    project_document, \
+    upsert_latest, \
+    convert_datetime_to_isoformat_with_z
 
 
 @unique
@@ -15,25 +29,106 @@ class Status(StrEnum):
     REFUNDED = 'refunded'
 
 
+# https://www.mongodb.com/docs/manual/tutorial/equality-sort-range-rule/
+#
+# The compound index covers querying the latest order in history by ESR rule,
+# equality fields first, then the sort field;
+# other single field indexes are covered by its prefix, or never queried.
+_INDEXES: list[IndexSpec] = [
+    ([
+        ('meta.custom_data.user_id', ASCENDING),                     # str.
+        ('data.attributes.store_id', ASCENDING),                     # str.
+        ('data.attributes.first_order_item.product_id', ASCENDING),  # str.
+        ('data.attributes.first_order_item.variant_id', ASCENDING),  # str.
+        ('data.attributes.test_mode', ASCENDING),                    # bool.
+        ('data.attributes.updated_at', DESCENDING),                  # nopep8; datetime.
+    ], {}),
+    ([('data.id', ASCENDING)], {}),                    # nopep8; str, as the `order_id`.
+    ([('data.attributes.user_email', ASCENDING)], {}),  # str.
+]
+
+# The single field indexes created by the older versions (before tracked),
+# dropped by `apply_indexes()` if not declared above.
+_LEGACY_INDEXES: list[str] = [f'{path}_1' for path in [
+    'meta.event_name',
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.customer_id',
+    'data.attributes.identifier',
+    'data.attributes.user_email',
+    'data.attributes.status',
+    'data.attributes.first_order_item.id',
+    'data.attributes.first_order_item.order_id',
+    'data.attributes.first_order_item.product_id',
+    'data.attributes.first_order_item.variant_id',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]]
+
+# One document per order, see `upsert_latest()`.
+_LATEST_INDEXES: list[IndexSpec] = [
+    ([
+        ('meta.custom_data.user_id', ASCENDING),                     # str.
+        ('data.attributes.store_id', ASCENDING),                     # str.
+        ('data.attributes.first_order_item.product_id', ASCENDING),  # str.
+        ('data.attributes.first_order_item.variant_id', ASCENDING),  # str.
+        ('data.attributes.test_mode', ASCENDING),                    # bool.
+    ], {'unique': True}),
+]
+
+# Only the fields for querying and `convert_order_to_response()`.
+_LATEST_PATHS = [
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.first_order_item.product_id',
+    'data.attributes.first_order_item.variant_id',
+    'data.attributes.test_mode',
+    'data.attributes.status',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]
+
+# Only the fields for querying, indexing and responding in the slim storage mode.
+_SLIM_PATHS = slim_paths(_INDEXES, _LATEST_PATHS)
+
+_LATEST_SORT = [('data.attributes.updated_at', DESCENDING)]
+
+
+# The arguments of `find_latest_order()`, as same order as `_LATEST_INDEXES[0]`.
+def _entity_key(order: dict) -> tuple:
+    keys, _ = _LATEST_INDEXES[0]
+    return tuple(get_by_path(order, path) for path, _ in keys)
+
+
+_batcher = WriteBatcher(orders, entity_key=_entity_key)
+_latest_batcher = WriteBatcher(
+    latest_orders,
+    operation=lambda latest: latest_operation(_LATEST_INDEXES[0][0], latest),
+    entity_key=_entity_key,
+    ignored_codes=frozenset({DUPLICATE_KEY_ERROR}),  # not newer.
+)
+
+
 async def setup_orders():
-    await orders.create_index('meta.event_name', background=True)              # nopep8; str.
-    await orders.create_index('meta.custom_data.user_id', background=True)     # nopep8; str.
+    await apply_indexes(orders, _INDEXES, _LEGACY_INDEXES)
+    await apply_indexes(latest_orders, _LATEST_INDEXES)
 
-    await orders.create_index('data.id', background=True)                      # nopep8; str, as the `order_id`.
-    await orders.create_index('data.attributes.store_id', background=True)     # nopep8; str.
-    await orders.create_index('data.attributes.customer_id', background=True)  # nopep8; str.
-    await orders.create_index('data.attributes.identifier', background=True)   # nopep8; str.
 
-    await orders.create_index('data.attributes.user_email', background=True)   # nopep8; str.
-    await orders.create_index('data.attributes.status', background=True)       # nopep8; str.
+async def check_orders():
+    await ensure_unique_indexes(latest_orders, _LATEST_INDEXES)
+    await check_query_plan(orders, _latest_order_query('', '', '', ''), _LATEST_SORT)  # nopep8.
+    await check_query_plan(latest_orders, _latest_order_query('', '', '', ''))
 
-    await orders.create_index('data.attributes.first_order_item.id', background=True)          # nopep8; str, as the `order_item_id`.
-    await orders.create_index('data.attributes.first_order_item.order_id', background=True)    # nopep8; str, as the `order_id`.
-    await orders.create_index('data.attributes.first_order_item.product_id', background=True)  # nopep8; str, as the `product_id`.
-    await orders.create_index('data.attributes.first_order_item.variant_id', background=True)  # nopep8; str, as the `variant_id`.
 
-    await orders.create_index('data.attributes.created_at', background=True)   # nopep8; datetime.
-    await orders.create_index('data.attributes.updated_at', background=True)   # nopep8; datetime.
+# Rebuild the latest states from history, return the number of orders.
+async def backfill_latest_orders() -> int:
+    count = 0
+    async for order in orders.find({}):
+        await _upsert_latest_order(order)
+        count += 1
+    return count
 
 
 # https://docs.lemonsqueezy.com/api/orders#the-order-object
@@ -42,11 +137,26 @@ async def setup_orders():
 # You will notice that the `data` in the payload is the order object,
 # plus some `meta` and the usual `relationships` and `links`.
 async def insert_order(order: dict):
-    await orders.insert_one(order)
-    find_latest_order.cache_clear()
+    if SLIM_STORAGE:
+        slim = await archive_document(orders, order, _SLIM_PATHS)
+        await _batcher.write(slim)
+    else:
+        await _batcher.write(order)
+    await _latest_batcher.write(project_document(order, _LATEST_PATHS))
+
+    # Only invalidate the cache of this order.
+    await find_latest_order.invalidate(*_entity_key(order))
+
 
+async def _upsert_latest_order(order: dict):
+    latest = project_document(order, _LATEST_PATHS)
+    keys, _ = _LATEST_INDEXES[0]
+    await upsert_latest(latest_orders, keys, latest)
 
-@alru_cache(ttl=10)
+
+# Run `python cli.py backfill-latest` once after upgrading,
+# to build the latest states from history.
+@keyed_cache(name='find_latest_order', ttl=60, shared_ttl=600)
 async def find_latest_order(
     user_id: str,
     store_id: str,
@@ -54,22 +164,39 @@ async def find_latest_order(
     variant_id: str,
     test_mode: bool = False,
 ) -> Optional[dict]:
-    cursor = orders \
-        .find({
-            'meta.custom_data.user_id': user_id,
-            'data.attributes.store_id': store_id,
-            'data.attributes.first_order_item.product_id': product_id,
-            'data.attributes.first_order_item.variant_id': variant_id,
-            'data.attributes.test_mode': test_mode,
-        }) \
-        .sort('data.attributes.updated_at', -1) \
-        .limit(1)
-
-    res: list[dict] = []
-    async for order in cursor:
-        res.append(order)
-
-    return res[0] if res else None
+    query = _latest_order_query(user_id, store_id, product_id, variant_id, test_mode)  # nopep8.
+    return await latest_orders.find_one(query)
+
+
+# Batch version of `find_latest_order()` with one `$or` query,
+# the `items` are the (store_id, product_id, variant_id, test_mode) tuples,
+# return the found orders by `_entity_key()`.
+async def find_latest_orders(
+    user_id: str,
+    items: list[tuple[str, str, str, bool]],
+) -> dict[tuple, dict]:
+    if not items:
+        return {}
+
+    query = {'$or': [_latest_order_query(user_id, *item) for item in items]}
+    cursor = latest_orders.find(query)
+    return {_entity_key(order): order async for order in cursor}
+
+
+def _latest_order_query(
+    user_id: str,
+    store_id: str,
+    product_id: str,
+    variant_id: str,
+    test_mode: bool = False,
+) -> dict:
+    return {
+        'meta.custom_data.user_id': user_id,
+        'data.attributes.store_id': store_id,
+        'data.attributes.first_order_item.product_id': product_id,
+        'data.attributes.first_order_item.variant_id': variant_id,
+        'data.attributes.test_mode': test_mode,
+    }
 
 
 def convert_order_to_response(order: dict) -> dict:
@@ -1,11 +1,24 @@
 from enum import unique
 from typing import Optional
 
-from async_lru import alru_cache
+from pymongo import ASCENDING, DESCENDING
 from strenum import StrEnum
 
-from mongo.db import subscriptions, \
+from cache import keyed_cache
+from mongo.archive import SLIM_STORAGE, archive_document, slim_paths
+from mongo.batcher import WriteBatcher
+from mongo.db import DUPLICATE_KEY_ERROR, \
+    IndexSpec, \
+    subscriptions, \
     subscription_payments, \
+    latest_subscriptions, \
+    apply_indexes, \
+    check_query_plan, \
+    ensure_unique_indexes, \
+    get_by_path, \
+    latest_operation, \
+    project_document, \
+    upsert_latest, \
     convert_datetime_to_isoformat_with_z
 
 
@@ -27,38 +40,142 @@ class BillingReason(StrEnum):
     UPDATED = 'updated'
 
 
-async def setup_subscriptions():
-    await subscriptions.create_index('meta.event_name', background=True)                # nopep8; str.
-    await subscriptions.create_index('meta.custom_data.user_id', background=True)       # nopep8; str.
+# https://www.mongodb.com/docs/manual/tutorial/equality-sort-range-rule/
+#
+# The compound index covers querying the latest subscription in history,
+# by the ESR rule, equality fields first, then the sort field;
+# other single field indexes are covered by its prefix, or never queried.
+_INDEXES: list[IndexSpec] = [
+    ([
+        ('meta.custom_data.user_id', ASCENDING),    # str.
+        ('data.attributes.store_id', ASCENDING),    # str.
+        ('data.attributes.product_id', ASCENDING),  # str.
+        ('data.attributes.variant_id', ASCENDING),  # str.
+        ('data.attributes.test_mode', ASCENDING),   # bool.
+        ('data.attributes.updated_at', DESCENDING),  # datetime.
+    ], {}),
+    ([('data.id', ASCENDING)], {}),                    # nopep8; str, as the `subscription_id`.
+    ([('data.attributes.user_email', ASCENDING)], {}),  # str.
+]
+
+# The single field indexes created by the older versions (before tracked),
+# dropped by `apply_indexes()` if not declared above.
+_LEGACY_INDEXES: list[str] = [f'{path}_1' for path in [
+    'meta.event_name',
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.customer_id',
+    'data.attributes.order_id',
+    'data.attributes.order_item_id',
+    'data.attributes.product_id',
+    'data.attributes.variant_id',
+    'data.attributes.user_email',
+    'data.attributes.status',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]]
+
+_PAYMENT_INDEXES: list[IndexSpec] = [
+    ([('data.id', ASCENDING)], {}),                          # nopep8; str, as the `invoice_id`.
+    ([('data.attributes.subscription_id', ASCENDING)], {}),  # str.
+]
+
+# The single field indexes created by the older versions (before tracked),
+# dropped by `apply_indexes()` if not declared above.
+_PAYMENT_LEGACY_INDEXES: list[str] = [f'{path}_1' for path in [
+    'meta.event_name',
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.subscription_id',
+    'data.attributes.billing_reason',
+    'data.attributes.status',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]]
+
+# One document per subscription, see `upsert_latest()`.
+_LATEST_INDEXES: list[IndexSpec] = [
+    ([
+        ('meta.custom_data.user_id', ASCENDING),    # str.
+        ('data.attributes.store_id', ASCENDING),    # str.
+        ('data.attributes.product_id', ASCENDING),  # str.
+        ('data.attributes.variant_id', ASCENDING),  # str.
+        ('data.attributes.test_mode', ASCENDING),   # bool.
+    ], {'unique': True}),
+]
+
+# Only the fields for querying and `convert_subscription_to_response()`.
+_LATEST_PATHS = [
+    'meta.custom_data.user_id',
+    'data.id',
+    'data.attributes.store_id',
+    'data.attributes.product_id',
+    'data.attributes.variant_id',
+    'data.attributes.test_mode',
+    'data.attributes.status',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+]
+
+# Only the fields for querying, indexing and responding in the slim storage mode.
+_SLIM_PATHS = slim_paths(_INDEXES, _LATEST_PATHS)
 
-    await subscriptions.create_index('data.id', background=True)                        # nopep8; str, as the `subscription_id`.
-    await subscriptions.create_index('data.attributes.store_id', background=True)       # nopep8; str.
-    await subscriptions.create_index('data.attributes.customer_id', background=True)    # nopep8; str.
-    await subscriptions.create_index('data.attributes.order_id', background=True)       # nopep8; str.
-    await subscriptions.create_index('data.attributes.order_item_id', background=True)  # nopep8; str.
-    await subscriptions.create_index('data.attributes.product_id', background=True)     # nopep8; str.
-    await subscriptions.create_index('data.attributes.variant_id', background=True)     # nopep8; str.
+# Only the fields for querying, plus the invoice summary, in the slim storage mode.
+_PAYMENT_SLIM_PATHS = slim_paths(_PAYMENT_INDEXES, [
+    'meta.custom_data.user_id',
+    'data.attributes.store_id',
+    'data.attributes.status',
+    'data.attributes.billing_reason',
+    'data.attributes.total',
+    'data.attributes.currency',
+    'data.attributes.test_mode',
+    'data.attributes.created_at',
+    'data.attributes.updated_at',
+])
 
-    await subscriptions.create_index('data.attributes.user_email', background=True)     # nopep8; str.
-    await subscriptions.create_index('data.attributes.status', background=True)         # nopep8; str.
+_LATEST_SORT = [('data.attributes.updated_at', DESCENDING)]
 
-    await subscriptions.create_index('data.attributes.created_at', background=True)     # nopep8; datetime.
-    await subscriptions.create_index('data.attributes.updated_at', background=True)     # nopep8; datetime.
+
+# The arguments of `find_latest_subscription()`, as same order as `_LATEST_INDEXES[0]`.
+def _entity_key(subscription: dict) -> tuple:
+    keys, _ = _LATEST_INDEXES[0]
+    return tuple(get_by_path(subscription, path) for path, _ in keys)
+
+
+_batcher = WriteBatcher(subscriptions, entity_key=_entity_key)
+_payment_batcher = WriteBatcher(subscription_payments)
+_latest_batcher = WriteBatcher(
+    latest_subscriptions,
+    operation=lambda latest: latest_operation(_LATEST_INDEXES[0][0], latest),
+    entity_key=_entity_key,
+    ignored_codes=frozenset({DUPLICATE_KEY_ERROR}),  # not newer.
+)
+
+
+async def setup_subscriptions():
+    await apply_indexes(subscriptions, _INDEXES, _LEGACY_INDEXES)
+    await apply_indexes(latest_subscriptions, _LATEST_INDEXES)
 
 
 async def setup_subscription_payments():
-    await subscription_payments.create_index('meta.event_name', background=True)                  # nopep8; str.
-    await subscription_payments.create_index('meta.custom_data.user_id', background=True)         # nopep8; str.
+    await apply_indexes(subscription_payments, _PAYMENT_INDEXES, _PAYMENT_LEGACY_INDEXES)  # nopep8.
 
-    await subscription_payments.create_index('data.id', background=True)                          # nopep8; str, as the `invoice_id`.
-    await subscription_payments.create_index('data.attributes.store_id', background=True)         # nopep8; str.
-    await subscription_payments.create_index('data.attributes.subscription_id', background=True)  # nopep8; str.
 
-    await subscription_payments.create_index('data.attributes.billing_reason', background=True)   # nopep8; str.
-    await subscription_payments.create_index('data.attributes.status', background=True)           # nopep8; str.
+async def check_subscriptions():
+    await ensure_unique_indexes(latest_subscriptions, _LATEST_INDEXES)
+    await check_query_plan(subscriptions, _latest_subscription_query('', '', '', ''), _LATEST_SORT)  # nopep8.
+    await check_query_plan(latest_subscriptions, _latest_subscription_query('', '', '', ''))  # nopep8.
 
-    await subscription_payments.create_index('data.attributes.created_at', background=True)       # nopep8; datetime.
-    await subscription_payments.create_index('data.attributes.updated_at', background=True)       # nopep8; datetime.
+
+# Rebuild the latest states from history, return the number of subscriptions.
+async def backfill_latest_subscriptions() -> int:
+    count = 0
+    async for subscription in subscriptions.find({}):
+        await _upsert_latest_subscription(subscription)
+        count += 1
+    return count
 
 
 # https://docs.lemonsqueezy.com/api/subscriptions#the-subscription-object
@@ -67,8 +184,21 @@ async def setup_subscription_payments():
 # You will notice that the `data` in the payload is the subscription object,
 # plus some `meta` and the usual `relationships` and `links`.
 async def insert_subscription(subscription: dict):
-    await subscriptions.insert_one(subscription)
-    find_latest_subscription.cache_clear()
+    if SLIM_STORAGE:
+        slim = await archive_document(subscriptions, subscription, _SLIM_PATHS)
+        await _batcher.write(slim)
+    else:
+        await _batcher.write(subscription)
+    await _latest_batcher.write(project_document(subscription, _LATEST_PATHS))
+
+    # Only invalidate the cache of this subscription.
+    await find_latest_subscription.invalidate(*_entity_key(subscription))
+
+
+async def _upsert_latest_subscription(subscription: dict):
+    latest = project_document(subscription, _LATEST_PATHS)
+    keys, _ = _LATEST_INDEXES[0]
+    await upsert_latest(latest_subscriptions, keys, latest)
 
 
 # https://docs.lemonsqueezy.com/api/subscription-invoices#the-subscription-invoice-object
@@ -77,10 +207,15 @@ async def insert_subscription(subscription: dict):
 # You will notice that the `data` in the payload is the subscription invoice object,
 # plus some `meta` and the usual `relationships` and `links`.
 async def insert_subscription_payment(payment: dict):
-    await subscription_payments.insert_one(payment)
+    if SLIM_STORAGE:
+        await _payment_batcher.write(await archive_document(subscription_payments, payment, _PAYMENT_SLIM_PATHS))  # nopep8.
+    else:
+        await _payment_batcher.write(payment)
 
 
-@alru_cache(ttl=10)
+# Run `python cli.py backfill-latest` once after upgrading,
+# to build the latest states from history.
+@keyed_cache(name='find_latest_subscription', ttl=60, shared_ttl=600)
 async def find_latest_subscription(
     user_id: str,
     store_id: str,
@@ -88,22 +223,39 @@ async def find_latest_subscription(
     variant_id: str,
     test_mode: bool = False,
 ) -> Optional[dict]:
-    cursor = subscriptions \
-        .find({
-            'meta.custom_data.user_id': user_id,
-            'data.attributes.store_id': store_id,
-            'data.attributes.product_id': product_id,
-            'data.attributes.variant_id': variant_id,
-            'data.attributes.test_mode': test_mode,
-        }) \
-        .sort('data.attributes.updated_at', -1) \
-        .limit(1)
-
-    res: list[dict] = []
-    async for order in cursor:
-        res.append(order)
-
-    return res[0] if res else None
+    query = _latest_subscription_query(user_id, store_id, product_id, variant_id, test_mode)  # nopep8.
+    return await latest_subscriptions.find_one(query)
+
+
+# Batch version of `find_latest_subscription()` with one `$or` query,
+# the `items` are the (store_id, product_id, variant_id, test_mode) tuples,
+# return the found subscriptions by `_entity_key()`.
+async def find_latest_subscriptions(
+    user_id: str,
+    items: list[tuple[str, str, str, bool]],
+) -> dict[tuple, dict]:
+    if not items:
+        return {}
+
+    queries = [_latest_subscription_query(user_id, *item) for item in items]
+    cursor = latest_subscriptions.find({'$or': queries})
+    return {_entity_key(s): s async for s in cursor}
+
+
+def _latest_subscription_query(
+    user_id: str,
+    store_id: str,
+    product_id: str,
+    variant_id: str,
+    test_mode: bool = False,
+) -> dict:
+    return {
+        'meta.custom_data.user_id': user_id,
+        'data.attributes.store_id': store_id,
+        'data.attributes.product_id': product_id,
+        'data.attributes.variant_id': variant_id,
+        'data.attributes.test_mode': test_mode,
+    }
 
 
 def convert_subscription_to_response(subscription: dict) -> dict:
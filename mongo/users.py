@@ -1,9 +1,10 @@
 from dataclasses import dataclass, asdict
 from typing import Optional
 
-from async_lru import alru_cache
+from pymongo import ReturnDocument
 from quart import abort
 
+from cache import keyed_cache
 from mongo.db import users
 
 
@@ -34,13 +35,19 @@ class TokenInfo:
 # MongoDB does not recreate the index if it already exists.
 # https://www.mongodb.com/community/forums/t/behavior-of-createindex-for-an-existing-index/2248/2
 async def setup_users():
-    await users.create_index('id', unique=True, background=True)     # str.
-    await users.create_index('token', unique=True, background=True)  # str.
+    await check_users()
     await users.create_index('email', background=True)               # str.
     await users.create_index('create_timestamp', background=True)    # int.
     await users.create_index('update_timestamp', background=True)    # int.
 
 
+# Only the unique indexes, ensured by workers before serving,
+# see `ensure_unique_indexes()`.
+async def check_users():
+    await users.create_index('id', unique=True, background=True)     # str.
+    await users.create_index('token', unique=True, background=True)  # str.
+
+
 async def find_user_by_email(email: str) -> Optional[User]:
     return await _find_user_by_('email', email)
 
@@ -49,7 +56,13 @@ async def find_user_by_token(token: str) -> Optional[User]:
     return await _find_user_by_('token', token)
 
 
-@alru_cache(ttl=10)
+@keyed_cache(
+    name='find_user',
+    ttl=60,
+    shared_ttl=600,
+    encode=lambda u: asdict(u) if u else None,
+    decode=lambda d: User(**d) if d else None,
+)
 async def _find_user_by_(key: str, value: str) -> Optional[User]:
     res: dict = await users.find_one({key: value})
     if not res:
@@ -73,10 +86,19 @@ async def upsert_user(user: User):
             or not user.update_timestamp:
         abort(500, 'invalid user object')
 
-    await users.update_one(
+    old: Optional[dict] = await users.find_one_and_update(
         {'id': user.id},
         {'$set': asdict(user)},
+        projection={'email': True, 'token': True},
         upsert=True,
+        return_document=ReturnDocument.BEFORE,
     )
 
-    _find_user_by_.cache_clear()
+    # Only invalidate the cache of this user,
+    # including the old email or token before updated.
+    await _find_user_by_.invalidate('email', user.email)
+    await _find_user_by_.invalidate('token', user.token)
+    if old and old.get('email') != user.email:
+        await _find_user_by_.invalidate('email', old.get('email'))
+    if old and old.get('token') != user.token:
+        await _find_user_by_.invalidate('token', old.get('token'))
@@ -1,74 +1,114 @@
 import json
+import os
+import struct
 import time
 
 import jwt
 import validators
 
-from base64 import b64encode, b64decode
-from dataclasses import asdict
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
 from typing import Optional
 from uuid import uuid4
 
+from async_lru import alru_cache
 from Crypto.Cipher import AES
-from jwt import PyJWKClient
 from quart import abort
 from validators import ValidationFailure
 
+from jwks import JWKSManager
 from logger import logger
 from mongo.users import User, Token, TokenInfo, \
     find_user_by_email, \
     find_user_by_token, \
     upsert_user
-from rds import rds, get_str_from_rds, \
-    GOOGLE_OAUTH_CLIENT_IDS, \
-    LEMONSQUEEZY_SIGNING_SECRET
+from rds import get_set_from_rds, GOOGLE_OAUTH_CLIENT_IDS
+from signing import SigningKeyRing, get_signing_keyring
 
-# Unsupported asyncio for now.
-_google_jwk_client = PyJWKClient(
+_google_jwks = JWKSManager(
     uri='https://www.googleapis.com/oauth2/v3/certs',
-    cache_jwk_set=True,
     lifespan=86400,  # seconds of 1 day.
     timeout=10,  # seconds.
 )
 
 
-# https://onboardbase.com/blog/aes-encryption-decryption/
+async def setup_oauth():
+    await _google_jwks.start()
+
+
+async def teardown_oauth():
+    await _google_jwks.stop()
+
+
+# The compact binary token, urlsafe base64 encoded without padding:
+#
+#   version (1 byte) | key id (4 bytes) | nonce (12 bytes) | ciphertext | tag (16 bytes)
+#
+# where the plaintext is generate timestamp (8 bytes) | user id (utf-8),
+# and the version, key id and nonce are authenticated as associated data.
+_TOKEN_VERSION = 1
+_TOKEN_HEADER = struct.Struct('>B4s12s')
+_TOKEN_TIMESTAMP = struct.Struct('>Q')
+
+# The legacy tokens are base64 encoded JSON, always start with '{"'.
+_LEGACY_TOKEN_PREFIX = 'eyJ'
+
+
 def generate_user_token(user_id: str, timestamp: int, secret: str = '') -> str:
-    secret = secret.strip()
-    if not secret:
-        secret = get_str_from_rds(LEMONSQUEEZY_SIGNING_SECRET)
-    if len(secret) != 16:
-        abort(500, f'"{LEMONSQUEEZY_SIGNING_SECRET}" must be 16 characters length string')  # nopep8.
-
-    info = TokenInfo(user_id=user_id, generate_timestamp=timestamp)
-    info = json.dumps(asdict(info)).encode()
-
-    cipher = AES.new(secret.encode(), AES.MODE_EAX)
-    ciphertext, tag = cipher.encrypt_and_digest(info)  # bytes.
-    nonce: bytes = cipher.nonce
-
-    token = Token(
-        ciphertext=b64encode(ciphertext).decode(),
-        tag=b64encode(tag).decode(),
-        nonce=b64encode(nonce).decode(),
-    )
+    key = get_signing_keyring(secret).active
+    header = _TOKEN_HEADER.pack(_TOKEN_VERSION, key.kid, os.urandom(12))
 
-    token = json.dumps(asdict(token)).encode()
-    return b64encode(token).decode()
+    plaintext = _TOKEN_TIMESTAMP.pack(timestamp) + user_id.encode()
+    ciphertext = key.cipher.encrypt(header[-12:], plaintext, header)
+    return urlsafe_b64encode(header + ciphertext).rstrip(b'=').decode()
 
 
-# https://onboardbase.com/blog/aes-encryption-decryption/
+# The decrypted tokens are cached, so repeated requests cost a dict lookup.
 def decrypt_user_token(token: str, secret: str = '') -> TokenInfo:
-    secret = secret.strip()
-    if not secret:
-        secret = get_str_from_rds(LEMONSQUEEZY_SIGNING_SECRET)
-    if len(secret) != 16:
-        abort(500, f'"{LEMONSQUEEZY_SIGNING_SECRET}" must be 16 characters length string')  # nopep8.
+    return _decrypt_user_token(token, get_signing_keyring(secret))
+
+
+@lru_cache(maxsize=4096)
+def _decrypt_user_token(token: str, keyring: SigningKeyRing) -> TokenInfo:
+    if token.startswith(_LEGACY_TOKEN_PREFIX):
+        return _decrypt_legacy_user_token(token, keyring)
+
+    data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    if len(data) < _TOKEN_HEADER.size + _TOKEN_TIMESTAMP.size + 16:
+        raise ValueError('invalid user token length')
 
+    header = data[:_TOKEN_HEADER.size]
+    version, kid, nonce = _TOKEN_HEADER.unpack(header)
+    if version != _TOKEN_VERSION:
+        raise ValueError(f'unknown user token version, version={version}')
+
+    # Only decrypt with the key of the key id.
+    key = keyring.keys.get(kid)
+    if not key:
+        raise ValueError(f'unknown user token key id, kid={kid.hex()}')
+
+    plaintext = key.cipher.decrypt(nonce, data[_TOKEN_HEADER.size:], header)
+    timestamp, = _TOKEN_TIMESTAMP.unpack_from(plaintext)
+    return TokenInfo(
+        user_id=plaintext[_TOKEN_TIMESTAMP.size:].decode(),
+        generate_timestamp=timestamp,
+    )
+
+
+# https://onboardbase.com/blog/aes-encryption-decryption/
+#
+# The legacy tokens don't carry the key id, try the active key first.
+def _decrypt_legacy_user_token(token: str, keyring: SigningKeyRing) -> TokenInfo:  # nopep8.
     token: Token = Token(**json.loads(b64decode(token)))
-    cipher = AES.new(secret.encode(), AES.MODE_EAX, b64decode(token.nonce))
-    info = cipher.decrypt_and_verify(b64decode(token.ciphertext), b64decode(token.tag))  # nopep8.
-    return TokenInfo(**json.loads(info))
+    for key in keyring.keys.values():
+        cipher = AES.new(key.secret, AES.MODE_EAX, b64decode(token.nonce))
+        try:
+            info = cipher.decrypt_and_verify(b64decode(token.ciphertext), b64decode(token.tag))  # nopep8.
+            return TokenInfo(**json.loads(info))
+        except ValueError:
+            continue  # MAC check failed.
+
+    raise ValueError('invalid legacy user token')
 
 
 async def upsert_user_from_google_oauth(
@@ -76,23 +116,22 @@ async def upsert_user_from_google_oauth(
     user_token: str = '',
     verify_exp: bool = False,
 ) -> User:
-    payload: dict = {}
-
-    client_ids = rds.smembers(GOOGLE_OAUTH_CLIENT_IDS)
-    for cid in client_ids:
-        try:
-            payload = _decode_google_oauth_credential(
-                credential=credential,
-                client_id=cid.decode(),
-                verify_exp=verify_exp,
-            )
-        except Exception as e:
-            logger.exception('_decode_google_oauth_credential')
-            latest_err = e
-            pass  # DO NOTHING.
-    if not payload:
+    # Verify signature once, and check `aud` against all of our client ids.
+    client_ids = get_set_from_rds(GOOGLE_OAUTH_CLIENT_IDS)
+    try:
+        payload = await _decode_google_oauth_credential(
+            credential=credential,
+            client_ids=client_ids,
+            verify_exp=verify_exp,
+        )
+    except Exception as e:
+        logger.warning(f'decode google oauth credential failed, err={repr(e)}')
         abort(401, f'invalid credential, credential={credential}')
 
+    # The verified payload may be cached, so check `exp` again.
+    if verify_exp and payload.get('exp', 0) <= time.time():
+        abort(401, f'expired credential, credential={credential}')
+
     email = payload.get('email', '').strip()
     if not email:
         abort(401, '"email" not exists')
@@ -134,17 +173,22 @@ async def upsert_user_from_google_oauth(
 
 # https://developers.google.com/identity/gsi/web/guides/verify-google-id-token
 # https://pyjwt.readthedocs.io/en/stable/usage.html#retrieve-rsa-signing-keys-from-a-jwks-endpoint
-def _decode_google_oauth_credential(
+#
+# Cache the verified payload for a short while to absorb sign in retries,
+# failed verifications are not cached.
+@alru_cache(maxsize=1024, ttl=60)
+async def _decode_google_oauth_credential(
     credential: str,
-    client_id: str,
+    client_ids: frozenset[str],
     verify_exp: bool = False,
 ) -> dict:
-    signing_key = _google_jwk_client.get_signing_key_from_jwt(credential)
+    header = jwt.get_unverified_header(credential)
+    signing_key = await _google_jwks.get_signing_key(header.get('kid', ''))
     return jwt.decode(
         jwt=credential,
         key=signing_key.key,
         algorithms=['RS256'],
-        audience=client_id,
+        audience=list(client_ids),  # match any of them.
         issuer='https://accounts.google.com',
         options={'verify_exp': verify_exp},
     )
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import time
+
+import redis
+
+from typing import Optional
+
+from quart import abort
+
+from logger import logger
+from metrics import collector
+from rds import async_rds, get_script
+
+# Reserve a token from the bucket, and return seconds to wait for it;
+# the tokens may be negative, which means they are reserved by waiters.
+# Return -1 without reserving if the waiting is longer than `max_wait`.
+#
+# Use the redis server time, so all workers share the same clock.
+_RESERVE_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or capacity)
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts') or now)
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+  wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+  return '-1'
+end
+redis.call('HSET', KEYS[1],
+  'tokens', tostring(tokens - 1), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+'''
+
+# Drain the bucket, so nobody can reserve a token in next `ARGV[3]` seconds.
+_PENALIZE_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local seconds = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or capacity)
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts') or now)
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+tokens = math.min(tokens, 0) - seconds * rate
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate + seconds) + 60)
+return 'OK'
+'''
+
+# As same as `workers` in `hypercorn_config.py`, but read from the environment
+# instead of importing the server config.
+_WORKERS = int(os.environ.get('LEMONSQUEEPY_WORKERS', 0)) or os.cpu_count() or 1  # nopep8.
+
+# All rate limiters by name, for stats.
+_limiters: dict[str, 'RateLimiter'] = {}
+
+# Log the fallback to the local bucket at most once per interval per limiter,
+# since every call falls back while redis is not available.
+_FALLBACK_LOG_INTERVAL = 60  # seconds.
+
+
+# Same algorithm as the scripts above, in process.
+class _LocalTokenBucket:
+    def __init__(self, capacity: int, rate: float):
+        self._capacity = capacity
+        self._rate = rate
+        self._tokens: float = capacity
+        self._ts = time.monotonic()
+
+    def reserve(self, max_wait: float) -> float:
+        self._refill()
+        wait = (1 - self._tokens) / self._rate if self._tokens < 1 else 0
+        if wait > max_wait:
+            return -1
+        self._tokens -= 1
+        return wait
+
+    def penalize(self, seconds: float):
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self._rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._ts) * self._rate)  # nopep8.
+        self._ts = now
+
+
+# https://en.wikipedia.org/wiki/Token_bucket
+#
+# The bucket is shared across workers by redis,
+# and fallback to a local bucket when redis is not available,
+# with a share of the limit per worker, so all workers don't exceed it together.
+#
+# Requests over the limit wait in a bounded queue instead of failing,
+# until the `max_wait` deadline, or the queue is full.
+class RateLimiter:
+    def __init__(
+        self,
+        name: str,
+        limit: int,  # requests per `period`.
+        period: float = 60,  # seconds.
+        max_wait: float = 10,  # seconds.
+        max_waiting: int = 100,  # requests; per process.
+        workers: int = _WORKERS,  # processes sharing the `limit`.
+    ):
+        self._key = f'lemonsqueepy:ratelimit:{name}'
+        self._name = name
+        self._capacity = limit
+        self._rate = limit / period  # tokens per second.
+        self._max_wait = max_wait
+        self._max_waiting = max_waiting
+        self._local = _LocalTokenBucket(max(limit // workers, 1), self._rate / workers)  # nopep8.
+        self._fallback_logged_at = float('-inf')
+        _limiters[name] = self
+
+        self._waiting = 0  # including the reserving ones.
+        self._acquired = 0
+        self._rejected = 0
+        self._wait_seconds_total: float = 0
+        self._wait_seconds_max: float = 0
+
+    async def acquire(self):
+        # Count before reserving (no awaiting between checking and counting),
+        # so the bound is enforced under concurrency.
+        if self._waiting >= self._max_waiting:
+            self._rejected += 1
+            abort(429, f'too many requests waiting, name={self._name}')
+
+        self._waiting += 1
+        try:
+            wait = await self._reserve()
+            if wait < 0:
+                self._rejected += 1
+                abort(429, f'too many requests, name={self._name}')
+
+            self._acquired += 1
+            self._wait_seconds_total += wait
+            self._wait_seconds_max = max(self._wait_seconds_max, wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting -= 1
+
+    # Feed the upstream `Retry-After` back to the limiter.
+    async def penalize(self, seconds: float):
+        logger.warning(f'rate limited by upstream, name={self._name}, seconds={seconds}')  # nopep8.
+        self._local.penalize(seconds)
+        try:
+            await get_script(_PENALIZE_SCRIPT)(
+                keys=[self._key],
+                args=[self._capacity, self._rate, seconds],
+                client=async_rds,
+            )
+        except redis.RedisError:
+            logger.exception(f'penalize rate limiter failed, name={self._name}')  # nopep8.
+
+    def stats(self) -> dict:
+        return {
+            'waiting': self._waiting,
+            'acquired': self._acquired,
+            'rejected': self._rejected,
+            'wait_seconds_total': self._wait_seconds_total,
+            'wait_seconds_max': self._wait_seconds_max,
+        }
+
+    async def _reserve(self) -> float:
+        try:
+            wait = await get_script(_RESERVE_SCRIPT)(
+                keys=[self._key],
+                args=[self._capacity, self._rate, self._max_wait],
+                client=async_rds,
+            )
+            return float(wait)
+        except redis.RedisError:
+            now = time.monotonic()
+            if now - self._fallback_logged_at >= _FALLBACK_LOG_INTERVAL:
+                self._fallback_logged_at = now
+                logger.warning(f'reserve from redis failed, fallback to local, name={self._name}')  # nopep8.
+            return self._local.reserve(self._max_wait)
+
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Retry-After
+def parse_retry_after(value: Optional[str], default: float = 60) -> float:
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        return default  # HTTP-date is not supported.
+
+
+def ratelimit_stats() -> dict[str, dict]:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+@collector('lemonsqueepy_ratelimit_requests_total', 'Rate limited requests by limiter and result.', 'counter', ('limiter', 'result'))  # nopep8.
+async def _collect_ratelimit_requests() -> dict:
+    res = {}
+    for name, stats in ratelimit_stats().items():
+        res[(name, 'acquired')] = stats['acquired']
+        res[(name, 'rejected')] = stats['rejected']
+    return res
+
+
+@collector('lemonsqueepy_ratelimit_waiting', 'Requests waiting for tokens by limiter.', 'gauge', ('limiter',))  # nopep8.
+async def _collect_ratelimit_waiting() -> dict:
+    return {(name,): stats['waiting'] for name, stats in ratelimit_stats().items()}  # nopep8.
+
+
+@collector('lemonsqueepy_ratelimit_wait_seconds_total', 'Seconds waited for tokens by limiter.', 'counter', ('limiter',))  # nopep8.
+async def _collect_ratelimit_wait_seconds() -> dict:
+    return {(name,): stats['wait_seconds_total'] for name, stats in ratelimit_stats().items()}  # nopep8.
@@ -1,6 +1,16 @@
+import asyncio
+import time
+
 import redis
+import redis.asyncio
+
+from typing import Any, Optional, Union
 
 from quart import abort
+from redis.commands.core import AsyncScript
+
+from logger import logger
+from metrics import Histogram
 
 # For checking whether the credential issuer is our own.
 # https://developers.google.com/identity/gsi/web/guides/get-google-api-clientid#get_your_google_api_client_id
@@ -18,21 +28,233 @@ GOOGLE_OAUTH_CLIENT_IDS = 'google_oauth_client_ids'  # set.
 # for example "0123456789abcdef" (don't use it, just a example, haha).
 LEMONSQUEEZY_SIGNING_SECRET = 'lemonsqueezy_signing_secret'  # string.
 
+# The previous signing secrets which are still accepted for verifying,
+# e.g. webhooks in flight and user tokens generated before rotation.
+#
+# To rotate, `SADD lemonsqueezy_previous_signing_secrets "OLD_SECRET"` first,
+# then `SET lemonsqueezy_signing_secret "NEW_SECRET"` in redis-cli.
+LEMONSQUEEZY_PREVIOUS_SIGNING_SECRETS = 'lemonsqueezy_previous_signing_secrets'  # nopep8; set.
+
 # Interact with the Lemon Squeezy backend.
 # https://docs.lemonsqueezy.com/guides/developer-guide/getting-started#api-overview
 LEMONSQUEEZY_API_KEY = 'lemonsqueezy_api_key'  # string.
 
 # Default host and port.
-rds = redis.from_url('redis://localhost:6379')
+_REDIS_URL = 'redis://localhost:6379'
+
+# Blocking client, only for scripts and tests which run outside of the event loop.
+rds = redis.from_url(_REDIS_URL)
+
+_command_seconds = Histogram(
+    'lemonsqueepy_redis_command_duration_seconds',
+    'Redis command latency by command.',
+    ('command',),
+)
+
+
+# All commands (including scripts) are sent by `execute_command()`,
+# except pipelines and pub/sub, which are not on the hot path.
+class _TimedRedis(redis.asyncio.Redis):
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            command = args[0] if isinstance(args[0], str) else args[0].decode()
+            _command_seconds.observe(command.upper(), value=time.perf_counter() - start)  # nopep8.
+
+
+# Non-blocking client, shared by all coroutines of current worker,
+# created in `setup_redis()`, or lazily on first use, e.g. by scripts and tests.
+_async_rds: Optional[redis.asyncio.Redis] = None
+
+
+def _get_async_rds() -> redis.asyncio.Redis:
+    global _async_rds
+    if _async_rds is None:
+        # Wait for a free connection instead of raising when the pool is exhausted.
+        _async_rds = _TimedRedis(
+            connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+                _REDIS_URL,
+                max_connections=32,
+                timeout=5,  # seconds.
+            ),
+        )
+    return _async_rds
+
+
+# Resolve the client of current worker on access,
+# so modules can still import `async_rds` at import time.
+class _AsyncRedis:
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(_get_async_rds(), attr)
+
+
+async_rds: redis.asyncio.Redis = _AsyncRedis()  # type: ignore
+
+# Lua scripts, registered lazily,
+# call with `client=async_rds` to run on the client of current worker.
+_scripts: dict[str, AsyncScript] = {}
+
+
+def get_script(source: str) -> AsyncScript:
+    script = _scripts.get(source)
+    if not script:
+        script = _scripts[source] = async_rds.register_script(source)
+    return script
+
+
+async def setup_redis():
+    _get_async_rds()
+
+
+async def teardown_redis():
+    global _async_rds
+    if _async_rds is not None:
+        await _async_rds.aclose()
+        _async_rds = None
+
+
+# Secrets are rarely changed, so we keep them in process,
+# then the hot path (webhooks, user token, etc.) doesn't need any network hop.
+#
+# They are reloaded in background when changed (keyspace notifications),
+# or when expired as a fallback of lost notifications.
+_SECRETS_TTL = 300  # seconds.
+_SECRETS_SET_KEYS = {GOOGLE_OAUTH_CLIENT_IDS, LEMONSQUEEZY_PREVIOUS_SIGNING_SECRETS}  # nopep8.
+_SECRETS_STR_KEYS = {LEMONSQUEEZY_SIGNING_SECRET, LEMONSQUEEZY_API_KEY}
+
+_Secret = Optional[Union[str, frozenset[str]]]  # None means not exists.
+
+_secrets: dict[str, tuple[_Secret, float]] = {}  # key -> (value, expire_at).
+_reloading: set[str] = set()
+_listener: Optional[asyncio.Task] = None
+
+
+async def setup_secrets():
+    for key in _SECRETS_STR_KEYS | _SECRETS_SET_KEYS:
+        await _reload_secret(key)
+
+    global _listener
+    _listener = asyncio.create_task(_listen_secrets())
+
+
+async def teardown_secrets():
+    global _listener
+    if _listener:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass  # DO NOTHING.
+        _listener = None
 
 
 def get_str_from_rds(key: str) -> str:
-    value = rds.get(key)
-    if not value:
+    value = _get_secret(key)
+    if value is None:
         abort(500, f'"{key}" not exists')
 
-    value = value.decode().strip()
+    value = value.strip()
     if not value:
         abort(500, f'"{key}" is empty')
 
     return value
+
+
+def get_set_from_rds(key: str) -> frozenset[str]:
+    return _get_secret(key) or frozenset()
+
+
+def _get_secret(key: str) -> _Secret:
+    entry = _secrets.get(key)
+    if not entry:  # not loaded yet, e.g. called by scripts or tests.
+        value = _fetch_secret_blocking(key)
+        _secrets[key] = (value, time.monotonic() + _SECRETS_TTL)
+        return value
+
+    value, expire_at = entry
+    if expire_at <= time.monotonic():
+        _schedule_reload_secret(key)  # still return the stale value.
+
+    return value
+
+
+def _schedule_reload_secret(key: str):
+    if key in _reloading:
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:  # outside of the event loop, blocking is fine.
+        _secrets[key] = (_fetch_secret_blocking(key), time.monotonic() + _SECRETS_TTL)  # nopep8.
+        return
+
+    _reloading.add(key)
+    task = loop.create_task(_reload_secret(key))
+    task.add_done_callback(lambda _: _reloading.discard(key))
+
+
+async def _reload_secret(key: str):
+    try:
+        if key in _SECRETS_SET_KEYS:
+            members = await async_rds.smembers(key)
+            value = frozenset(m.decode().strip() for m in members) - {''}
+        else:
+            value = await async_rds.get(key)
+            value = value.decode() if value else None
+    except redis.RedisError:
+        logger.exception(f'reload secret failed, key={key}')
+        return  # keep the stale value, retry when expired again.
+
+    _secrets[key] = (value, time.monotonic() + _SECRETS_TTL)
+
+
+def _fetch_secret_blocking(key: str) -> _Secret:
+    if key in _SECRETS_SET_KEYS:
+        members = rds.smembers(key)
+        return frozenset(m.decode().strip() for m in members) - {''}
+
+    value = rds.get(key)
+    return value.decode() if value else None
+
+
+# https://redis.io/docs/manual/keyspace-notifications/
+#
+# Notifications are disabled by default, we try to enable them here,
+# it's fine if failed (e.g. CONFIG is disabled by the cloud vendor),
+# the secrets will be reloaded when expired anyway.
+async def _enable_keyspace_notifications():
+    try:
+        config: dict = await async_rds.config_get('notify-keyspace-events')
+        flags = set(config.get('notify-keyspace-events', ''))
+
+        # Keyspace events ("K") of string ("$") and set ("s") commands,
+        # and generic ("g") ones, e.g. DEL; "A" is an alias of "g$lshzxetd".
+        required = {'K'} if 'A' in flags else {'K', '$', 's', 'g'}
+        if not required <= flags:
+            flags |= required
+            await async_rds.config_set('notify-keyspace-events', ''.join(sorted(flags)))  # nopep8.
+    except redis.RedisError:
+        logger.warning('enable keyspace notifications failed')
+
+
+async def _listen_secrets():
+    prefix = '__keyspace@*__:'
+    channels = [prefix + k for k in _SECRETS_STR_KEYS | _SECRETS_SET_KEYS]
+
+    while True:
+        try:
+            await _enable_keyspace_notifications()
+            async with async_rds.pubsub() as pubsub:
+                await pubsub.psubscribe(*channels)
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel: str = message['channel'].decode()
+                    await _reload_secret(channel.split(':', 1)[1])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('listen secrets failed, retry later')
+            await asyncio.sleep(5)
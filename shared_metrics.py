@@ -0,0 +1,133 @@
+import asyncio
+import os
+import socket
+import time
+
+from typing import Optional
+
+import orjson
+import redis
+
+from logger import logger
+from metrics import Snapshot, merge_snapshots, render_metrics, snapshot_metrics
+from rds import async_rds
+
+# Every worker publishes its metrics snapshot to redis periodically,
+# and the scrape renders the merged snapshots of all workers,
+# so the counters don't jump by whichever worker answered the scrape.
+#
+# The snapshots of exited workers (or stale ones, e.g. killed) are merged
+# into the "retired" one, only the counters and histograms,
+# so they are still monotonic when workers are restarted, e.g. by
+# `max_requests` in `hypercorn_config.py`.
+_WORKERS_KEY = 'lemonsqueepy:metrics:workers'  # hash, worker -> snapshot.
+_RETIRED = 'retired'
+
+_PUBLISH_INTERVAL = 5  # seconds.
+_STALE_SECONDS = 60
+
+_publisher: Optional[asyncio.Task] = None
+
+
+async def setup_shared_metrics():
+    global _publisher
+    _publisher = asyncio.create_task(_publish_periodically())
+
+
+async def teardown_shared_metrics():
+    global _publisher
+    if not _publisher:
+        return
+
+    _publisher.cancel()
+    try:
+        await _publisher
+    except asyncio.CancelledError:
+        pass  # DO NOTHING.
+    _publisher = None
+
+    try:
+        await _publish(await snapshot_metrics())
+        await _retire(_worker())
+    except redis.RedisError:
+        logger.exception('retire metrics failed')
+
+
+# Render the metrics of all workers,
+# or only this worker if redis is not available.
+async def render_shared_metrics() -> str:
+    try:
+        snapshot = await snapshot_metrics()
+        await _publish(snapshot)
+        snapshots = await _load_snapshots()
+    except redis.RedisError:
+        logger.exception('load shared metrics failed, render this worker only')  # nopep8.
+        return await render_metrics()
+    return await render_metrics(snapshots)
+
+
+# Hostname and pid, since workers may be on different hosts.
+def _worker() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+async def _publish_periodically():
+    while True:
+        await asyncio.sleep(_PUBLISH_INTERVAL)
+        try:
+            await _publish(await snapshot_metrics())
+        except redis.RedisError:
+            logger.exception('publish metrics failed')
+
+
+async def _publish(snapshot: Snapshot):
+    data = orjson.dumps({'at': time.time(), 'snapshot': snapshot})
+    await async_rds.hset(_WORKERS_KEY, _worker(), data)
+
+
+# Return the snapshots of the retired and the live workers,
+# retire the stale ones first, then load again to include them.
+async def _load_snapshots() -> list[Snapshot]:
+    entries = await _load_entries()
+    stale = [
+        worker for worker, entry in entries.items()
+        if worker != _RETIRED and entry['at'] < time.time() - _STALE_SECONDS
+    ]
+    if stale:
+        for worker in stale:
+            await _retire(worker)
+        entries = await _load_entries()
+    return [entry['snapshot'] for entry in entries.values()]
+
+
+async def _load_entries() -> dict[str, dict]:
+    res: dict[str, dict] = {}
+    for field, data in (await async_rds.hgetall(_WORKERS_KEY)).items():
+        field = field.decode() if isinstance(field, bytes) else field
+        res[field] = orjson.loads(data)
+    return res
+
+
+# Merge the snapshot of the exited `worker` into the retired one,
+# in a transaction, since workers may retire the same stale one at once.
+async def _retire(worker: str):
+    async with async_rds.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(_WORKERS_KEY)
+                retired, data = await pipe.hmget(_WORKERS_KEY, [_RETIRED, worker])  # nopep8.
+                if not data:
+                    return  # retired by others.
+
+                snapshots = [orjson.loads(data)['snapshot']]
+                if retired:
+                    snapshots.append(orjson.loads(retired)['snapshot'])
+                merged = merge_snapshots(snapshots, cumulative=True)
+
+                pipe.multi()
+                pipe.hset(_WORKERS_KEY, _RETIRED, orjson.dumps({'at': 0, 'snapshot': merged}))  # nopep8.
+                pipe.hdel(_WORKERS_KEY, worker)
+                await pipe.execute()
+                return
+            except redis.WatchError:
+                continue  # changed by others, retry.
@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from quart import abort
+
+from logger import logger
+from rds import get_str_from_rds, get_set_from_rds, \
+    LEMONSQUEEZY_SIGNING_SECRET, \
+    LEMONSQUEEZY_PREVIOUS_SIGNING_SECRETS
+
+
+# A signing secret with the precomputed HMAC and AES objects,
+# the `kid` is the first 4 bytes of the SHA-256 of the secret.
+@dataclass(frozen=True)
+class SigningKey:
+    kid: bytes
+    secret: bytes = field(repr=False)
+    hmac: 'hmac.HMAC' = field(repr=False)  # copy before using.
+    cipher: AESGCM = field(repr=False)
+
+    def sign(self, body: bytes) -> str:
+        mac = self.hmac.copy()
+        mac.update(body)
+        return mac.hexdigest()
+
+
+# The active key signs and encrypts,
+# the active and previous keys verify and decrypt, the active one first.
+#
+# Rings are rebuilt only when the secrets are changed (see `rds.py`),
+# and compared by identity, so they can be the keys of caches.
+@dataclass(frozen=True, eq=False)
+class SigningKeyRing:
+    active: SigningKey
+    keys: dict[bytes, SigningKey]  # kid -> key, the active one first.
+
+    def verify(self, body: bytes, signature: str) -> bool:
+        for key in self.keys.values():
+            if hmac.compare_digest(key.sign(body), signature):
+                return True
+        return False
+
+
+# Use the `secret` only if it is not empty, e.g. in tests.
+def get_signing_keyring(secret: str = '') -> SigningKeyRing:
+    secret = secret.strip()
+    if secret:
+        return _build_keyring(secret, frozenset())
+
+    return _build_keyring(
+        get_str_from_rds(LEMONSQUEEZY_SIGNING_SECRET),
+        get_set_from_rds(LEMONSQUEEZY_PREVIOUS_SIGNING_SECRETS),
+    )
+
+
+@lru_cache(maxsize=8)
+def _build_keyring(active: str, previous: frozenset[str]) -> SigningKeyRing:
+    if len(active) != 16:
+        abort(500, f'"{LEMONSQUEEZY_SIGNING_SECRET}" must be 16 characters length string')  # nopep8.
+
+    active_key = _build_key(active)
+    keys = {active_key.kid: active_key}
+    for secret in sorted(previous - {active}):
+        if len(secret) != 16:
+            logger.warning(f'skip invalid "{LEMONSQUEEZY_PREVIOUS_SIGNING_SECRETS}" member')  # nopep8.
+            continue
+        key = _build_key(secret)
+        keys.setdefault(key.kid, key)
+
+    return SigningKeyRing(active=active_key, keys=keys)
+
+
+def _build_key(secret: str) -> SigningKey:
+    data = secret.encode()
+    return SigningKey(
+        kid=hashlib.sha256(data).digest()[:4],
+        secret=data,
+        hmac=hmac.new(data, digestmod=hashlib.sha256),
+        cipher=AESGCM(data),
+    )
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import cache
+
+from cache import keyed_cache
+
+
+@pytest.mark.asyncio
+async def test_keyed_cache():
+    calls = []
+
+    @keyed_cache(name='test_keyed_cache', maxsize=2)
+    async def find(a: str, b: bool = False) -> str:
+        calls.append((a, b))
+        return f'{a}-{b}'
+
+    assert await find('x') == 'x-False'
+    assert await find('x', b=False) == 'x-False'  # hit.
+    assert await find('y') == 'y-False'
+    assert len(calls) == 2
+
+    assert await find.invalidate('x')
+    assert not await find.invalidate('z')
+    assert await find('y') == 'y-False'  # still hit.
+    assert len(calls) == 2
+
+    await find('x')
+    await find('z')  # evict 'y'.
+    assert len(calls) == 4
+
+    assert find.invalidate_if(lambda v: v.startswith('z')) == 1
+    assert find.stats() == {
+        'size': 1,
+        'hits': 2,
+        'misses': 4,
+        'shared_hits': 0,
+        'shared_misses': 0,
+        'evictions': 1,
+        'invalidations': 2,
+    }
+
+
+@pytest.mark.asyncio
+async def test_keyed_cache_loading():
+    calls = []
+    release = asyncio.Event()
+
+    @keyed_cache(name='test_keyed_cache_loading')
+    async def find(a: str) -> str:
+        calls.append(a)
+        await release.wait()
+        return f'{a}-{len(calls)}'
+
+    # Concurrent misses of the same key are loaded once.
+    x1 = asyncio.ensure_future(find('x'))
+    x2 = asyncio.ensure_future(find('x'))
+    y = asyncio.ensure_future(find('y'))
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert calls == ['x', 'y']
+
+    # The invalidated one is not cached, the others still are.
+    await find.invalidate('x')
+    release.set()
+    assert await x1 == await x2 == 'x-2'
+    assert await y == 'y-2'
+
+    assert await find('y') == 'y-2'  # hit.
+    assert await find('x') == 'x-3'
+    assert calls == ['x', 'y', 'x']
+
+
+@pytest.mark.asyncio
+async def test_keyed_cache_shared(monkeypatch):
+    rds = _FakeRedis()
+    monkeypatch.setattr(cache, 'async_rds', rds)
+    monkeypatch.setattr(cache, 'get_script', lambda source: rds.set_if_generation)  # nopep8.
+
+    loaded = asyncio.Event()
+    release = asyncio.Event()
+
+    @keyed_cache(name='test_keyed_cache_shared', shared_ttl=600)
+    async def find(a: str) -> str:
+        loaded.set()
+        await release.wait()
+        return 'stale'
+
+    # Another worker invalidates while loading, so the stale value is not shared.
+    task = asyncio.ensure_future(find('x'))
+    await loaded.wait()
+    digest = find._digest('x')
+    await _invalidate_by_other_worker(rds, find, digest)
+    release.set()
+    assert await task == 'stale'
+    assert find._shared_key(digest) not in rds.data
+
+    # Loaded after invalidation, so shared.
+    find.clear()
+    assert await find('x') == 'stale'
+    assert find._shared_key(digest) in rds.data
+
+
+async def _invalidate_by_other_worker(rds: '_FakeRedis', find: cache.KeyedCache, digest: str):  # nopep8.
+    key = find._generation_key(digest)
+    rds.data[key] = str(int(rds.data.get(key, b'0')) + 1).encode()
+    rds.data.pop(find._shared_key(digest), None)
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data: dict[str, bytes] = {}
+
+    async def mget(self, *keys: str) -> list:
+        return [self.data.get(key) for key in keys]
+
+    async def set_if_generation(self, keys: list, args: list, client) -> int:
+        if self.data.get(keys[1], b'0') != args[0]:
+            return 0
+        self.data[keys[0]] = args[1]
+        return 1
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from werkzeug.exceptions import HTTPException
+
+import events
+
+from mongo.entitlements import Snapshot
+
+
+@pytest.mark.asyncio
+async def test_stream_entitlements(monkeypatch):
+    snapshots = [
+        Snapshot(version=1, etag='a', entitlements={}),
+        Snapshot(version=2, etag='a', entitlements={}),  # unchanged.
+        Snapshot(version=3, etag='b', entitlements={'license:k:false': {}}),
+    ]
+
+    async def get_entitlements(user_id: str) -> Snapshot:
+        snapshot = snapshots.pop(0)
+        if snapshot.version == 2:
+            events._notify(user_id)  # touched again while reading.
+        return snapshot
+
+    monkeypatch.setattr(events, 'get_entitlements', get_entitlements)
+
+    stream = events.stream_entitlements('user')
+    assert (await stream.__anext__()).startswith(b'retry:')
+    assert (await stream.__anext__()).startswith(b'id: a\nevent: entitlements\n')  # nopep8.
+
+    events._notify('user')
+    events._notify('user')  # coalesced.
+    chunk = await asyncio.wait_for(stream.__anext__(), 1)
+    assert chunk.startswith(b'id: b\n')
+    assert b'"license:k:false"' in chunk
+
+    await stream.aclose()
+    assert 'user' not in events._subscribers
+    assert events._connections == 0
+
+
+@pytest.mark.asyncio
+async def test_entitlements_limits(monkeypatch):
+    monkeypatch.setattr(events, '_MAX_CONNECTIONS', 5)
+
+    subscribers = [events._subscribe('user') for _ in range(events._MAX_USER_CONNECTIONS)]  # nopep8.
+    with pytest.raises(HTTPException) as e:
+        events.check_entitlements_limits('user')
+    assert e.value.code == 429
+
+    subscribers.append(events._subscribe('other'))
+    with pytest.raises(HTTPException) as e:
+        events.check_entitlements_limits('another')
+    assert e.value.code == 503
+
+    # Exceeded after checked, closed without registering.
+    stream = events.stream_entitlements('another')
+    assert (await stream.__anext__()).startswith(b'retry:')
+    with pytest.raises(StopAsyncIteration):
+        await stream.__anext__()
+    assert 'another' not in events._subscribers
+
+    for subscriber in subscribers:
+        events._unsubscribe(subscriber)
+    assert events._connections == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_entitlements_never_streamed():
+    # Checked, but the response is never streamed, e.g. disconnected.
+    events.check_entitlements_limits('user')
+    events.stream_entitlements('user')
+    assert events._connections == 0
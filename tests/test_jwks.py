@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import httpx
+import jwt
+import pytest
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from jwt.exceptions import PyJWKClientError
+
+from jwks import JWKSManager
+
+
+def _generate_jwk(kid: str) -> dict:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)  # nopep8.
+    jwk: dict = RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    jwk.update({'kid': kid, 'alg': 'RS256', 'use': 'sig'})
+    return jwk
+
+
+def _mock_transport(jwks: dict, requests: list) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(
+            status_code=200,
+            headers={'Cache-Control': 'public, max-age=3600'},
+            json=jwks,
+        )
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_get_signing_key():
+    requests = []
+    manager = JWKSManager(
+        uri='https://example.com/certs',
+        transport=_mock_transport({'keys': [_generate_jwk('k1')]}, requests),
+    )
+
+    key = await manager.get_signing_key('k1')
+    assert key.key_id == 'k1'
+
+    await manager.get_signing_key('k1')
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_unknown_kid_refetch_at_most_once():
+    requests = []
+    manager = JWKSManager(
+        uri='https://example.com/certs',
+        transport=_mock_transport({'keys': [_generate_jwk('k1')]}, requests),
+    )
+
+    results = await asyncio.gather(
+        *[manager.get_signing_key('unknown') for _ in range(10)],
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(r, PyJWKClientError) for r in results)
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_load_from_file(tmp_path):
+    path = tmp_path / 'certs.json'
+    path.write_text(json.dumps({'keys': [_generate_jwk('k1')]}))
+
+    manager = JWKSManager(uri=f'file://{path}')
+    key = await manager.get_signing_key('k1')
+
+    assert isinstance(key, jwt.PyJWK)
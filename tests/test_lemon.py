@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+import lemon
+
+from lemon import LemonSqueezyClient, activate_license
+from mongo.licenses import convert_license_to_response
+
+_LEMONSQUEEZY_API_KEY = 'test-api-key'
+
+# https://docs.lemonsqueezy.com/help/licensing/license-api#post-v1-licenses-activate
+_ACTIVATION = {
+    'activated': True,
+    'error': None,
+    'license_key': {
+        'id': 1,
+        'status': 'active',
+        'key': '38b1460a-5104-4067-a91d-77b872934d51',
+        'activation_limit': 1,
+        'activation_usage': 1,
+        'created_at': '2021-01-24T14:15:07.000000Z',
+        'expires_at': None,
+        'test_mode': False,
+    },
+    'instance': {
+        'id': '47596ad9-a811-4ebf-ac8a-03fc7b6d2a17',
+        'name': 'Test',
+        'created_at': '2021-04-06T14:15:07.000000Z',
+    },
+    'meta': {
+        'store_id': 1,
+        'order_id': 2,
+        'order_item_id': 3,
+        'product_id': 4,
+        'variant_id': 5,
+        'customer_id': 6,
+        'customer_name': 'Luke Skywalker',
+        'customer_email': 'luke@skywalker.com',
+    },
+}
+
+
+def _setup(monkeypatch, activation: dict) -> tuple[list, list]:
+    requests: list[httpx.Request] = []
+    inserted: list[dict] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path == '/v1/licenses/activate':
+            return httpx.Response(200, json=activation)
+        return httpx.Response(200, json={
+            'data': {'type': 'license-keys', 'id': '1'},
+        })
+
+    async def update_latest_license(license: dict):
+        inserted.append(license)
+
+    client = LemonSqueezyClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(lemon, '_lemonsqueezy', client)
+    monkeypatch.setattr(lemon, 'update_latest_license', update_latest_license)
+    return requests, inserted
+
+
+@pytest.mark.asyncio
+async def test_activate_license(monkeypatch):
+    requests, inserted = _setup(monkeypatch, _ACTIVATION)
+
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+    res = await activate_license(
+        license_key=_ACTIVATION['license_key']['key'],
+        instance_name='Test',
+        api_key=_LEMONSQUEEZY_API_KEY,
+    )
+
+    assert [r.url.path for r in requests] == ['/v1/licenses/activate']
+    assert inserted == [res]
+
+    assert res['data']['id'] == '1'
+    assert res['data']['attributes']['store_id'] == '1'
+
+    # Stamped with the activation time, not the instance's `created_at`.
+    updated_at = res['data']['attributes']['updated_at']
+    assert start <= updated_at <= datetime.now(timezone.utc)
+
+    response = convert_license_to_response(res)
+    assert response['available']
+    assert response['instances_count'] == 1
+    assert response['created_at'] == '2021-01-24T14:15:07Z'
+
+
+@pytest.mark.asyncio
+async def test_activate_license_without_retrieving(monkeypatch):
+    _setup(monkeypatch, _ACTIVATION)
+
+    async def retrieve_license(*args, **kwargs):
+        raise AssertionError('retrieve_license should not be called')
+
+    monkeypatch.setattr(lemon, 'retrieve_license', retrieve_license)
+
+    res = await activate_license(
+        license_key=_ACTIVATION['license_key']['key'],
+        instance_name='Test',
+        api_key=_LEMONSQUEEZY_API_KEY,
+    )
+    assert res['data']['attributes']['key'] == _ACTIVATION['license_key']['key']  # nopep8.
+
+
+@pytest.mark.asyncio
+async def test_activate_license_fallback_to_retrieve(monkeypatch):
+    activation = {'activated': True, 'license_key': {'id': 1}}
+    requests, inserted = _setup(monkeypatch, activation)
+
+    res = await activate_license(
+        license_key='...',
+        instance_name='...',
+        api_key=_LEMONSQUEEZY_API_KEY,
+    )
+
+    assert res['data']['id'] == '1'
+    assert inserted == [res]
+    assert [r.url.path for r in requests] == [
+        '/v1/licenses/activate',
+        '/v1/license-keys/1',
+    ]
+    assert all(r.url.host == 'api.lemonsqueezy.com' for r in requests)
@@ -0,0 +1,24 @@
+import logger
+
+from logger import _Body, mask
+
+
+def test_body_redacted():
+    body = b'{"license_key": "abc", "meta": {"key": "a\\"b"}, "name": "key"}'
+    assert str(_Body(body, 0)) == '{"license_key": "[REDACTED]", "meta": {"key": "[REDACTED]"}, "name": "key"}'  # nopep8.
+    assert str(_Body('0123456789', 4)) == '0123...(10 characters)'
+
+
+def test_log_body_errors_only(monkeypatch):
+    logged = []
+    monkeypatch.setattr(logger, '_BODY_MODE', 'errors')
+    monkeypatch.setattr(logger.logger, 'info', lambda *args, **kwargs: logged.append(args))  # nopep8.
+
+    logger.log_body('/api/licenses/activate', b'{}', status=200)
+    logger.log_body('/api/licenses/activate', b'{}', error=True, status=400)
+    assert len(logged) == 1
+
+
+def test_mask():
+    assert mask('80e15db5-c796-436b') == '****436b'
+    assert mask('short') == '****'
@@ -0,0 +1,76 @@
+import pytest
+
+from metrics import Counter, \
+    Gauge, \
+    Histogram, \
+    collector, \
+    merge_snapshots, \
+    render_metrics, \
+    snapshot_metrics
+
+
+@pytest.mark.asyncio
+async def test_render_metrics():
+    counter = Counter('test_requests_total', 'Requests.', ('route',))
+    counter.inc('/a')
+    counter.inc('/a', amount=2)
+    counter.inc('/"b"')
+
+    histogram = Histogram('test_duration_seconds', 'Duration.', buckets=(0.1, 1))  # nopep8.
+    histogram.observe(value=0.05)
+    histogram.observe(value=0.5)
+    histogram.observe(value=5)
+
+    @collector('test_size', 'Size.', 'gauge', ('cache',))
+    async def collect_size():
+        return {('c1',): 3}
+
+    lines = (await render_metrics()).splitlines()
+    assert '# TYPE test_requests_total counter' in lines
+    assert 'test_requests_total{route="/a"} 3' in lines
+    assert 'test_requests_total{route="/\\"b\\""} 1' in lines
+    assert 'test_duration_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="1"} 2' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_sum 5.55' in lines
+    assert 'test_duration_seconds_count 3' in lines
+    assert 'test_size{cache="c1"} 3' in lines
+
+    with pytest.raises(ValueError):
+        Counter('test_requests_total', 'Duplicated.')
+
+
+@pytest.mark.asyncio
+async def test_render_merged_metrics():
+    counter = Counter('test_merged_total', 'Merged.', ('route',))
+    gauge = Gauge('test_merged_connections', 'Summed.')
+    shared = Gauge('test_merged_pending', 'Shared.', merge='max')
+    histogram = Histogram('test_merged_seconds', 'Merged.', buckets=(1,))
+
+    counter.inc('/a', amount=2)
+    gauge.set(value=3)
+    shared.set(value=7)
+    histogram.observe(value=0.5)
+    worker = await snapshot_metrics()
+
+    # As same as another worker.
+    counter.inc('/a', amount=3)
+    counter.inc('/b')
+    gauge.set(value=4)
+    shared.set(value=5)
+    histogram.observe(value=2)
+    other = await snapshot_metrics()
+
+    lines = (await render_metrics([worker, other])).splitlines()
+    assert 'test_merged_total{route="/a"} 7' in lines
+    assert 'test_merged_total{route="/b"} 1' in lines
+    assert 'test_merged_connections 7' in lines
+    assert 'test_merged_pending 7' in lines
+    assert 'test_merged_seconds_bucket{le="1"} 2' in lines
+    assert 'test_merged_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_merged_seconds_sum 3' in lines
+
+    # Gauges of the exited workers are not kept.
+    retired = merge_snapshots([worker, other], cumulative=True)
+    assert retired['test_merged_total'] == [[['/a'], 7], [['/b'], 1]]
+    assert 'test_merged_connections' not in retired
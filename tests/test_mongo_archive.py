@@ -0,0 +1,130 @@
+import zlib
+
+import bson
+import pytest
+
+from mongo import archive
+from mongo import orders as mongo_orders
+from mongo.archive import _build_archive, slim_collection, slim_paths
+from mongo.db import orders, project_document
+from mongo.orders import _INDEXES, _SLIM_PATHS
+
+
+def test_slim_paths():
+    paths = slim_paths(_INDEXES, ['data.attributes.status'])
+
+    assert 'meta.custom_data.user_id' in paths
+    assert 'data.attributes.updated_at' in paths
+    assert 'data.attributes.status' in paths
+    assert 'data.id' in paths
+    assert paths == sorted(set(paths))
+
+
+def test_build_archive():
+    document = {
+        '_id': bson.ObjectId(),
+        'meta': {'event_name': 'order_created', 'custom_data': {'user_id': 'u'}},  # nopep8.
+        'data': {'id': '1', 'type': 'orders', 'links': {'self': '...'}},
+    }
+
+    archive = _build_archive(orders, document)
+    assert archive['_id'] == document['_id']
+    assert archive['collection'] == 'orders'
+    assert archive['data_id'] == '1'
+    assert bson.decode(zlib.decompress(archive['payload'])) == document
+
+    slim = project_document(document, _SLIM_PATHS)
+    assert 'links' not in slim['data']
+    assert slim['meta']['custom_data']['user_id'] == 'u'
+
+
+@pytest.mark.asyncio
+async def test_insert_order_slim(monkeypatch):
+    archives, history, latest = _FakeBatcher(), _FakeBatcher(), _FakeBatcher()
+    invalidated = []
+
+    async def invalidate(*args):
+        invalidated.append(args)
+
+    monkeypatch.setattr(mongo_orders, 'SLIM_STORAGE', True)
+    monkeypatch.setattr(archive, '_archive_batcher', archives)
+    monkeypatch.setattr(mongo_orders, '_batcher', history)
+    monkeypatch.setattr(mongo_orders, '_latest_batcher', latest)
+    monkeypatch.setattr(mongo_orders.find_latest_order, 'invalidate', invalidate)  # nopep8.
+
+    order = _order('1')
+    await mongo_orders.insert_order(order)
+
+    # The whole payload is archived, by the same `_id` as the slim one.
+    [payload] = archives.documents
+    [slim] = history.documents
+    assert payload['_id'] == slim['_id']
+    assert bson.decode(zlib.decompress(payload['payload'])) == order
+
+    assert slim['archived']
+    assert 'links' not in slim['data']
+    assert slim['data']['attributes']['status'] == 'paid'
+    assert len(latest.documents) == 1
+    assert invalidated == [mongo_orders._entity_key(order)]
+
+
+@pytest.mark.asyncio
+async def test_slim_collection_idempotent(monkeypatch):
+    collection = _FakeCollection([_order('1'), _order('2'), _order('3')])
+    webhook_archive = _FakeCollection([])
+    monkeypatch.setattr(archive, 'webhook_archive', webhook_archive)
+
+    assert await slim_collection(collection, _SLIM_PATHS, batch_size=2) == 3
+    archived = dict(webhook_archive.documents)
+
+    # Run again, e.g. after interrupted, nothing left to convert,
+    # and the archived whole payloads are not replaced by the slim ones.
+    assert await slim_collection(collection, _SLIM_PATHS, batch_size=2) == 0
+    assert webhook_archive.documents == archived
+    for document in collection.documents.values():
+        assert document['archived']
+        assert 'links' not in document['data']
+        payload = bson.decode(zlib.decompress(archived[document['_id']]['payload']))  # nopep8.
+        assert payload['data']['links']
+
+
+def _order(order_id: str) -> dict:
+    return {
+        '_id': bson.ObjectId(),
+        'meta': {'event_name': 'order_created', 'custom_data': {'user_id': 'u'}},  # nopep8.
+        'data': {
+            'id': order_id,
+            'type': 'orders',
+            'attributes': {'store_id': '1', 'status': 'paid'},
+            'links': {'self': '...'},
+        },
+    }
+
+
+class _FakeBatcher:
+    def __init__(self):
+        self.documents = []
+
+    async def write(self, document: dict):
+        self.documents.append(document)
+
+
+class _FakeCollection:
+    name = 'orders'
+
+    def __init__(self, documents: list[dict]):
+        self.documents = {d['_id']: d for d in documents}
+
+    def find(self, query: dict, batch_size: int = 0):
+        assert query == {'archived': {'$ne': True}}
+        return _iterate([d for d in self.documents.values() if not d.get('archived')])  # nopep8.
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        for operation in operations:
+            document = operation._doc
+            self.documents[document['_id']] = document
+
+
+async def _iterate(documents: list[dict]):
+    for document in documents:
+        yield document
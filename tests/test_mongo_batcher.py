@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from mongo.batcher import WriteBatcher, insert_or_replace
+
+
+class _FakeCollection:
+    name = 'fake'
+
+    def __init__(self, failed: dict[str, int] = {}):
+        self.batches: list[list[str]] = []
+        self._failed = failed  # document name -> error code.
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        names = [op._doc['name'] for op in operations]
+        self.batches.append(names)
+
+        errors = [
+            {'index': i, 'code': self._failed[n], 'errmsg': '...'}
+            for i, n in enumerate(names) if n in self._failed
+        ]
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+
+@pytest.mark.asyncio
+async def test_write_batcher_preserves_entity_order():
+    collection = _FakeCollection()
+    batcher = WriteBatcher(collection, entity_key=lambda d: d['entity'])
+
+    await asyncio.gather(
+        batcher.write({'name': 'a1', 'entity': 'a'}),
+        batcher.write({'name': 'b1', 'entity': 'b'}),
+        batcher.write({'name': 'a2', 'entity': 'a'}),
+        batcher.write({'name': 'c1', 'entity': 'c'}),
+    )
+
+    assert collection.batches == [['a1', 'b1'], ['a2', 'c1']]
+
+
+@pytest.mark.asyncio
+async def test_write_batcher_errors():
+    collection = _FakeCollection(failed={'b': 11000, 'c': 121})
+    batcher = WriteBatcher(collection, ignored_codes=frozenset({11000}))
+
+    results = await asyncio.gather(
+        batcher.write({'name': 'a'}),
+        batcher.write({'name': 'b'}),
+        batcher.write({'name': 'c'}),
+        return_exceptions=True,
+    )
+
+    assert collection.batches == [['a', 'b', 'c']]
+    assert results[0] is None
+    assert results[1] is None  # ignored.
+    assert isinstance(results[2], BulkWriteError)
+
+
+def test_insert_or_replace():
+    assert isinstance(insert_or_replace({'name': 'a'}), InsertOne)
+
+    # Retrying the same webhook replaces its history instead of inserting.
+    operation = insert_or_replace({'_id': 'order_created:1', 'name': 'a'})
+    assert isinstance(operation, ReplaceOne)
+    assert operation._filter == {'_id': 'order_created:1'}
+    assert operation._upsert
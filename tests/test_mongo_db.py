@@ -1,7 +1,25 @@
 from datetime import datetime
 
-from mongo.db import convert_id_to_str_in_json, \
-    convert_at_to_datetime_in_json
+import pytest
+
+from dateutil import parser
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import mongo.db
+
+from mongo.db import DUPLICATE_KEY_ERROR, \
+    INDEX_NOT_FOUND_ERROR, \
+    _collect_stages, \
+    apply_indexes, \
+    convert_id_to_str_in_json, \
+    convert_at_to_datetime_in_json, \
+    convert_datetime_to_isoformat_with_z, \
+    ensure_unique_indexes, \
+    normalize_json, \
+    parse_iso8601, \
+    project_document, \
+    upsert_latest
 
 
 def test_convert_id_to_str_in_json():
@@ -42,3 +60,194 @@ def test_convert_at_to_datetime_in_json():
     assert isinstance(data['l'][0]['d']['t1_at'], datetime)
     assert isinstance(data['l'][0]['d']['t2_at'], int)
     assert isinstance(data['l'][0]['d']['t3_at'], str)
+
+
+def test_collect_stages():
+    plan = {
+        'stage': 'LIMIT',
+        'inputStage': {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'IXSCAN', 'indexName': '...'},
+        },
+    }
+
+    assert set(_collect_stages(plan)) == {'LIMIT', 'FETCH', 'IXSCAN'}
+
+
+def test_project_document():
+    data = {
+        'meta': {'event_name': 'order_created'},
+        'data': {
+            'id': '1',
+            'attributes': {'status': 'paid', 'identifier': '...'},
+            'links': {'self': '...'},
+        },
+    }
+
+    res = project_document(data, [
+        'meta.custom_data.user_id',
+        'data.id',
+        'data.attributes.status',
+    ])
+
+    assert res == {
+        'meta': {'custom_data': {'user_id': None}},
+        'data': {'id': '1', 'attributes': {'status': 'paid'}},
+    }
+
+
+def test_normalize_json():
+    data = {
+        'id': 1,
+        'l': [{
+            'd': {
+                '_id': 1,
+                'uid': 2,
+                't1': '2023-01-17T12:26:23.000000Z',
+                't1_at': '2023-01-17T12:26:23.000000Z',
+                't2_at': 1691487612,
+                't3_at': '...',
+            },
+        }, [{'order_id': 3}]],
+    }
+
+    normalize_json(data)
+
+    assert data['id'] == '1'
+    assert data['l'][0]['d']['_id'] == '1'
+    assert data['l'][1][0]['order_id'] == '3'
+    assert isinstance(data['l'][0]['d']['uid'], int)
+    assert isinstance(data['l'][0]['d']['t1'], str)
+    assert isinstance(data['l'][0]['d']['t1_at'], datetime)
+    assert isinstance(data['l'][0]['d']['t2_at'], int)
+    assert isinstance(data['l'][0]['d']['t3_at'], str)
+
+
+def test_parse_iso8601():
+    dt = parse_iso8601('2023-01-17T12:26:23.000000Z')
+    assert dt == parser.isoparse('2023-01-17T12:26:23.000000Z')
+    assert convert_datetime_to_isoformat_with_z(dt) == '2023-01-17T12:26:23Z'
+
+    dt = parse_iso8601('2023-01-17T12:26:23+08:00')
+    assert dt == parser.isoparse('2023-01-17T12:26:23+08:00')
+
+    dt = parse_iso8601('20230117T122623Z')  # fallback to dateutil.
+    assert dt == parser.isoparse('20230117T122623Z')
+
+    assert parse_iso8601('...') is None
+    assert parse_iso8601('2023-13-17T12:26:23.000000Z') is None
+
+    memo = {}
+    parse_iso8601('2023-01-17T12:26:23.000000Z', memo)
+    assert '2023-01-17T12:26:23.000000Z' in memo
+
+
+@pytest.mark.asyncio
+async def test_upsert_latest():
+    keys = [('data.id', ASCENDING)]
+    latest = _FakeLatest()
+
+    def state(updated_at: datetime, status: str) -> dict:
+        return {'data': {'id': '1', 'attributes': {'updated_at': updated_at, 'status': status}}}  # nopep8.
+
+    await upsert_latest(latest, keys, state(datetime(2023, 1, 2), 'paid'))
+    assert latest.status() == 'paid'
+
+    # The older one is ignored, by the duplicate key error of upserting.
+    await upsert_latest(latest, keys, state(datetime(2023, 1, 1), 'pending'))
+    assert latest.status() == 'paid'
+
+    # The same or newer one replaces.
+    await upsert_latest(latest, keys, state(datetime(2023, 1, 2), 'refunded'))
+    assert latest.status() == 'refunded'
+    await upsert_latest(latest, keys, state(datetime(2023, 1, 3), 'paid'))
+    assert latest.status() == 'paid'
+
+    # Other errors are raised.
+    latest.error_code = 121
+    with pytest.raises(BulkWriteError):
+        await upsert_latest(latest, keys, state(datetime(2023, 1, 4), 'paid'))
+
+
+# A collection with the unique index on "data.id".
+class _FakeLatest:
+    def __init__(self):
+        self.documents: dict[str, dict] = {}
+        self.error_code = 0
+
+    def status(self) -> str:
+        [document] = self.documents.values()
+        return document['data']['attributes']['status']
+
+    async def bulk_write(self, operations: list[ReplaceOne]):
+        [operation] = operations
+        query, document = operation._filter, operation._doc
+        if self.error_code:
+            raise BulkWriteError({'writeErrors': [{'code': self.error_code}]})
+
+        current = self.documents.get(query['data.id'])
+        if current is None:
+            self.documents[query['data.id']] = document
+            return
+
+        updated_at = current['data']['attributes']['updated_at']
+        if updated_at <= query['data.attributes.updated_at']['$lte']:
+            self.documents[query['data.id']] = document
+            return
+
+        # Not matched, so upserting violates the unique index.
+        raise BulkWriteError({'writeErrors': [{'code': DUPLICATE_KEY_ERROR}]})
+
+
+@pytest.mark.asyncio
+async def test_apply_indexes(monkeypatch):
+    applied = _FakeApplied()
+    monkeypatch.setattr(mongo.db, 'applied_indexes', applied)
+
+    collection = _FakeIndexed({'_id_', 'legacy_1', 'operator_1'})
+    await apply_indexes(collection, [([('a', ASCENDING)], {}), ([('b', ASCENDING)], {})], ['legacy_1'])  # nopep8.
+    assert collection.names == {'_id_', 'a_1', 'b_1', 'operator_1'}
+
+    # Only the applied ones are dropped, dropped by others concurrently is fine.
+    collection.names.discard('b_1')
+    await apply_indexes(collection, [([('a', ASCENDING)], {})])
+    assert collection.names == {'_id_', 'a_1', 'operator_1'}
+    assert applied.documents['test'] == {'names': ['a_1']}
+
+
+@pytest.mark.asyncio
+async def test_ensure_unique_indexes():
+    collection = _FakeIndexed({'_id_'})
+    await ensure_unique_indexes(collection, [
+        ([('a', ASCENDING), ('b', ASCENDING)], {'unique': True}),
+        ([('c', ASCENDING)], {}),
+    ])
+    assert collection.names == {'_id_', 'a_1_b_1'}
+
+
+class _FakeIndexed:
+    name = 'test'
+
+    def __init__(self, names: set[str]):
+        self.names = names
+
+    async def create_index(self, keys: list, background: bool, **options) -> str:  # nopep8.
+        name = '_'.join(f'{path}_{direction}' for path, direction in keys)
+        self.names.add(name)
+        return name
+
+    async def drop_index(self, name: str):
+        if name not in self.names:
+            raise OperationFailure('index not found', INDEX_NOT_FOUND_ERROR)
+        self.names.remove(name)
+
+
+class _FakeApplied:
+    def __init__(self):
+        self.documents: dict[str, dict] = {}
+
+    async def find_one(self, query: dict):
+        return self.documents.get(query['_id'])
+
+    async def replace_one(self, query: dict, document: dict, upsert: bool):
+        self.documents[query['_id']] = document
@@ -0,0 +1,51 @@
+import pytest
+
+from mongo import entitlements
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    async def incr(self, key: str) -> int:
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    async def mget(self, *keys: str) -> list:
+        return [self.data.get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, ex: int = 0):
+        self.data[key] = value
+
+    async def publish(self, channel: str, message: str):
+        self.published.append((channel, message))
+
+
+def test_entitlement_key():
+    assert entitlements.entitlement_key('order', ('1', '2', '3', False)) == 'order:1:2:3:false'  # nopep8.
+    assert entitlements.entitlement_key('license', ('key', True)) == 'license:key:true'  # nopep8.
+
+
+@pytest.mark.asyncio
+async def test_get_entitlements(monkeypatch):
+    computed = []
+
+    async def compute_snapshot(user_id: str, version: int):
+        computed.append(version)
+        return entitlements.Snapshot(version, f'etag{len(computed)}', {})
+
+    rds = _FakeRedis()
+    monkeypatch.setattr(entitlements, 'async_rds', rds)
+    monkeypatch.setattr(entitlements, '_compute_snapshot', compute_snapshot)
+
+    # Computed once, then served from the snapshot.
+    assert (await entitlements.get_entitlements('user')).etag == 'etag1'
+    assert (await entitlements.get_entitlements('user')).etag == 'etag1'
+    assert computed == [0]
+
+    # Recomputed and published on touch.
+    await entitlements.touch_entitlements('user')
+    assert rds.published == [(entitlements.ENTITLEMENTS_CHANNEL, 'user')]
+    assert (await entitlements.get_entitlements('user')).etag == 'etag2'
+    assert computed == [0, 1]
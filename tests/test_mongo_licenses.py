@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+
+from pymongo.errors import DuplicateKeyError
+
+from mongo import licenses
+
+
+@pytest.mark.asyncio
+async def test_update_latest_license(monkeypatch):
+    latest = _FakeLatest({'meta': {'custom_data': {'user_id': 'user'}}})
+    monkeypatch.setattr(licenses, 'latest_licenses', latest)
+
+    updated_at = datetime(2023, 1, 1)
+    license = {
+        'data': {
+            'id': '1',
+            'attributes': {
+                'key': 'key',
+                'test_mode': False,
+                'status': 'active',
+                'instances_count': 1,
+                'updated_at': updated_at,
+            },
+        },
+    }
+
+    assert await licenses.update_latest_license(license) == 'user'
+    query, update = latest.calls[0]
+    assert query == {
+        'data.attributes.key': 'key',
+        'data.attributes.test_mode': False,
+        'data.attributes.updated_at': {'$lte': updated_at},
+    }
+
+    # Only the `data` is updated, the `meta` from webhooks is kept.
+    assert update['$set']['synthetic']
+    assert update['$set']['data.attributes.instances_count'] == 1
+    assert not any(path.startswith('meta.') for path in update['$set'])
+
+    # Missing in the API response, not overwriting the ones from webhooks.
+    assert 'data.attributes.store_id' not in update['$set']
+    assert update['$setOnInsert']['data.attributes.store_id'] is None
+
+    # Not newer than the latest state.
+    latest.error = DuplicateKeyError('duplicated')
+    assert await licenses.update_latest_license(license) is None
+
+
+class _FakeLatest:
+    def __init__(self, document: dict):
+        self.document = document
+        self.calls = []
+        self.error = None
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs) -> dict:  # nopep8.
+        self.calls.append((query, update))
+        if self.error:
+            raise self.error
+        return self.document
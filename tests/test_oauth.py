@@ -1,6 +1,19 @@
+import json
 import time
 import uuid
 
+from base64 import b64encode
+
+import jwt
+import pytest
+
+from Crypto.Cipher import AES
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+import oauth
+
+from jwks import JWKSManager
 from oauth import generate_user_token, decrypt_user_token
 
 # Make sure that secret is a **16 characters length** string.
@@ -32,3 +45,63 @@ def test_decrypt_user_token():
 
     assert info.user_id == user_id
     assert info.generate_timestamp == timestamp
+
+
+def test_decrypt_legacy_user_token():
+    info = json.dumps({'user_id': 'user', 'generate_timestamp': 1}).encode()
+    cipher = AES.new(_LEMONSQUEEZY_SIGNING_SECRET.encode(), AES.MODE_EAX)
+    ciphertext, tag = cipher.encrypt_and_digest(info)
+    token = b64encode(json.dumps({
+        'ciphertext': b64encode(ciphertext).decode(),
+        'tag': b64encode(tag).decode(),
+        'nonce': b64encode(cipher.nonce).decode(),
+    }).encode()).decode()
+
+    info = decrypt_user_token(token, _LEMONSQUEEZY_SIGNING_SECRET)
+    assert info.user_id == 'user'
+    assert info.generate_timestamp == 1
+
+
+def test_decrypt_tampered_user_token():
+    token = generate_user_token('user', 1, _LEMONSQUEEZY_SIGNING_SECRET)
+    tampered = token[:-2] + ('A' if token[-2] != 'A' else 'B') + token[-1]
+
+    with pytest.raises(Exception):
+        decrypt_user_token(tampered, _LEMONSQUEEZY_SIGNING_SECRET)
+    with pytest.raises(ValueError):
+        decrypt_user_token(token, 'fedcba9876543210')  # another key id.
+
+
+@pytest.mark.asyncio
+async def test_decode_google_oauth_credential(monkeypatch):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)  # nopep8.
+    jwk: dict = RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+    jwk.update({'kid': 'k1', 'alg': 'RS256'})
+
+    jwks = JWKSManager(uri='https://example.com/certs')
+    jwks._keys = {'k1': jwt.PyJWK(jwk)}
+    jwks._expire_at = time.monotonic() + 60
+    monkeypatch.setattr(oauth, '_google_jwks', jwks)
+
+    credential = jwt.encode(
+        payload={
+            'iss': 'https://accounts.google.com',
+            'aud': 'client-2',
+            'email': 'someone@example.com',
+        },
+        key=private_key,
+        algorithm='RS256',
+        headers={'kid': 'k1'},
+    )
+
+    payload = await oauth._decode_google_oauth_credential(
+        credential=credential,
+        client_ids=frozenset({'client-1', 'client-2', 'client-3'}),
+    )
+    assert payload['email'] == 'someone@example.com'
+
+    with pytest.raises(jwt.InvalidAudienceError):
+        await oauth._decode_google_oauth_credential(
+            credential=credential,
+            client_ids=frozenset({'client-1'}),
+        )
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+import redis
+
+from werkzeug.exceptions import HTTPException
+
+import ratelimit
+
+from ratelimit import RateLimiter, _LocalTokenBucket, parse_retry_after
+
+
+def test_local_token_bucket():
+    bucket = _LocalTokenBucket(capacity=2, rate=1)
+
+    assert bucket.reserve(max_wait=10) == 0
+    assert bucket.reserve(max_wait=10) == 0
+    assert 0 < bucket.reserve(max_wait=10) <= 1  # reserved.
+    assert bucket.reserve(max_wait=1) == -1  # rejected.
+
+    bucket.penalize(30)
+    assert bucket.reserve(max_wait=10) == -1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('5') == 5
+    assert parse_retry_after(None, default=60) == 60
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', default=60) == 60
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_max_waiting(monkeypatch):
+    limiter = RateLimiter('test_max_waiting', limit=60, max_waiting=2)
+    release = asyncio.Event()
+
+    async def reserve() -> float:
+        await release.wait()
+        return 0
+
+    monkeypatch.setattr(limiter, '_reserve', reserve)
+
+    # The reserving ones are counted, so the third one is rejected at once.
+    tasks = [asyncio.ensure_future(limiter.acquire()) for _ in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as e:
+        await limiter.acquire()
+    assert e.value.code == 429
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert limiter.stats()['waiting'] == 0
+    assert limiter.stats()['acquired'] == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_fallback(monkeypatch):
+    def get_script(source: str):
+        async def script(**kwargs):
+            raise redis.ConnectionError('unavailable')
+        return script
+
+    monkeypatch.setattr(ratelimit, 'get_script', get_script)
+
+    # A quarter of the limit per worker.
+    limiter = RateLimiter('test_fallback', limit=8, max_wait=0, workers=4)
+    for _ in range(2):
+        await limiter.acquire()
+    with pytest.raises(HTTPException):
+        await limiter.acquire()
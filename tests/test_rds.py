@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import rds
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('current, expected', [
+    ('', '$Kgs'),
+    ('AE', 'AEK'),  # "A" doesn't include "K".
+    ('KA', None),
+    ('K$sgE', None),
+    ('Ex', '$EKgsx'),
+])
+async def test_enable_keyspace_notifications(monkeypatch, current: str, expected: str):  # nopep8.
+    fake = _FakeRedis()
+    fake.config = current
+    monkeypatch.setattr(rds, 'async_rds', fake)
+
+    await rds._enable_keyspace_notifications()
+    assert fake.config_set_value == expected
+
+
+@pytest.mark.asyncio
+async def test_secrets_cache(monkeypatch):
+    fake = _FakeRedis()
+    fake.values[rds.LEMONSQUEEZY_API_KEY] = b'old'
+    monkeypatch.setattr(rds, 'async_rds', fake)
+    monkeypatch.setattr(rds, '_secrets', {})
+    monkeypatch.setattr(rds, '_fetch_secret_blocking', lambda key: 'blocking')
+
+    # Not loaded yet, fetched by blocking.
+    assert rds.get_str_from_rds(rds.LEMONSQUEEZY_API_KEY) == 'blocking'
+
+    # Loaded, served in process.
+    await rds._reload_secret(rds.LEMONSQUEEZY_API_KEY)
+    assert rds.get_str_from_rds(rds.LEMONSQUEEZY_API_KEY) == 'old'
+
+    # Expired, return the stale value, and reload in background.
+    fake.values[rds.LEMONSQUEEZY_API_KEY] = b'new'
+    value, _ = rds._secrets[rds.LEMONSQUEEZY_API_KEY]
+    rds._secrets[rds.LEMONSQUEEZY_API_KEY] = (value, 0)
+    assert rds.get_str_from_rds(rds.LEMONSQUEEZY_API_KEY) == 'old'
+    await asyncio.sleep(0)
+    assert rds.get_str_from_rds(rds.LEMONSQUEEZY_API_KEY) == 'new'
+
+
+@pytest.mark.asyncio
+async def test_listen_secrets(monkeypatch):
+    fake = _FakeRedis()
+    fake.config = 'KA'
+    fake.values[rds.LEMONSQUEEZY_API_KEY] = b'old'
+    monkeypatch.setattr(rds, 'async_rds', fake)
+    monkeypatch.setattr(rds, '_secrets', {})
+
+    await rds._reload_secret(rds.LEMONSQUEEZY_API_KEY)
+    listener = asyncio.create_task(rds._listen_secrets())
+
+    # Changed, reloaded by the keyspace notification before expired.
+    fake.values[rds.LEMONSQUEEZY_API_KEY] = b'new'
+    await fake.messages.put({
+        'type': 'pmessage',
+        'channel': f'__keyspace@0__:{rds.LEMONSQUEEZY_API_KEY}'.encode(),
+    })
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    listener.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await listener
+
+    assert rds.get_str_from_rds(rds.LEMONSQUEEZY_API_KEY) == 'new'
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.config = ''
+        self.config_set_value = None
+        self.values: dict[str, bytes] = {}
+        self.messages: asyncio.Queue = asyncio.Queue()
+
+    async def config_get(self, name: str) -> dict:
+        return {name: self.config}
+
+    async def config_set(self, name: str, value: str):
+        self.config_set_value = value
+
+    async def get(self, key: str):
+        return self.values.get(key)
+
+    def pubsub(self) -> '_FakePubSub':
+        return _FakePubSub(self.messages)
+
+
+class _FakePubSub:
+    def __init__(self, messages: asyncio.Queue):
+        self._messages = messages
+
+    async def __aenter__(self) -> '_FakePubSub':
+        return self
+
+    async def __aexit__(self, *args):
+        pass  # DO NOTHING.
+
+    async def psubscribe(self, *channels: str):
+        pass  # DO NOTHING.
+
+    async def listen(self):
+        while True:
+            yield await self._messages.get()
@@ -0,0 +1,96 @@
+import time
+
+import orjson
+import pytest
+
+import shared_metrics
+
+from metrics import Counter, Gauge
+
+_requests = Counter('test_shared_requests_total', 'Requests.')
+_connections = Gauge('test_shared_connections', 'Connections.')
+
+
+@pytest.mark.asyncio
+async def test_render_shared_metrics(monkeypatch):
+    fake = _FakeRedis()
+    monkeypatch.setattr(shared_metrics, 'async_rds', fake)
+    fake.hash['a'] = _entry(time.time(), 1, 1)
+    fake.hash['b'] = _entry(0, 2, 1)  # stale.
+
+    async def snapshot_metrics():
+        return _snapshot(4, 1)
+
+    monkeypatch.setattr(shared_metrics, 'snapshot_metrics', snapshot_metrics)
+    monkeypatch.setattr(shared_metrics, '_worker', lambda: 'c')
+
+    # Merged from all workers, the stale one is retired without its gauges.
+    lines = (await shared_metrics.render_shared_metrics()).splitlines()
+    assert 'test_shared_requests_total 7' in lines
+    assert 'test_shared_connections 2' in lines
+    assert set(fake.hash) == {'a', 'c', shared_metrics._RETIRED}
+
+    # Exited, the counters are still monotonic.
+    await shared_metrics._retire('c')
+    await shared_metrics._retire('c')  # retired already.
+    monkeypatch.setattr(shared_metrics, '_worker', lambda: 'a')
+    lines = (await shared_metrics.render_shared_metrics()).splitlines()
+    assert 'test_shared_requests_total 10' in lines  # nopep8; 2 + 4 retired, 4 of "a".
+    assert 'test_shared_connections 1' in lines
+    assert set(fake.hash) == {'a', shared_metrics._RETIRED}
+
+
+def _snapshot(requests: int, connections: int) -> dict:
+    return {
+        'test_shared_requests_total': [[[], requests]],
+        'test_shared_connections': [[[], connections]],
+    }
+
+
+def _entry(at: float, requests: int, connections: int) -> bytes:
+    return orjson.dumps({'at': at, 'snapshot': _snapshot(requests, connections)})  # nopep8.
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.hash: dict[str, bytes] = {}
+
+    async def hset(self, key: str, field: str, value: bytes):
+        self.hash[field] = value
+
+    async def hgetall(self, key: str) -> dict:
+        return {field.encode(): value for field, value in self.hash.items()}
+
+    def pipeline(self, transaction: bool):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, rds: _FakeRedis):
+        self._rds = rds
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def watch(self, key: str):
+        pass
+
+    async def hmget(self, key: str, fields: list[str]) -> list:
+        return [self._rds.hash.get(field) for field in fields]
+
+    def multi(self):
+        self._commands = []
+
+    def hset(self, key: str, field: str, value: bytes):
+        self._commands.append(lambda: self._rds.hash.update({field: value}))
+
+    def hdel(self, key: str, field: str):
+        self._commands.append(lambda: self._rds.hash.pop(field, None))
+
+    async def execute(self):
+        for command in self._commands:
+            command()
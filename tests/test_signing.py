@@ -0,0 +1,38 @@
+import pytest
+
+from oauth import generate_user_token, decrypt_user_token, _decrypt_user_token
+from signing import _build_keyring
+
+_OLD_SECRET = '0123456789abcdef'
+_NEW_SECRET = 'fedcba9876543210'
+
+
+def test_keyring_verify():
+    old = _build_keyring(_OLD_SECRET, frozenset())
+    new = _build_keyring(_NEW_SECRET, frozenset({_OLD_SECRET, 'too short'}))
+
+    body = b'{"meta": {}}'
+    signature = old.active.sign(body)
+
+    assert list(new.keys) == [new.active.kid, old.active.kid]
+    assert new.verify(body, signature)
+    assert not new.verify(body + b' ', signature)
+    assert not _build_keyring(_NEW_SECRET, frozenset()).verify(body, signature)  # nopep8.
+
+
+def test_keyring_decrypt_user_token():
+    token = generate_user_token('user', 1, _OLD_SECRET)
+
+    keyring = _build_keyring(_NEW_SECRET, frozenset({_OLD_SECRET}))
+    assert _decrypt_user_token(token, keyring).user_id == 'user'
+
+    # The new tokens are encrypted by the active key.
+    token = generate_user_token('user', 1, _NEW_SECRET)
+    assert decrypt_user_token(token, _NEW_SECRET).user_id == 'user'
+    with pytest.raises(ValueError):
+        decrypt_user_token(token, _OLD_SECRET)
+
+
+def test_signing_key_repr():
+    key = _build_keyring(_OLD_SECRET, frozenset()).active
+    assert _OLD_SECRET not in repr(key)
@@ -0,0 +1,262 @@
+import asyncio
+import fcntl
+
+from datetime import datetime
+
+import orjson
+import pytest
+import redis
+
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import UpdateResult
+
+import webhooks
+
+from lemon import Event
+
+
+@pytest.mark.asyncio
+async def test_process_webhook(monkeypatch):
+    dispatched = []
+
+    async def dispatch_event(event: Event, body: dict):
+        dispatched.append((event, body))
+
+    monkeypatch.setattr(webhooks, 'dispatch_event', dispatch_event)
+    monkeypatch.setattr(webhooks, 'webhook_events', _FakeEvents())
+
+    data = orjson.dumps({
+        'meta': {'event_name': 'order_created'},
+        'data': {'id': 1, 'attributes': {'updated_at': '2023-01-17T12:26:23.000000Z'}},  # nopep8.
+    })
+    await webhooks.process_webhook('order_created', data)
+
+    event, body = dispatched[0]
+    assert event == Event.ORDER_CREATED
+    assert body['data']['id'] == '1'
+    assert isinstance(body['data']['attributes']['updated_at'], datetime)
+
+    # The history is written by the event identity.
+    assert body['_id'] == 'order_created:1:2023-01-17T12:26:23+00:00'
+
+
+@pytest.mark.asyncio
+async def test_process_webhook_duplicated(monkeypatch):
+    dispatched = []
+
+    async def dispatch_event(event: Event, body: dict):
+        dispatched.append(event)
+        if len(dispatched) == 1:
+            raise RuntimeError('failed')
+
+    events = _FakeEvents()
+    monkeypatch.setattr(webhooks, 'dispatch_event', dispatch_event)
+    monkeypatch.setattr(webhooks, 'webhook_events', events)
+
+    data = orjson.dumps({
+        'meta': {'event_name': 'order_created'},
+        'data': {'id': 1, 'attributes': {'updated_at': '2023-01-17T12:26:23.000000Z'}},  # nopep8.
+    })
+
+    # The failed one is retryable, the processed one is dropped.
+    with pytest.raises(RuntimeError):
+        await webhooks.process_webhook('order_created', data, 'sig1')
+    await webhooks.process_webhook('order_created', data, 'sig1')
+    await webhooks.process_webhook('order_created', data, 'sig2')
+
+    assert len(dispatched) == 2
+    assert list(events.ids) == ['order_created:1:2023-01-17T12:26:23+00:00']
+
+
+@pytest.mark.asyncio
+async def test_process_webhook_cancelled(monkeypatch):
+    dispatched = []
+
+    async def dispatch_event(event: Event, body: dict):
+        dispatched.append(event)
+        if len(dispatched) == 1:
+            raise asyncio.CancelledError()
+
+    events = _FakeEvents()
+    monkeypatch.setattr(webhooks, 'dispatch_event', dispatch_event)
+    monkeypatch.setattr(webhooks, 'webhook_events', events)
+
+    data = orjson.dumps({
+        'meta': {'event_name': 'order_created'},
+        'data': {'id': 1, 'attributes': {'updated_at': '2023-01-17T12:26:23.000000Z'}},  # nopep8.
+    })
+
+    # The cancelled one is released, so the retry is dispatched.
+    with pytest.raises(asyncio.CancelledError):
+        await webhooks.process_webhook('order_created', data, 'sig1')
+    await webhooks.process_webhook('order_created', data, 'sig1')
+    assert len(dispatched) == 2
+
+    # The claim of a crashed one is taken over after expired.
+    identity = 'order_created:2:2023-01-17T12:26:23+00:00'
+    assert await webhooks._claim_event(identity)
+    assert not await webhooks._claim_event(identity)
+    events.documents[identity]['expire_at'] = datetime(2000, 1, 1)
+    assert await webhooks._claim_event(identity)
+
+    # The done one is never taken over.
+    done = 'order_created:1:2023-01-17T12:26:23+00:00'
+    events.documents[done]['expire_at'] = datetime(2000, 1, 1)
+    assert not await webhooks._claim_event(done)
+
+
+@pytest.mark.asyncio
+async def test_enqueue_webhook_unmark(monkeypatch, tmp_path):
+    rds = _BrokenRedis()
+    monkeypatch.setattr(webhooks, 'async_rds', rds)
+    monkeypatch.setattr(webhooks, '_SPOOL_DIR', str(tmp_path / 'missing'))
+
+    def append_spool(fields: dict):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(webhooks, '_append_spool', append_spool)
+
+    # Neither queued nor spooled, so unmarked for the retried delivery.
+    with pytest.raises(OSError):
+        await webhooks.enqueue_webhook(Event.ORDER_CREATED, b'{}', 'sig')
+    assert rds.seen == set()
+
+
+def test_event_identity():
+    body = {'data': {'id': '1', 'attributes': {}}}
+    assert webhooks._event_identity('order_created', body, 'sig') == 'order_created:sig'  # nopep8.
+
+
+def test_append_spool(monkeypatch, tmp_path):
+    monkeypatch.setattr(webhooks, '_SPOOL_DIR', str(tmp_path))
+
+    webhooks._append_spool({'event': 'order_created', 'body': b'{"a": 1}', 'signature': 'a'})  # nopep8.
+    webhooks._append_spool({'event': 'order_refunded', 'body': b'{\n"b": 2\n}', 'signature': 'b'})  # nopep8.
+
+    [path] = list(tmp_path.iterdir())
+    lines = [orjson.loads(line) for line in webhooks._read_lines(str(path))]
+    assert lines == [
+        {'event': 'order_created', 'body': '{"a": 1}', 'signature': 'a'},
+        {'event': 'order_refunded', 'body': '{\n"b": 2\n}', 'signature': 'b'},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_replay_spool(monkeypatch, tmp_path):
+    processed = []
+
+    async def process_webhook(event: str, data: bytes, signature: str = ''):
+        processed.append((event, data, signature))
+
+    monkeypatch.setattr(webhooks, '_SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(webhooks, 'async_rds', _BrokenRedis())
+    monkeypatch.setattr(webhooks, 'process_webhook', process_webhook)
+
+    webhooks._append_spool({'event': 'order_created', 'body': b'{"a": 1}', 'signature': 'a'})  # nopep8.
+    [path] = list(tmp_path.iterdir())
+
+    # Redis is still not available, so processed directly.
+    await webhooks._replay_spool(str(path))
+
+    assert processed == [('order_created', b'{"a": 1}', 'a')]
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_replay_spool_partially(monkeypatch, tmp_path):
+    processed = []
+
+    async def process_webhook(event: str, data: bytes, signature: str = ''):
+        if signature == 'b':
+            raise RuntimeError('mongo is not available')
+        processed.append(signature)
+
+    async def dead_letter(fields: dict, attempts: int):
+        raise RuntimeError('mongo is not available')
+
+    monkeypatch.setattr(webhooks, '_SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(webhooks, 'async_rds', _BrokenRedis())
+    monkeypatch.setattr(webhooks, 'process_webhook', process_webhook)
+    monkeypatch.setattr(webhooks, '_dead_letter', dead_letter)
+
+    for signature in ['a', 'b', 'c']:
+        webhooks._append_spool({'event': 'order_created', 'body': b'{}', 'signature': signature})  # nopep8.
+    [path] = webhooks._spool_paths()
+
+    # The handled line is dropped, the others are kept in the claimed file.
+    with pytest.raises(RuntimeError):
+        await webhooks._replay_spool(path)
+    assert processed == ['a']
+
+    [claimed] = webhooks._spool_paths()
+    assert claimed.endswith('.replaying')
+    assert [orjson.loads(line)['signature'] for line in webhooks._read_lines(claimed)] == ['b', 'c']  # nopep8.
+
+    # Skipped while locked by others, e.g. another worker.
+    with open(claimed, 'rb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        await webhooks._replay_spool(claimed)
+    assert processed == ['a']
+
+    # Picked up after unlocked, e.g. the worker died.
+    monkeypatch.setattr(webhooks, '_dead_letter', _noop_dead_letter)
+    await webhooks._replay_spool(claimed)
+    assert processed == ['a', 'c']
+    assert webhooks._spool_paths() == []
+
+
+async def _noop_dead_letter(fields: dict, attempts: int):
+    pass  # DO NOTHING.
+
+
+class _BrokenRedis:
+    def __init__(self):
+        self.seen = set()
+
+    async def set(self, key: str, value: int, nx: bool, ex: int) -> bool:
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    async def delete(self, key: str):
+        self.seen.discard(key)
+
+    async def xadd(self, **kwargs):
+        raise redis.ConnectionError('unavailable')
+
+
+class _FakeEvents:
+    def __init__(self):
+        self.documents = {}
+
+    @property
+    def ids(self) -> set:
+        return set(self.documents)
+
+    async def insert_one(self, document: dict):
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError('duplicated')
+        self.documents[document['_id']] = dict(document)
+
+    async def update_one(self, query: dict, update: dict) -> UpdateResult:
+        document = self.documents.get(query['_id'])
+        if document is None or not self._matches(document, query):
+            return UpdateResult({'n': 0, 'nModified': 0}, True)
+        document.update(update['$set'])
+        return UpdateResult({'n': 1, 'nModified': 1}, True)
+
+    async def delete_one(self, query: dict):
+        document = self.documents.get(query['_id'])
+        if document is not None and self._matches(document, query):
+            del self.documents[query['_id']]
+
+    @staticmethod
+    def _matches(document: dict, query: dict) -> bool:
+        for key, value in query.items():
+            if isinstance(value, dict):
+                if not document.get(key) < value['$lt']:
+                    return False
+            elif document.get(key) != value:
+                return False
+        return True
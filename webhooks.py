@@ -0,0 +1,537 @@
+import asyncio
+import fcntl
+import glob
+import hashlib
+import os
+import socket
+import time
+
+import orjson
+import redis
+
+from datetime import datetime, timedelta
+from typing import BinaryIO, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from lemon import Event, dispatch_event
+from logger import logger
+from metrics import Histogram, collector
+from mongo.entitlements import touch_entitlements
+from mongo.db import IndexSpec, \
+    webhook_events, \
+    webhook_dead_letters, \
+    apply_indexes, \
+    normalize_json
+from rds import async_rds
+
+# Webhooks are acknowledged as soon as they are appended to the queue,
+# then processed by the consumers in background,
+# so a slow MongoDB doesn't make Lemon Squeezy deliveries time out and retry.
+#
+# https://redis.io/docs/data-types/streams/
+_STREAM = 'lemonsqueepy:webhooks'
+_GROUP = 'dispatchers'
+_STREAM_MAXLEN = 100000  # approximately, only trim the acknowledged entries.
+
+# Append to the local files when redis is not available,
+# and replay them to the stream when redis is back.
+#
+# The files are locked (flock) when appending and replaying,
+# the locks are released when the process exits, so the files left by
+# a dead worker are picked up by the others, or after restarting.
+_SPOOL_DIR = os.environ.get('LEMONSQUEEPY_SPOOL_DIR', os.path.expanduser('~/.lemonsqueepy/spool'))  # nopep8.
+_SPOOL_INTERVAL = 5  # seconds.
+
+_CONSUMERS = 4  # per process.
+_BATCH_SIZE = 16  # entries per read.
+_BLOCK = 5000  # milliseconds.
+
+# Retry the entries not acknowledged in `_RETRY_IDLE` milliseconds,
+# and move them to the dead letter store after `_MAX_ATTEMPTS` deliveries.
+_RETRY_IDLE = 30000  # milliseconds.
+_RETRY_INTERVAL = 10  # seconds.
+_MAX_ATTEMPTS = 5
+
+# Lemon Squeezy retries webhooks, so drop the duplicates as early as possible,
+# by the `X-Signature` (HMAC of the body) in redis first,
+# then by the event identity in MongoDB (unique `_id`) as the backstop.
+_SEEN_TTL = 86400  # seconds.
+_EVENTS_TTL = 30 * 86400  # seconds.
+
+# An event identity is claimed before dispatching, and marked done after.
+# The claim of a cancelled or crashed dispatch is taken over after expired,
+# no longer than `_RETRY_IDLE`, so the retried delivery isn't dropped.
+_CLAIM_TTL = _RETRY_IDLE / 1000  # seconds.
+
+_EVENTS_INDEXES: list[IndexSpec] = [
+    ([('created_at', ASCENDING)], {'expireAfterSeconds': _EVENTS_TTL}),
+]
+
+_dispatch_seconds = Histogram(
+    'lemonsqueepy_webhook_dispatch_duration_seconds',
+    'Webhook dispatch latency by event, including failed dispatches.',
+    ('event',),
+)
+
+_tasks: list[asyncio.Task] = []
+_stats = {
+    'duplicated': 0,  # dropped before queued.
+    'duplicated_events': 0,  # dropped before dispatched.
+    'enqueued': 0,
+    'spooled': 0,
+    'processed': 0,
+    'failed': 0,
+    'dead_lettered': 0,
+}
+
+
+async def setup_webhook_events():
+    await apply_indexes(webhook_events, _EVENTS_INDEXES)
+
+
+async def setup_webhooks():
+    try:
+        await async_rds.xgroup_create(_STREAM, _GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):  # the group already exists is fine.
+            raise
+    except redis.RedisError:
+        logger.exception('create webhooks consumer group failed')
+
+    prefix = f'{socket.gethostname()}-{os.getpid()}'
+    for i in range(_CONSUMERS):
+        _tasks.append(asyncio.create_task(_consume_forever(f'{prefix}-{i}')))
+    _tasks.append(asyncio.create_task(_retry_forever(f'{prefix}-retry')))
+    _tasks.append(asyncio.create_task(_replay_spool_forever()))
+
+
+async def teardown_webhooks():
+    for task in _tasks:
+        task.cancel()
+
+    for task in _tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass  # DO NOTHING.
+
+    _tasks.clear()
+
+
+# The `data` is the raw body which has been verified by the `signature`,
+# return False if it is a duplicate delivery.
+async def enqueue_webhook(event: Event, data: bytes, signature: str) -> bool:
+    if not await _mark_seen(signature):
+        _stats['duplicated'] += 1
+        return False
+
+    # Unmark if not queued for any reason (including cancelled),
+    # so the retried delivery from Lemon Squeezy isn't dropped.
+    queued = False
+    try:
+        await _queue_webhook({'event': str(event), 'body': data, 'signature': signature})  # nopep8.
+        queued = True
+    finally:
+        if not queued:
+            await _unmark_seen(signature)
+    return True
+
+
+async def process_webhook(event: str, data: bytes, signature: str = ''):
+    body = orjson.loads(data)
+    normalize_json(body)
+
+    # The spooled ones may have no signature, use the body hash instead.
+    identity = _event_identity(event, body, signature or hashlib.sha256(data).hexdigest())  # nopep8.
+    if not await _claim_event(identity):
+        _stats['duplicated_events'] += 1
+        return
+
+    # As the `_id` of the history, so retrying after partially written
+    # replaces it instead of inserting again, see `insert_or_replace()`.
+    body['_id'] = identity
+
+    start = time.perf_counter()
+    dispatched = False
+    try:
+        await dispatch_event(Event(event), body)
+        dispatched = True
+    finally:
+        _dispatch_seconds.observe(event, value=time.perf_counter() - start)
+        if not dispatched:  # failed or cancelled, release for retrying.
+            await webhook_events.delete_one({'_id': identity, 'done': False})  # nopep8.
+
+    await webhook_events.update_one({'_id': identity}, {'$set': {'done': True}})  # nopep8.
+
+    custom_data = (body.get('meta') or {}).get('custom_data') or {}
+    user_id = custom_data.get('user_id')
+    if user_id:
+        await touch_entitlements(user_id)
+
+
+async def _queue_webhook(fields: dict):
+    try:
+        await async_rds.xadd(
+            name=_STREAM,
+            fields=fields,
+            maxlen=_STREAM_MAXLEN,
+            approximate=True,
+        )
+        _stats['enqueued'] += 1
+        return
+    except redis.RedisError:
+        logger.exception('enqueue webhook failed, fallback to spool')
+
+    await asyncio.to_thread(_append_spool, fields)
+    _stats['spooled'] += 1
+
+
+# Return False if the event has been dispatched, or is being dispatched.
+async def _claim_event(identity: str) -> bool:
+    now = datetime.utcnow()
+    expire_at = now + timedelta(seconds=_CLAIM_TTL)
+    try:
+        await webhook_events.insert_one({
+            '_id': identity,
+            'done': False,
+            'expire_at': expire_at,
+            'created_at': now,
+        })
+        return True
+    except DuplicateKeyError:
+        pass
+
+    # Take over the expired claim, the documents without "done" are done.
+    res = await webhook_events.update_one(
+        {'_id': identity, 'done': False, 'expire_at': {'$lt': now}},
+        {'$set': {'expire_at': expire_at}},
+    )
+    return res.modified_count > 0
+
+
+async def webhook_queue_stats() -> dict:
+    res = dict(_stats)
+    res['spool_files'] = len(_spool_paths())
+
+    try:
+        pending: dict = await async_rds.xpending(_STREAM, _GROUP)
+        res['pending'] = pending['pending']
+
+        # The stream id is "milliseconds-sequence".
+        lag = 0
+        if pending['min']:
+            oldest = int(pending['min'].decode().split('-')[0])
+            lag = max(time.time() - oldest / 1000, 0)
+        res['lag_seconds'] = lag
+
+        for group in await async_rds.xinfo_groups(_STREAM):
+            if group['name'].decode() == _GROUP:
+                res['unread'] = group.get('lag')  # since redis 7.0.
+    except redis.RedisError:
+        logger.exception('get webhooks queue stats failed')
+
+    return res
+
+
+async def _consume_forever(consumer: str):
+    while True:
+        try:
+            streams = await async_rds.xreadgroup(
+                groupname=_GROUP,
+                consumername=consumer,
+                streams={_STREAM: '>'},
+                count=_BATCH_SIZE,
+                block=_BLOCK,
+            )
+            for _, entries in streams:
+                await _process_entries(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f'consume webhooks failed, consumer={consumer}')
+            await asyncio.sleep(1)
+
+
+# Process in order, and acknowledge all successful entries at once,
+# the failed entries stay pending for retrying.
+async def _process_entries(entries: list[tuple[bytes, dict]]):
+    acked: list[bytes] = []
+    for entry_id, fields in entries:
+        try:
+            await process_webhook(
+                event=fields[b'event'].decode(),
+                data=fields[b'body'],
+                signature=fields.get(b'signature', b'').decode(),
+            )
+            acked.append(entry_id)
+            _stats['processed'] += 1
+        except Exception:
+            logger.exception(f'process webhook failed, id={entry_id.decode()}')  # nopep8.
+            _stats['failed'] += 1
+
+    if acked:
+        await async_rds.xack(_STREAM, _GROUP, *acked)
+
+
+async def _retry_forever(consumer: str):
+    while True:
+        await asyncio.sleep(_RETRY_INTERVAL)
+        try:
+            await _retry_pending(consumer)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('retry webhooks failed')
+
+
+async def _retry_pending(consumer: str):
+    pending: list[dict] = await async_rds.xpending_range(
+        name=_STREAM,
+        groupname=_GROUP,
+        min='-',
+        max='+',
+        count=_BATCH_SIZE,
+        idle=_RETRY_IDLE,
+    )
+    if not pending:
+        return
+
+    exhausted = {p['message_id'] for p in pending if p['times_delivered'] >= _MAX_ATTEMPTS}  # nopep8.
+    entries = await async_rds.xclaim(
+        name=_STREAM,
+        groupname=_GROUP,
+        consumername=consumer,
+        min_idle_time=_RETRY_IDLE,
+        message_ids=[p['message_id'] for p in pending],
+    )
+
+    retries = []
+    for entry_id, fields in entries:
+        if not fields:  # trimmed from the stream.
+            await async_rds.xack(_STREAM, _GROUP, entry_id)
+            continue
+        if entry_id not in exhausted:
+            retries.append((entry_id, fields))
+            continue
+
+        await _dead_letter(fields, _MAX_ATTEMPTS)
+        await async_rds.xack(_STREAM, _GROUP, entry_id)
+
+    if retries:
+        await _process_entries(retries)
+
+
+async def _dead_letter(fields: dict, attempts: int):
+    logger.error(f'dead letter webhook, event={fields[b"event"].decode()}')
+    await webhook_dead_letters.insert_one({
+        'event': fields[b'event'].decode(),
+        'body': fields[b'body'].decode(errors='replace'),
+        'attempts': attempts,
+        'create_timestamp': int(time.time()),
+    })
+    _stats['dead_lettered'] += 1
+
+
+def _append_spool(fields: dict):
+    os.makedirs(_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(_SPOOL_DIR, f'webhooks-{os.getpid()}.jsonl')
+
+    entry = dict(fields, body=fields['body'].decode())
+    line = orjson.dumps(entry) + b'\n'
+    while True:
+        with open(path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if not _is_same_file(f, path):
+                continue  # renamed for replaying, append to a new one.
+
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            return
+
+
+async def _replay_spool_forever():
+    while True:
+        await asyncio.sleep(_SPOOL_INTERVAL)
+        for path in await asyncio.to_thread(_spool_paths):
+            try:
+                await _replay_spool(path)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f'replay spool failed, path={path}')
+
+
+# The appending files, and the replaying files (maybe left by a dead worker).
+def _spool_paths() -> list[str]:
+    return sorted(
+        glob.glob(os.path.join(_SPOOL_DIR, '*.jsonl')) +
+        glob.glob(os.path.join(_SPOOL_DIR, '*.replaying'))
+    )
+
+
+# Claim the file by locking it, so only one worker replays it,
+# and rename the appending one, so new entries go to a new file.
+#
+# The lines which are not handled (failed or cancelled) are kept in the file
+# for the next replaying; the handled lines may be replayed again
+# if the process dies, then they are dropped by the deduplication.
+#
+# All file operations run in threads, as same as `_append_spool()`,
+# so a large spool never blocks the event loop.
+async def _replay_spool(path: str):
+    claim = await asyncio.to_thread(_claim_spool, path)
+    if claim is None:
+        return  # claimed by others, or replayed.
+
+    f, claimed = claim
+    try:
+        lines = await asyncio.to_thread(_read_lines, claimed)
+        handled = 0
+        try:
+            for line in lines:
+                await _replay_line(line)
+                handled += 1
+        finally:
+            await asyncio.to_thread(_release_spool, claimed, lines, handled)
+    finally:
+        f.close()  # unlock.
+
+
+async def _replay_line(line: bytes):
+    fields: dict = orjson.loads(line)
+    fields['body'] = fields['body'].encode()
+
+    try:
+        await async_rds.xadd(
+            name=_STREAM,
+            fields=fields,
+            maxlen=_STREAM_MAXLEN,
+            approximate=True,
+        )
+        return
+    except redis.RedisError:
+        pass  # process directly.
+
+    try:
+        await process_webhook(
+            event=fields['event'],
+            data=fields['body'],
+            signature=fields.get('signature', ''),
+        )
+        _stats['processed'] += 1
+    except Exception:
+        logger.exception('process spooled webhook failed')
+        await _dead_letter({b'event': fields['event'].encode(), b'body': fields['body']}, 1)  # nopep8.
+
+
+# Return the locked file and the path to replay,
+# or None if locked by others or removed.
+def _claim_spool(path: str) -> Optional[tuple[BinaryIO, str]]:
+    f = _lock_spool(path)
+    if f is None:
+        return None
+
+    claimed = path
+    if path.endswith('.jsonl'):
+        claimed = f'{path}.{os.getpid()}.replaying'
+        try:
+            os.rename(path, claimed)
+        except BaseException:
+            f.close()
+            raise
+    return f, claimed
+
+
+# Remove the file if all `lines` are handled, or keep the remaining ones.
+def _release_spool(path: str, lines: list[bytes], handled: int):
+    if handled == len(lines):
+        os.remove(path)
+    elif handled:
+        _write_lines(path, lines[handled:])
+
+
+# Return the locked file, or None if locked by others or removed.
+def _lock_spool(path: str) -> Optional[BinaryIO]:
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+
+    if not _is_same_file(f, path):  # renamed or removed before locked.
+        f.close()
+        return None
+    return f
+
+
+def _is_same_file(f: BinaryIO, path: str) -> bool:
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _read_lines(path: str) -> list[bytes]:
+    with open(path, 'rb') as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+
+# Replace atomically, so a crash never leaves a partial file.
+def _write_lines(path: str, lines: list[bytes]):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b''.join(line + b'\n' for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Return False if the `signature` has been seen,
+# or True if not, or redis is not available (the backstop will check it).
+async def _mark_seen(signature: str) -> bool:
+    try:
+        return bool(await async_rds.set(
+            f'lemonsqueepy:webhooks:seen:{signature}', 1,
+            nx=True,
+            ex=_SEEN_TTL,
+        ))
+    except redis.RedisError:
+        logger.exception('mark webhook seen failed')
+        return True
+
+
+async def _unmark_seen(signature: str):
+    try:
+        await async_rds.delete(f'lemonsqueepy:webhooks:seen:{signature}')
+    except redis.RedisError:
+        logger.exception('unmark webhook seen failed')
+
+
+# The same event of the same object at the same time is a duplicate,
+# fallback to the signature (HMAC of the body) if missing some fields.
+def _event_identity(event: str, body: dict, signature: str) -> str:
+    data: dict = body.get('data') or {}
+    updated_at = (data.get('attributes') or {}).get('updated_at')
+    if data.get('id') is None or not isinstance(updated_at, datetime):
+        return f'{event}:{signature}'
+
+    return f'{event}:{data["id"]}:{updated_at.isoformat()}'
+
+
+@collector('lemonsqueepy_webhooks_total', 'Webhooks by stage.', 'counter', ('stage',))  # nopep8.
+async def _collect_webhooks() -> dict:
+    return {(stage,): count for stage, count in _stats.items()}
+
+
+@collector('lemonsqueepy_webhook_queue', 'Webhook queue state, e.g. pending, lag_seconds.', 'gauge', ('state',), merge='max')  # nopep8; shared by workers.
+async def _collect_webhook_queue() -> dict:
+    res = await webhook_queue_stats()
+    return {(k,): v for k, v in res.items() if k not in _stats and isinstance(v, (int, float))}  # nopep8.